@@ -6,20 +6,38 @@ Some code is taken from: https://github.com/abahgat/webapp2-user-accounts
 
 import importlib
 import json
+import csv
+import os
+import cPickle as pickle
+from cStringIO import StringIO
 import re
+import hmac
+import hashlib
+import base64
+import time as time_module
+import random
+import math
+import logging
 from urlparse import urlparse
-from datetime import datetime, time, date
+from datetime import datetime, time, date, timedelta
 from urllib import urlencode
 import webapp2
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import Cursor
 from google.appengine.ext.db import BadValueError, BadRequestError
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import datastore_query
+from google.appengine.runtime import apiproxy_errors
 from webapp2_extras import auth
 from webapp2_extras import sessions
 from webapp2_extras.routes import NamePrefixRoute
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.api import app_identity
+from google.appengine.api import datastore
+from google.appengine.api import images
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
 from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
 try:
@@ -27,154 +45,1634 @@ try:
 except ImportError as e:
     dateutil = None
 
+try:
+    import msgpack
+except ImportError as e:
+    msgpack = None
+
+try:
+    import cloudstorage
+except ImportError as e:
+    cloudstorage = None
+
+
+# The REST permissions
+PERMISSION_ANYONE = 'anyone'
+PERMISSION_LOGGED_IN_USER = 'logged_in_user'
+PERMISSION_OWNER_USER = 'owner_user'
+PERMISSION_ADMIN = 'admin'
+
+# The content types accepted for MessagePack input/output (in addition to JSON)
+MSGPACK_CONTENT_TYPES = ['application/x-msgpack', 'application/msgpack']
+
+# All of the models wrapped by a RESTHandler (kind -> model class)
+_rest_models = {}
+
+# The output settings of the first RESTHandler registered for each model (kind -> dict, see register_rest_model) - used when a model
+# is output without its own handler's settings
+_rest_output_settings = {}
+
+# The metadata of the models (translation tables, included properties, input decoders) - (model class, metadata name) -> value.
+# Each value is computed once (when the model is registered, or on first use) and is immutable, so it's safely shared by all threads.
+_model_metadata = {}
+
+# ISO 8601 formats (parsed without dateutil)
+_ISO_DATETIME_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d{1,6})\d*)?)?)?\s*(Z|[+-]\d{2}(?::?\d{2})?)?$')
+_ISO_TIME_RE = re.compile(r'^(\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d{1,6})\d*)?)?$')
+
+# Compact model IDs (see encode_model_id) - e.g. '123', '~my_id', 'Parent:123,456'
+_COMPACT_ID_SEGMENT = r'(?:\d+|~[A-Za-z0-9_.\-]+)'
+_COMPACT_ID_RE = re.compile(r'^(?:\w+:%s,)*%s$' % (_COMPACT_ID_SEGMENT, _COMPACT_ID_SEGMENT))
+_COMPACT_STRING_ID_RE = re.compile(r'^[A-Za-z0-9_.\-]+$')
+
+# The app's hostname (resolved once per instance - see get_server_host)
+_server_host = None
+
+# The maximal width/height of an image rendition (see get_blob_rendition)
+MAX_RENDITION_SIZE = 1600
+# How long (in seconds) clients may cache an image rendition
+RENDITION_CACHE_SECONDS = 86400 * 365
+# The maximal size (in bytes) of a stored rendition (datastore entities are limited to 1MB) - bigger renditions are generated on each request
+MAX_STORED_RENDITION_BYTES = 1000000
+
+# The number of keys fetched (and deleted) in each batch of a background purge task
+PURGE_BATCH_SIZE = 500
+# The number of batches a single purge task processes before checkpointing (i.e. continuing in a new task)
+PURGE_BATCHES_PER_TASK = 20
+# How long (in seconds) a running purge holds its lease (renewed on each checkpoint) - a purge isn't started again while its lease is held
+PURGE_LEASE_TIME = 3600
+
+# The batch size of the GET queries when `max_result_bytes` is set (the size of the results is checked as each batch is fetched)
+RESULT_BYTES_BATCH_SIZE = 100
+
+# The maximal size (in bytes) of a prefetched page (see RESTHandler's `prefetch_next_page`) - bigger pages aren't cached (memcache values
+# are limited to 1MB)
+PREFETCH_MAX_BYTES = 900000
+
+# The maximal number of shards a GET query can be split into (shard=i/n)
+MAX_QUERY_SHARDS = 256
+# The number of __scatter__ samples taken per shard when splitting a kind's key space
+SHARD_OVERSAMPLING = 32
+# The maximal number of keys scanned when splitting a kind that has too few __scatter__ samples (i.e. a small kind)
+SHARD_FALLBACK_SCAN_SIZE = 10000
+# How long (in seconds) the split points of a kind are kept - all of the shards of a parallel read should start within this time
+SHARD_SPLIT_POINTS_CACHE_TIME = 3600
+
+# The first path segments of the endpoints routed ahead of the model IDs (e.g. /api/my_model/_export) - not allowed as input IDs
+# (see RESTMeta.use_input_id), since such models couldn't be reached
+RESERVED_MODEL_IDS = frozenset(['_export', '_watch', '_aggregate', '_views', '_blobs'])
+
+# The supported export formats (format -> content type) and the number of entities fetched in each batch of an export
+EXPORT_CONTENT_TYPES = { 'ndjson': 'application/x-ndjson', 'csv': 'text/csv' }
+EXPORT_BATCH_SIZE = 1000
+# How long (in seconds) the status of a background export is kept
+EXPORT_STATUS_CACHE_TIME = 86400 * 7
+
+# How long (in seconds) delete tombstones are kept by default (see RESTMeta.tombstone_horizon)
+DEFAULT_TOMBSTONE_HORIZON = 86400 * 30
+# The maximal number of deletions returned to a syncing client - if there are more, the client has to resync from scratch
+MAX_SYNC_TOMBSTONES = 10000
+# Sync tokens are moved back by this many seconds, so changes which weren't visible to the (eventually consistent) query are returned next time
+SYNC_TOKEN_OVERLAP = 60
+
+# The default/maximal time (in seconds) a watch request waits for changes, and the interval of its memcache checks
+WATCH_DEFAULT_TIMEOUT = 25
+WATCH_MAX_TIMEOUT = 50
+WATCH_POLL_INTERVAL = 0.5
+# How long (in seconds) the change records are kept, and the maximal number of them a watch request reads
+WATCH_CHANGES_CACHE_TIME = 600
+WATCH_MAX_CHANGES = 1000
+
+# The number of shards of each counter (see increment_counters) - the number of concurrent increments a counter can handle
+COUNTER_SHARDS = 20
+# How long (in seconds) the counter totals are cached (they're also updated on each increment), how long (in seconds) a total is marked
+# as being summed from the shards (see get_counters), and the offset added to the cached totals (memcache can't decrement below 0)
+COUNTER_CACHE_TIME = 300
+COUNTER_CACHE_LOCK_TIME = 5
+COUNTER_CACHE_OFFSET = 2 ** 62
+# The maximal number of sharded counters of a model (a model is written together with a shard of each counter, in a cross-group
+# transaction of up to 25 entity groups)
+MAX_SHARDED_COUNTERS = 24
+
+# The geohash alphabet, the precision (length) of the indexed geohashes, the maximal number of geohash prefixes (i.e. parallel queries) per
+# geo query, and the maximal number of models fetched from each prefix (a query with more models in one of its cells fails, rather than
+# silently missing some of them)
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9
+MAX_GEO_PREFIXES = 16
+MAX_GEO_CELL_RESULTS = 1000
+# The mean radius of the earth (in meters)
+EARTH_RADIUS = 6371000.0
+
+# The transient datastore errors which are retried (see the `retry_attempts` RESTHandler argument)
+TRANSIENT_DATASTORE_ERRORS = (datastore_errors.Timeout, datastore_errors.TransactionFailedError, datastore_errors.InternalError)
+
+# The default number of models in a materialized view (see RESTMeta.views), how long (in seconds) writes are batched before the views are
+# refreshed, and how long (in seconds) the views are cached in memcache
+DEFAULT_VIEW_LIMIT = 50
+VIEW_REFRESH_DELAY = 5
+VIEW_CACHE_TIME = 86400
+
+# The name of the search index property (see RESTMeta.search_properties), and the maximal length of the indexed word prefixes
+SEARCH_INDEX_NAME = 'search_tokens'
+SEARCH_MAX_PREFIX_LENGTH = 20
+
+# The supported aggregation operations, the batch size of the aggregation queries and how long (in seconds) the results are cached
+AGGREGATE_OPERATIONS = ['sum', 'avg', 'min', 'max', 'count']
+AGGREGATE_BATCH_SIZE = 1000
+AGGREGATE_CACHE_TIME = 3600
+
+
+class NDBEncoder(json.JSONEncoder):
+    """JSON encoding for NDB models and properties. `output_settings` are the settings of the RESTHandler serving the response (see
+    register_rest_model) - used for the models of its kind."""
+    def __init__(self, *args, **kwd):
+        self._output_settings = kwd.pop('output_settings', None)
+        super(NDBEncoder, self).__init__(*args, **kwd)
+        # The encoded IDs (each key is encoded only once per response)
+        self._encoded_ids = {}
+
+    def _get_output_settings(self, obj):
+        kind = obj._get_kind()
+        if self._output_settings and self._output_settings['kind'] == kind:
+            return self._output_settings
+        return _rest_output_settings.get(kind) or {}
+
+    def _decode_key(self, key):
+            return encode_model_id(key, self._encoded_ids)
+
+    def default(self, obj):
+        if isinstance(obj, ndb.Model):
+            obj_dict = obj.to_dict()
+
+            # Each BlobKeyProperty is represented as a dict of upload_url/download_url
+            for name in get_blob_properties(obj):
+                settings = self._get_output_settings(obj)
+                blob_property_url = 'http://%s%s/%s/%s' % (get_server_host(), settings.get('base_url', ''), self._decode_key(obj.key), name) # e.g. /api/my_model/<SOME_KEY>/blob_prop
+                blob_key = getattr(obj, name)
+
+                if blob_key and settings.get('blob_download_secret'):
+                    # Use a pre-authorized download URL (served without going through the REST handler)
+                    download_url = get_signed_blob_url(settings['base_url'], blob_key, settings['blob_download_secret'], settings['blob_download_url_ttl'])
+                else:
+                    download_url = blob_property_url if blob_key else None # Display as null if the blob property is not set
+
+                obj_dict[name] = {
+                        'upload_url': blob_property_url,
+                        'download_url': download_url
+                        }
+
+                if blob_key and settings.get('blob_rendition_sizes'):
+                    # The download URLs of the allowed image renditions
+                    obj_dict[name]['renditions'] = get_blob_rendition_urls(settings, blob_key, blob_property_url)
+
+
+            # Filter the properties that will be returned to user
+            included_properties = get_included_properties(obj, 'output')
+            obj_dict = dict((k,v) for k,v in obj_dict.iteritems() if k in included_properties)
+            # Translate the property names
+            obj_dict = translate_property_names(obj_dict, obj, 'output')
+            obj_dict['id'] = self._decode_key(obj.key)
+
+            return obj_dict
+
+        elif isinstance(obj, datetime) or isinstance(obj, date) or isinstance(obj, time):
+            return obj.isoformat()
+
+        elif isinstance(obj, ndb.Key):
+            return self._decode_key(obj)
+
+        elif isinstance(obj, ndb.GeoPt):
+            return str(obj)
+
+        else:
+            return json.JSONEncoder.default(self, obj)
+
+class BlobRendition(ndb.Model):
+    """A resized version of an image blob (BlobKeyProperty), generated once per (blob key, transformation) - see get_blob_rendition"""
+    blob_key = ndb.BlobKeyProperty()
+    data = ndb.BlobProperty()
+    content_type = ndb.StringProperty(indexed=False)
+
+
+class RESTTombstone(ndb.Model):
+    """Marks a model instance deleted through a RESTHandler - for models with a RESTMeta.updated_property (see the `since` GET argument)"""
+    model_kind = ndb.StringProperty()
+    model_id = ndb.StringProperty(indexed=False)
+    owner = ndb.KeyProperty()
+    deleted = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class RESTCounterShard(ndb.Model):
+    """A shard of a counter (see increment_counters) - the key name is formatted as 'counter_name|shard_number'"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class RESTMaterializedView(ndb.Model):
+    """The stored results of a view of a model (see RESTMeta.views) - the key name is formatted as 'kind:view_name'"""
+    results = ndb.PickleProperty(compressed=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class FrozenDict(dict):
+    """A read-only dict (used for the model metadata shared by all requests)"""
+
+    def _read_only(self, *args, **kwd):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+class RESTException(Exception):
+    """REST methods exception"""
+    pass
+
+
+class NoResponseResult(object):
+    """A class representing a non-response - used by rest_method_wrapper to detect when we shouldn't print any data with response.write.
+    Used when serving blobs (for BlobKeyProperty)"""
+    pass
+
+
+#
+# Utility functions
+#
+
+
+def encode_model_id(key, memo=None):
+    """Returns the ID of `key` as displayed to the user - according to the RESTMeta of its model class: the string ID (if `use_input_id`
+    is set), a compact ID (if `use_compact_id` is set) or the urlsafe key. `memo` is an optional dict for caching the encoded IDs."""
+
+    if memo is not None and key in memo:
+        return memo[key]
+
+    meta_class = getattr(ndb.Model._kind_map.get(key.kind()), 'RESTMeta', None)
+
+    if meta_class and getattr(meta_class, 'use_input_id', False):
+        model_id = key.string_id()
+    elif meta_class and getattr(meta_class, 'use_compact_id', False):
+        model_id = _encode_compact_id(key) or key.urlsafe()
+    else:
+        model_id = key.urlsafe()
+
+    if memo is not None:
+        memo[key] = model_id
+
+    return model_id
+
+
+def decode_model_id(model_class, model_id, memo=None):
+    """Returns the key of a `model_class` instance according to its `model_id` (as returned by encode_model_id). Raises an exception
+    if the ID is invalid. `memo` is an optional dict for caching the decoded keys."""
+
+    if memo is not None and (model_class, model_id) in memo:
+        return memo[(model_class, model_id)]
+
+    meta_class = getattr(model_class, 'RESTMeta', None)
+
+    if meta_class and getattr(meta_class, 'use_input_id', False):
+        key = ndb.Key(model_class, model_id)
+    elif meta_class and getattr(meta_class, 'use_compact_id', False) and _COMPACT_ID_RE.match(model_id):
+        key = _decode_compact_id(model_class, model_id)
+    else:
+        key = ndb.Key(urlsafe=model_id)
+
+    if memo is not None:
+        memo[(model_class, model_id)] = key
+
+    return key
+
+
+def _encode_compact_id(key):
+    """Returns a compact ID for `key`: the ID (integer IDs as-is, string IDs prefixed with '~') of a root entity, or its ancestors' kinds
+    and IDs followed by its ID, for an entity with ancestors (e.g. 'Parent:123,456'). The app ID, namespace and the model's own kind are
+    omitted. Returns None if the key can't be represented that way (e.g. a string ID with special characters)."""
+
+    segments = []
+
+    for (kind, id) in key.pairs():
+        if isinstance(id, basestring):
+            if not _COMPACT_STRING_ID_RE.match(id):
+                return None
+            id = '~' + id
+
+        segments.append('%s:%s' % (kind, id))
+
+    # The kind of the entity itself is known from the endpoint
+    segments[-1] = segments[-1].split(':', 1)[1]
+
+    return ','.join(segments)
+
+
+def _decode_compact_id(model_class, model_id):
+    """Returns the key of a `model_class` instance according to its compact ID (see _encode_compact_id)"""
+
+    pairs = []
+    segments = model_id.split(',')
+
+    for segment in segments[:-1]:
+        (kind, id) = segment.split(':', 1)
+        pairs.append((kind, id[1:] if id.startswith('~') else int(id)))
+
+    id = segments[-1]
+    pairs.append((model_class._get_kind(), id[1:] if id.startswith('~') else int(id)))
+
+    return ndb.Key(pairs=pairs)
+
+
+def get_server_host():
+    """Returns the app's hostname (resolved only once per instance)"""
+    global _server_host
+
+    if _server_host is None:
+        _server_host = app_identity.get_default_version_hostname()
+
+    return _server_host
+
+
+def get_blob_properties(model):
+    """Returns the names of the BlobKeyProperty properties of a `model` class"""
+    return get_model_metadata(model, 'blob_properties', lambda model_class: tuple(name for (name, prop) in model_class._properties.iteritems() if isinstance(prop, ndb.BlobKeyProperty)))
+
+
+def get_signed_blob_url(base_url, blob_key, secret, ttl, size=None, crop=False):
+    """Returns a pre-authorized download URL for `blob_key` (served by BlobDownloadHandlerClass), which expires in `ttl` to 2*`ttl` seconds.
+    The expiration time is rounded, so the URL stays the same for `ttl` seconds (and can be cached by clients). If `size` is given, the URL
+    is of that rendition of the image (see get_blob_rendition) - the size and crop are signed too, so other renditions can't be requested."""
+
+    expires = (int(time_module.time()) // ttl + 2) * ttl
+    rendition = get_rendition_name(size, crop) if size else None
+    params = [('expires', expires)] + ([('size', size)] + ([('crop', 'true')] if crop else []) if size else [])
+
+    return 'http://%s%s/_blobs/%s?%s' % (get_server_host(), base_url, blob_key, urlencode(params + [('signature', _sign_blob_url(secret, blob_key, expires, rendition))]))
+
+
+def get_blob_rendition_urls(output_settings, blob_key, blob_property_url):
+    """Returns the download URLs of the allowed renditions of `blob_key` (see the `blob_rendition_sizes` RESTHandler argument) - a dict of
+    rendition (e.g. '400x300:crop') -> URL. The URLs are pre-authorized if the handler has a `blob_download_secret`."""
+
+    urls = {}
+
+    for (size, crop) in output_settings['blob_rendition_sizes'].itervalues():
+        if output_settings.get('blob_download_secret'):
+            url = get_signed_blob_url(output_settings['base_url'], blob_key, output_settings['blob_download_secret'], output_settings['blob_download_url_ttl'], size, crop)
+        else:
+            url = '%s?%s' % (blob_property_url, urlencode([('size', size)] + ([('crop', 'true')] if crop else [])))
+
+        urls[size + (':crop' if crop else '')] = url
+
+    return urls
+
+
+def _sign_blob_url(secret, blob_key, expires, rendition=None):
+    message = '%s:%d:%s' % (blob_key, expires, rendition) if rendition else '%s:%d' % (blob_key, expires)
+    return base64.urlsafe_b64encode(hmac.new(secret, message, hashlib.sha256).digest()).rstrip('=')
+
+
+def _parse_rendition_size(size):
+    """Returns the (width, height) of a rendition `size` argument ('200' or '200x100'). Raises a RESTException if it's invalid."""
+
+    try:
+        (width, height) = [int(n) for n in size.lower().split('x')] if 'x' in size else (int(size), int(size))
+        if not (0 < width <= MAX_RENDITION_SIZE and 0 < height <= MAX_RENDITION_SIZE): raise ValueError()
+    except ValueError:
+        raise RESTException('Invalid "size" parameter - %s (must be formatted as WIDTH or WIDTHxHEIGHT, up to %d)' % (size, MAX_RENDITION_SIZE))
+
+    return (width, height)
+
+
+def get_rendition_name(size, crop=False):
+    """Returns the normalized name of a rendition - 'WIDTHxHEIGHT', with a 'c' suffix if it's cropped (e.g. size='200' is '200x200').
+    Raises a RESTException if `size` is invalid."""
+    return '%dx%d%s' % (_parse_rendition_size(size) + ('c' if crop else '',))
+
+
+def parse_rendition_sizes(sizes):
+    """Returns a dict of name (see get_rendition_name) -> (size, crop) of the `blob_rendition_sizes` RESTHandler argument - a list of `size`
+    arguments, with a ':crop' suffix for cropped renditions (e.g. ['200', '400x300:crop']). Raises ValueError if a size is invalid."""
+
+    renditions = {}
+
+    for value in sizes:
+        (size, crop) = (value[:-len(':crop')], True) if value.endswith(':crop') else (value, False)
+        try:
+            renditions[get_rendition_name(size, crop)] = (size, crop)
+        except RESTException, exc:
+            raise ValueError('Invalid "blob_rendition_sizes" value - %s' % value)
+
+    return renditions
+
+
+def get_blob_rendition(blob_key, size, crop=False):
+    """Returns the BlobRendition of an image `blob_key` resized to `size` ('200' or '200x100' - the image is resized to fit in that box,
+    or cropped to exactly that size if `crop` is set). The rendition is generated using the images service and stored on first use (unless
+    it's bigger than MAX_STORED_RENDITION_BYTES - then an unsaved BlobRendition is returned)."""
+
+    (width, height) = _parse_rendition_size(size)
+    rendition_key = ndb.Key(BlobRendition, '%s:%s' % (blob_key, get_rendition_name(size, crop)))
+    rendition = rendition_key.get()
+
+    if not rendition:
+        blob_info = blobstore.BlobInfo.get(blob_key)
+        if not blob_info or not blob_info.content_type.startswith('image/'):
+            raise RESTException('The blob is not an image')
+
+        (output_encoding, content_type) = (images.PNG, 'image/png') if blob_info.content_type in ['image/png', 'image/gif'] else (images.JPEG, 'image/jpeg')
+
+        try:
+            image = images.Image(blob_key=blob_key)
+            image.resize(width=width, height=height, crop_to_fit=crop)
+            data = image.execute_transforms(output_encoding=output_encoding)
+        except images.Error, exc:
+            raise RESTException('Could not resize the image - %s' % exc)
+
+        rendition = BlobRendition(key=rendition_key, blob_key=blob_key, data=data, content_type=content_type)
+
+        if len(data) <= MAX_STORED_RENDITION_BYTES:
+            rendition.put()
+        else:
+            # Too big for an entity - it's resized again on each request (the clients still cache it)
+            logging.info('Not storing the %s rendition of %s - it is too big (%d bytes)' % (size, blob_key, len(data)))
+
+    return rendition
+
+
+def get_blob_rendition_response(request, blob_key, public=False, allowed_renditions=None):
+    """Returns a response with the rendition of `blob_key` according to the size/crop arguments of the `request` (see get_blob_rendition).
+    If `allowed_renditions` (rendition names - see get_rendition_name) are given, other renditions are rejected."""
+
+    (size, crop) = (request.GET.get('size'), _is_rendition_cropped(request))
+
+    if allowed_renditions is not None and get_rendition_name(size, crop) not in allowed_renditions:
+        raise RESTException('Invalid "size"/"crop" parameters - %s (the allowed sizes are: %s)' % (size, ', '.join(sorted(allowed_renditions))))
+
+    rendition = get_blob_rendition(blob_key, size, crop)
+
+    response = webapp2.Response()
+    response.headers['ETag'] = '"%s"' % rendition.key.id()
+    response.headers['Cache-Control'] = '%s, max-age=%d' % ('public' if public else 'private', RENDITION_CACHE_SECONDS)
+
+    if request.headers.get('If-None-Match') == response.headers['ETag']:
+        response.status = 304
+    else:
+        response.headers['Content-Type'] = str(rendition.content_type)
+        response.body = rendition.data
+
+    return response
+
+
+def _is_rendition_cropped(request):
+    return request.GET.get('crop', '').lower() in ['1', 'true']
+
+
+def get_model_blob_keys(model):
+    """Returns the blob keys of all of the BlobKeyProperty values of a `model` instance (including repeated properties)"""
+
+    blob_keys = []
+
+    for name in get_blob_properties(model):
+        value = getattr(model, name)
+        blob_keys.extend([blob_key for blob_key in value if blob_key] if isinstance(value, list) else [value] if value else [])
+
+    return blob_keys
+
+
+def delete_blobs(blob_keys):
+    """Deletes the given blobs and their renditions"""
+    blobstore.delete(blob_keys)
+    _delete_blob_renditions_async(blob_keys).get_result()
+
+
+@ndb.tasklet
+def _delete_blob_renditions_async(blob_keys):
+    keys = yield [BlobRendition.query(BlobRendition.blob_key == blob_key).fetch_async(keys_only=True) for blob_key in blob_keys]
+    yield ndb.delete_multi_async([key for rendition_keys in keys for key in rendition_keys])
+
+
+def is_owner_ancestor_model(model):
+    """Returns True if the instances of a `model` class are stored under their owner's key (RESTMeta.user_owner_ancestor)"""
+    meta_class = getattr(model, 'RESTMeta', None)
+    return bool(meta_class and getattr(meta_class, 'user_owner_property', None) and getattr(meta_class, 'user_owner_ancestor', False))
+
+
+def get_model_metadata(model, name, compute):
+    """Returns the metadata `name` of a `model` class (or instance). The metadata is computed by calling `compute` with the model class
+    (only once per model class) - the returned value must not be modified."""
+
+    model_class = model if isinstance(model, type) else model.__class__
+
+    try:
+        return _model_metadata[(model_class, name)]
+    except KeyError:
+        # setdefault makes sure all of the threads get the same value, even if several threads computed it at the same time
+        return _model_metadata.setdefault((model_class, name), compute(model_class))
+
+
+def freeze_model_metadata(model):
+    """Computes all of the metadata of a `model` class from its RESTMeta (called when the model is registered, so requests only read it)"""
+
+    for input_type in ['input', 'output']:
+        get_translation_table(model, input_type)
+        get_included_properties(model, input_type)
+
+    get_input_decoder(model)
+
+
+def clear_model_metadata(model):
+    """Clears the computed metadata of a `model` class (should be called if its properties or RESTMeta are changed)"""
+
+    for key in [key for key in _model_metadata.keys() if key[0] is model]:
+        _model_metadata.pop(key, None)
+
+
+def get_translation_table(model, input_type):
+    """Returns the translation table for a given `model` with a given `input_type`"""
+    return get_model_metadata(model, 'translation_table_%s' % input_type, lambda model_class: _build_translation_table(model_class, input_type))
+
+
+def _build_translation_table(model, input_type):
+    meta_class = getattr(model, 'RESTMeta', None)
+    if not meta_class:
+        return FrozenDict()
+
+    # Build a new dict (the RESTMeta dicts must not be modified - they're shared by the input and output tables)
+    translation_table = dict(getattr(model.RESTMeta, 'translate_property_names', {}))
+    translation_table.update(getattr(model.RESTMeta, 'translate_%s_property_names' % input_type, {}))
+
+    return FrozenDict(translation_table)
+
+
+
+def translate_property_names(data, model, input_type):
+    """Translates property names in `data` dict from one name to another, according to what is stated in `input_type` and the model's
+    RESTMeta.translate_property_names/translate_input_property_names/translate_output_property_name - note that the change of `data` is in-place."""
+
+    translation_table = get_translation_table(model, input_type)
+
+    if not translation_table:
+        return data
+
+
+    # Translate from one property name to another - for output, we turn the original property names
+    # into the new property names. For input, we convert back from the new property names to the original
+    # property names.
+    for old_name, new_name in translation_table.iteritems():
+        if input_type == 'output' and old_name not in data: continue
+        if input_type == 'input' and new_name not in data: continue
+
+        if input_type == 'output':
+            original_value = data[old_name]
+            del data[old_name]
+            data[new_name] = original_value
+
+        elif input_type == 'input':
+            original_value = data[new_name]
+            del data[new_name]
+            data[old_name] = original_value
+
+    return data
+
+def get_included_properties(model, input_type):
+    """Gets the properties of a `model` class to use for input/output (`input_type`). Uses the
+    model's Meta class to determine the included/excluded properties."""
+    return get_model_metadata(model, 'included_properties_%s' % input_type, lambda model_class: _build_included_properties(model_class, input_type))
+
+
+def _build_included_properties(model, input_type):
+    meta_class = getattr(model, 'RESTMeta', None)
+
+    included_properties = set()
+
+    if meta_class:
+        included_properties = set(getattr(meta_class, 'included_%s_properties' % input_type, []))
+        included_properties.update(set(getattr(meta_class, 'included_properties', [])))
+
+    if not included_properties:
+        # No Meta class (or no included properties defined), assume all properties are included
+        included_properties = set(model._properties.keys())
+
+    if meta_class:
+        excluded_properties = set(getattr(meta_class, 'excluded_%s_properties' % input_type, []))
+        excluded_properties.update(set(getattr(meta_class, 'excluded_properties', [])))
+    else:
+        # No Meta class, assume no properties are excluded
+        excluded_properties = set()
+
+    # The index properties are only used for querying
+    excluded_properties.update(get_index_property_names(model))
+
+    # Add some default excluded properties
+    if input_type == 'input':
+        excluded_properties.update(set(BaseRESTHandler.DEFAULT_EXCLUDED_INPUT_PROPERTIES))
+        if meta_class:
+            # Counters can only be incremented (using "$inc" - see RESTMeta.sharded_counters)
+            excluded_properties.update(set(getattr(meta_class, 'sharded_counters', [])))
+        if meta_class and getattr(meta_class, 'use_input_id', False):
+            included_properties.update(['id'])
+    if input_type == 'output':
+        excluded_properties.update(set(BaseRESTHandler.DEFAULT_EXCLUDED_OUTPUT_PROPERTIES))
+
+    # Calculate the properties to include
+    properties = included_properties - excluded_properties
+
+    return frozenset(properties)
+
+
+def start_purge(name, kind, filters=None, select_keys=None, select_keys_args=()):
+    """Schedules a purge task (see purge_entities) - unless a purge of the same `name` is still running (i.e. holds its lease).
+    Returns True if the purge was scheduled."""
+
+    if not memcache.add('rest_gae:purge_lease:%s' % name, True, time=PURGE_LEASE_TIME):
+        return False
+
+    deferred.defer(purge_entities, name, kind, filters, select_keys, select_keys_args)
+    return True
+
+
+def purge_entities(name, kind, filters=None, select_keys=None, select_keys_args=(), cursor=None, scanned_count=0, deleted_count=0):
+    """Deletes all of the entities of `kind` that match the `filters` (a list of (property name, operator, value) tuples). Should be
+    run as a deferred task (see start_purge): scans keys-only batches, optionally narrowed by the `select_keys` function (receives a list
+    of keys + the `select_keys_args` and returns the keys to delete), and deletes them asynchronously. After PURGE_BATCHES_PER_TASK batches
+    it checkpoints by deferring itself with the current cursor. The progress is stored in memcache under `name` (see get_purge_stats)."""
+
+    filter_nodes = [ndb.FilterNode(*f) for f in (filters or [])]
+    query = ndb.Query(kind=kind, filters=(ndb.AND(*filter_nodes) if len(filter_nodes) > 1 else (filter_nodes[0] if filter_nodes else None)))
+
+    cursor = Cursor(urlsafe=cursor) if cursor else None
+    more_available = True
+    delete_futures = []
+
+    for i in range(PURGE_BATCHES_PER_TASK):
+        (keys, cursor, more_available) = query.fetch_page(PURGE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        scanned_count += len(keys)
+
+        if select_keys and keys:
+            keys = select_keys(keys, *select_keys_args)
+
+        if keys:
+            # Keep on scanning while the keys are being deleted
+            delete_futures.append(ndb.delete_multi_async(keys))
+            deleted_count += len(keys)
+
+        if not more_available or not cursor:
+            more_available = False
+            break
+
+    for futures in delete_futures:
+        for future in futures:
+            future.check_success()
+
+    memcache.set('rest_gae:purge:%s' % name, {
+        'scanned': scanned_count,
+        'deleted': deleted_count,
+        'finished': not more_available,
+        'updated': int(time_module.time())
+        })
+
+    if more_available:
+        # Checkpoint - continue in a new task (and renew the lease, so the purge won't be started again in the meantime)
+        memcache.set('rest_gae:purge_lease:%s' % name, True, time=PURGE_LEASE_TIME)
+        deferred.defer(purge_entities, name, kind, filters, select_keys, select_keys_args, cursor.urlsafe(), scanned_count, deleted_count)
+    else:
+        memcache.delete('rest_gae:purge_lease:%s' % name)
+        logging.info('Purge "%s" finished - deleted %d out of %d scanned %s entities' % (name, deleted_count, scanned_count, kind))
+
+
+def register_rest_model(model, base_url, **kwd):
+    """Registers a `model` class as served by a RESTHandler at `base_url` (with the RESTHandler's `kwd` arguments) and computes its metadata.
+    Returns the settings needed for the handler's output - a dict of kind/base_url/blob_download_secret/blob_download_url_ttl/blob_rendition_sizes, which is
+    kept per handler (several handlers may serve the same model with different settings) and can be passed to deferred tasks."""
+
+    if not hasattr(model, 'RESTMeta'):
+        class NewRESTMeta: pass
+        model.RESTMeta = NewRESTMeta
+
+    output_settings = {
+            'kind': model._get_kind(),
+            # The base API URL of the handler (used for BlobKeyProperty)
+            'base_url': base_url,
+            # Pre-authorized blob download URLs (used for BlobKeyProperty)
+            'blob_download_secret': kwd.get('blob_download_secret', None),
+            'blob_download_url_ttl': kwd.get('blob_download_url_ttl', 86400),
+            # The allowed image renditions of the BlobKeyProperty downloads (name -> (size, crop) - see parse_rendition_sizes), None for any
+            'blob_rendition_sizes': parse_rendition_sizes(kwd['blob_rendition_sizes']) if kwd.get('blob_rendition_sizes') is not None else None
+            }
+
+    _rest_models[model._get_kind()] = model
+    _rest_output_settings.setdefault(model._get_kind(), output_settings)
+
+    install_geo_index(model)
+    install_search_index(model)
+
+    # Compute the model metadata now, so the requests will only read it
+    freeze_model_metadata(model)
+
+    return output_settings
+
+
+def _ensure_rest_model(model, output_settings):
+    """Registers a `model` class with a RESTHandler's `output_settings` (see register_rest_model), unless it's already registered in this
+    instance - for deferred tasks, which may run in an instance where the RESTHandler wasn't created"""
+
+    if _rest_models.get(model._get_kind()) is not model:
+        register_rest_model(model, **output_settings)
+
+
+def build_gql_query(model, q):
+    """Returns a query of a `model` class filtered by the GQL conditions `q` (which may use the translated input property names)"""
+
+    # Translate any property names
+    translation_table = get_translation_table(model, 'input')
+
+    for original_name, new_name in translation_table.iteritems():
+        # Replace any references to the new property name with the old (original) one
+        q = re.sub(r'\b%s\s*(<=|>=|=|<|>|!=|(\s+IN\s+))' % new_name, r'%s \1' % original_name, q, flags=re.IGNORECASE)
+
+    return model.gql('WHERE ' + q)
+
+
+def get_query_orders(model, order):
+    """Returns the query orders of a `model` class for an `order` string formatted as 'col1, -col2, col3' (which may use the translated input
+    property names). Raises AttributeError for invalid property names."""
+
+    orders = []
+
+    for o in order.split(','):
+        o = o.strip()
+        # Translate the property name (if it's defined for the model) - e.g. input 'col1' is actually 'my_col1' in MyModel
+        name = translate_property_names({ o.lstrip('-+'): True }, model, 'input').keys()[0]
+        orders.append(-getattr(model, name) if o.startswith('-') else getattr(model, name))
+
+    return orders
+
+
+def build_view_query(model, view):
+    """Returns the query of a materialized view of a `model` class - `view` is a dict of q/order (see RESTMeta.views)"""
+    query = build_gql_query(model, view['q']) if view.get('q') else model.query()
+    return query.order(*get_query_orders(model, view['order'])) if view.get('order') else query
+
+
+def refresh_views(model, names=None):
+    """Recomputes the materialized views (RESTMeta.views) of a `model` class (or its import path) - all of them, or only `names`. The results
+    (model instances) are stored both as RESTMaterializedView entities and in memcache - they're encoded on each request, so the output
+    (e.g. signed blob URLs and counter totals) is always up-to-date. Returns a dict of view name -> results."""
+
+    model = import_class(model)
+    kind = model._get_kind()
+    views = model.RESTMeta.views
+
+    if names is None:
+        # Writes from now on will schedule another refresh (see schedule_views_refresh)
+        memcache.delete('rest_gae:views_dirty:%s' % kind)
+        names = sorted(views)
+
+    futures = [(name, build_view_query(model, views[name]).fetch_async(views[name].get('limit', DEFAULT_VIEW_LIMIT))) for name in names]
+    results = dict((name, future.get_result()) for (name, future) in futures)
+
+    ndb.put_multi([RESTMaterializedView(id='%s:%s' % (kind, name), results=view_results) for (name, view_results) in results.iteritems()])
+    memcache.set_multi(dict(('%s:%s' % (kind, name), view_results) for (name, view_results) in results.iteritems()), key_prefix='rest_gae:view:', time=VIEW_CACHE_TIME)
+
+    return results
+
+
+def schedule_views_refresh(model):
+    """Schedules a (deferred) refresh of the materialized views of a `model` class after a write - the writes of VIEW_REFRESH_DELAY seconds
+    are batched into a single refresh"""
+
+    if memcache.add('rest_gae:views_dirty:%s' % model._get_kind(), True, time=VIEW_REFRESH_DELAY * 12):
+        deferred.defer(refresh_views, get_class_path(model), _countdown=VIEW_REFRESH_DELAY)
+
+
+def get_geo_index_name(model):
+    """Returns the name of the geohash index property of a `model` class (see RESTMeta.geo_index_property), or None if not used"""
+    meta_class = getattr(model, 'RESTMeta', None)
+    geo_property = getattr(meta_class, 'geo_index_property', None) if meta_class else None
+    return '%s_geohash' % geo_property if geo_property else None
+
+
+def install_geo_index(model):
+    """Adds the geohash index property to a `model` class (if RESTMeta.geo_index_property is set): a repeated ComputedProperty holding all
+    of the prefixes of the geohash of the location - so the models in a geohash cell can be found using an equality filter"""
+
+    index_name = get_geo_index_name(model)
+    if not index_name or index_name in model._properties:
+        return
+
+    geo_property = model._properties.get(model.RESTMeta.geo_index_property)
+    if not isinstance(geo_property, ndb.GeoPtProperty) or geo_property._repeated:
+        raise ValueError('The geo_index_property "%s" (defined in RESTMeta.geo_index_property) must be a GeoPtProperty in the given model %s' % (model.RESTMeta.geo_index_property, model))
+
+    def get_geohash_prefixes(entity):
+        location = geo_property._get_value(entity)
+        if not location:
+            return []
+        geohash = encode_geohash(location.lat, location.lon, GEOHASH_PRECISION)
+        return [geohash[:i] for i in range(1, GEOHASH_PRECISION + 1)]
+
+    setattr(model, index_name, ndb.ComputedProperty(get_geohash_prefixes, name=index_name, repeated=True))
+    model._fix_up_properties()
+    clear_model_metadata(model)
+
+
+def install_search_index(model):
+    """Adds the search index property to a `model` class (if RESTMeta.search_properties is set): a repeated ComputedProperty holding the
+    prefixes of all of the words of the searchable properties - as 'property_name:prefix' and ':prefix' (for searching all of them)"""
+
+    meta_class = getattr(model, 'RESTMeta', None)
+    names = list(getattr(meta_class, 'search_properties', [])) if meta_class else []
+
+    if not names or SEARCH_INDEX_NAME in model._properties:
+        return
+
+    for name in names:
+        if not isinstance(model._properties.get(name), (ndb.StringProperty, ndb.TextProperty)):
+            raise ValueError('The search property "%s" (defined in RESTMeta.search_properties) must be a StringProperty in the given model %s' % (name, model))
+
+    def get_search_tokens(entity):
+        tokens = set()
+
+        for name in names:
+            values = getattr(entity, name)
+            for value in (values if isinstance(values, list) else [values]):
+                for word in get_search_words(value or ''):
+                    for i in range(1, min(len(word), SEARCH_MAX_PREFIX_LENGTH) + 1):
+                        tokens.update(['%s:%s' % (name, word[:i]), ':%s' % word[:i]])
+
+        return sorted(tokens)
+
+    setattr(model, SEARCH_INDEX_NAME, ndb.ComputedProperty(get_search_tokens, name=SEARCH_INDEX_NAME, repeated=True))
+    model._fix_up_properties()
+    clear_model_metadata(model)
+
+
+def get_search_words(value):
+    """Returns the normalized (lower-case) words of a string, as indexed for searching (see install_search_index)"""
+    return re.findall(r'\w+', value.lower(), re.UNICODE)
+
+
+def get_index_property_names(model):
+    """Returns the names of the hidden index properties of a `model` class (geohash/search indexes) - they're used only for querying"""
+    meta_class = getattr(model, 'RESTMeta', None)
+    names = [get_geo_index_name(model)] + ([SEARCH_INDEX_NAME] if meta_class and getattr(meta_class, 'search_properties', None) else [])
+    return [name for name in names if name]
+
+
+def encode_geohash(lat, lng, precision):
+    """Returns the geohash of a location (with `precision` characters)"""
+
+    (lat_range, lng_range) = ([-90.0, 90.0], [-180.0, 180.0])
+    geohash = []
+    (bits, bit_count, use_lng) = (0, 0, True)
+
+    while len(geohash) < precision:
+        (value, value_range) = (lng, lng_range) if use_lng else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+
+        if value >= middle:
+            bits = (bits << 1) | 1
+            value_range[0] = middle
+        else:
+            bits = bits << 1
+            value_range[1] = middle
+
+        (bit_count, use_lng) = (bit_count + 1, not use_lng)
+
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            (bits, bit_count) = (0, 0)
+
+    return ''.join(geohash)
+
+
+def get_geohash_prefixes(south, west, north, east):
+    """Returns the geohashes of the cells which cover a bounding box - using the longest geohashes that need at most MAX_GEO_PREFIXES cells.
+    `east` may be smaller than `west` for boxes crossing the 180th meridian."""
+
+    if east < west:
+        east += 360
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        # The cell size of geohashes with this precision (each character is 5 bits - starting with a longitude bit)
+        cell_height = 180.0 / 2 ** (5 * precision // 2)
+        cell_width = 360.0 / 2 ** ((5 * precision + 1) // 2)
+
+        if (int((north - south) / cell_height) + 2) * (int((east - west) / cell_width) + 2) <= MAX_GEO_PREFIXES or precision == 1:
+            break
+
+    lats = [min(south + i * cell_height, north) for i in range(int((north - south) / cell_height) + 2)]
+    lngs = [min(west + i * cell_width, east) for i in range(int((east - west) / cell_width) + 2)]
+
+    return sorted(set(encode_geohash(lat, (lng + 180) % 360 - 180, precision) for lat in lats for lng in lngs))
+
+
+def get_distance(lat1, lng1, lat2, lng2):
+    """Returns the distance (in meters) between two locations (the haversine formula)"""
+
+    (lat1, lng1, lat2, lng2) = [math.radians(value) for value in (lat1, lng1, lat2, lng2)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def reindex_entities(model, cursor=None, reindexed_count=0):
+    """Re-saves all of the entities of a `model` class (or its import path, e.g. 'models.MyModel'), so their computed index properties
+    (RESTMeta.geo_index_property/search_properties) are updated - for entities created before the index was added. Should be run as a
+    deferred task: checkpoints by deferring itself every PURGE_BATCHES_PER_TASK batches."""
+
+    model = import_class(model)
+    install_geo_index(model)
+    install_search_index(model)
+    query = model.query()
+
+    cursor = Cursor(urlsafe=cursor) if cursor else None
+    more_available = True
+
+    for i in range(PURGE_BATCHES_PER_TASK):
+        (entities, cursor, more_available) = query.fetch_page(PURGE_BATCH_SIZE, start_cursor=cursor)
+        ndb.put_multi(entities)
+        reindexed_count += len(entities)
+
+        if not more_available or not cursor:
+            more_available = False
+            break
+
+    if more_available:
+        # Checkpoint - continue in a new task
+        deferred.defer(reindex_entities, get_class_path(model), cursor.urlsafe(), reindexed_count)
+    else:
+        logging.info('Reindexed %d %s entities' % (reindexed_count, model._get_kind()))
+
+
+def iter_export(model, query, format, after_get_callback=None, output_settings=None, **options):
+    """Yields the results of `query` (`model` instances) encoded as NDJSON (a JSON object per line) or CSV (`format`), in chunks of
+    EXPORT_BATCH_SIZE entities - the same output as the GET endpoint (including the RESTMeta filtering and translation of properties).
+    `options` are passed to the query (e.g. deadline, read_policy)."""
+
+    encoder = NDBEncoder(output_settings=output_settings)
+
+    if format == 'csv':
+        output_names = translate_property_names(dict.fromkeys(get_included_properties(model, 'output')), model, 'output').keys()
+        columns = ['id'] + sorted(name for name in output_names if name != 'id')
+        yield _encode_csv_row(columns)
+
+    future = query.fetch_page_async(EXPORT_BATCH_SIZE, **options)
+
+    while future:
+        (results, cursor, more_available) = future.get_result()
+
+        # Fetch the next batch while the current one is being encoded
+        future = query.fetch_page_async(EXPORT_BATCH_SIZE, start_cursor=cursor, **options) if more_available and cursor else None
+
+        merge_counters(model, results)
+
+        if after_get_callback:
+            results = after_get_callback(results)
+
+        if format == 'csv':
+            rows = [encoder.default(result) for result in results]
+            yield ''.join(_encode_csv_row([_encode_csv_value(row.get(name), encoder) for name in columns]) for row in rows)
+        else:
+            yield ''.join(encoder.encode(result) + '\n' for result in results)
+
+
+def _encode_csv_row(values):
+    output = StringIO()
+    csv.writer(output).writerow(values)
+    return output.getvalue()
+
+
+def _encode_csv_value(value, encoder):
+    """Returns a CSV cell for a property value - lists and dicts are JSON-encoded"""
+
+    if value is None:
+        return ''
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, (str, bool, int, long, float)):
+        return str(value)
+    elif isinstance(value, (list, dict)):
+        return encoder.encode(value)
+    else:
+        return _encode_csv_value(encoder.default(value), encoder)
+
+
+def export_to_file(model, output_settings, filters, ancestor, format, filename, export_id, after_get_callback=None, orders=None):
+    """Writes all of the `model` instances that match `filters` (and `ancestor`, ordered by `orders` - see encode_query_orders) to a Google
+    Cloud Storage file (`filename`) - see iter_export. Should be run as a deferred task (requires the GCS client library). The status is
+    stored in memcache (see get_export_status)."""
+
+    _ensure_rest_model(model, output_settings)
+
+    query = ndb.Query(kind=model._get_kind(), ancestor=ancestor, filters=filters, orders=decode_query_orders(orders))
+
+    with cloudstorage.open(filename, 'w', content_type=EXPORT_CONTENT_TYPES[format]) as output:
+        for chunk in iter_export(model, query, format, after_get_callback, output_settings):
+            output.write(chunk)
+
+    status = get_export_status(export_id) or {}
+    status['finished'] = True
+    memcache.set('rest_gae:export:%s' % export_id, status, time=EXPORT_STATUS_CACHE_TIME)
+
+    logging.info('Export %s of %s finished' % (export_id, model._get_kind()))
+
+
+def get_tombstone_horizon(model):
+    """Returns how long (in seconds) the delete tombstones of a `model` class are kept (RESTMeta.tombstone_horizon)"""
+    return getattr(model.RESTMeta, 'tombstone_horizon', DEFAULT_TOMBSTONE_HORIZON)
+
+
+def get_tombstone_purge_jobs(now):
+    """Returns the purge jobs (see purge_entities) which delete the expired tombstones of all of the registered models - a list of
+    (name, kind, filters, select_keys, select_keys_args) tuples"""
+
+    return [('tombstones_%s' % kind, RESTTombstone._get_kind(), [('model_kind', '=', kind), ('deleted', '<', now - timedelta(seconds=get_tombstone_horizon(model)))], None, ())
+            for (kind, model) in sorted(_rest_models.iteritems()) if getattr(model.RESTMeta, 'updated_property', None)]
+
+
+def _datetime_to_sync_token(value):
+    """Returns a sync token (the number of microseconds since the epoch) for a datetime"""
+    delta = value - datetime(1970, 1, 1)
+    return str((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _sync_token_to_datetime(token):
+    """Returns the datetime of a sync token (see _datetime_to_sync_token). Raises ValueError if the token is invalid."""
+    return datetime(1970, 1, 1) + timedelta(microseconds=int(token))
+
+
+def record_changes(kind, changes):
+    """Records a write to models of `kind` for the watch requests: bumps the kind's change generation (in memcache) and stores the
+    `changes` - a list of (model ID, operation, owner key) tuples - under the new generation. Returns the new generation."""
+
+    generation = memcache.incr('rest_gae:gen:%s' % kind, initial_value=_get_initial_generation())
+
+    if generation is not None:
+        memcache.set('rest_gae:changes:%s:%d' % (kind, generation), changes, time=WATCH_CHANGES_CACHE_TIME)
+
+    return generation
+
+
+def get_change_generation(kind):
+    """Returns the current change generation of `kind` (see record_changes)"""
+
+    generation = memcache.get('rest_gae:gen:%s' % kind)
+
+    if generation is None:
+        memcache.add('rest_gae:gen:%s' % kind, _get_initial_generation())
+        generation = memcache.get('rest_gae:gen:%s' % kind) or 0
+
+    return generation
+
+
+def _get_initial_generation():
+    # The generations start from the current time (in microseconds) - so when the generation is evicted from memcache, it restarts from
+    # a greater value instead of reusing the previous generations (which key the cached aggregations, and the watch requests' changes)
+    return int(time_module.time() * 1000000)
+
+
+def get_count_counter_name(kind, owner=None):
+    """Returns the name of the counter of all of the models of `kind` (or only the models of `owner`) - see RESTMeta.maintain_count"""
+    return 'count:%s' % kind + (':%s' % owner.urlsafe() if owner else '')
+
+
+def get_property_counter_name(key, name):
+    """Returns the name of the sharded counter of the `name` property of the model with `key` (see RESTMeta.sharded_counters)"""
+    return 'property:%s:%s' % (name, key.urlsafe())
+
+
+def increment_counters(deltas):
+    """Increments sharded counters - `deltas` is a dict of counter name -> delta (may be negative). Each counter is incremented in a
+    random shard (in a transaction), so the counters can handle frequent concurrent increments."""
+
+    uncached_names = begin_cached_counters_update(deltas)
+    futures = [ndb.transaction_async(lambda name=name, delta=delta: increment_counters_async({ name: delta })) for (name, delta) in deltas.iteritems() if delta]
+
+    try:
+        for future in futures:
+            future.get_result()
+    except Exception:
+        end_cached_counters_update(deltas, uncached_names, committed=False)
+        raise
+
+    end_cached_counters_update(deltas, uncached_names)
+
+
+@ndb.tasklet
+def increment_counters_async(deltas):
+    """Increments sharded counters (see increment_counters) without a transaction of its own - for incrementing counters in the transaction
+    that writes their model. The cached totals must be updated around the transaction (see begin_cached_counters_update)."""
+
+    keys = [ndb.Key(RESTCounterShard, '%s|%d' % (name, random.randint(0, COUNTER_SHARDS - 1))) for (name, delta) in sorted(deltas.iteritems()) if delta]
+    shards = yield ndb.get_multi_async(keys)
+    shards = [shard or RESTCounterShard(key=key) for (key, shard) in zip(keys, shards)]
+
+    for shard in shards:
+        shard.count += deltas[shard.key.id().rsplit('|', 1)[0]]
+
+    yield ndb.put_multi_async(shards)
+
+
+def _is_cached_counter_total(value):
+    # Anything else is a mark of a total being summed (see get_counters)
+    return isinstance(value, (int, long)) and value >= COUNTER_CACHE_OFFSET // 2
+
+
+def begin_cached_counters_update(deltas):
+    """Applies the increments `deltas` (a dict of counter name -> delta) to the cached counter totals - before the increments are committed.
+    Returns the names of the counters whose totals aren't cached (or are being summed by get_counters) - see end_cached_counters_update."""
+
+    results = memcache.offset_multi(dict((name, delta) for (name, delta) in deltas.iteritems() if delta), key_prefix='rest_gae:counter:')
+    return [name for (name, total) in results.iteritems() if not _is_cached_counter_total(total)]
+
+
+def end_cached_counters_update(deltas, uncached_names, committed=True):
+    """Completes the update of the cached counter totals once the increments `deltas` were committed (or failed, if `committed` is False).
+    The totals which weren't cached are removed - a total summed from the shards before the increment was committed mustn't be cached."""
+
+    if uncached_names:
+        memcache.delete_multi(uncached_names, key_prefix='rest_gae:counter:')
+
+    if not committed:
+        memcache.offset_multi(dict((name, -delta) for (name, delta) in deltas.iteritems() if delta and name not in uncached_names), key_prefix='rest_gae:counter:')
+
+
+def get_counters(names):
+    """Returns the totals of sharded counters (see increment_counters) - a dict of counter name -> total. The totals are cached in memcache."""
+
+    client = memcache.Client()
+    cached = client.get_multi(names, key_prefix='rest_gae:counter:')
+    counters = dict((name, total - COUNTER_CACHE_OFFSET) for (name, total) in cached.iteritems() if _is_cached_counter_total(total))
+    missing_names = [name for name in names if name not in counters]
+
+    if missing_names:
+        # Mark the totals as being summed - an increment in the meantime removes the mark, so a total which misses it won't be cached
+        client.add_multi(dict((name, 0) for name in missing_names), time=COUNTER_CACHE_LOCK_TIME, key_prefix='rest_gae:counter:')
+        marks = client.get_multi(missing_names, key_prefix='rest_gae:counter:', for_cas=True)
+
+        shards = ndb.get_multi([ndb.Key(RESTCounterShard, '%s|%d' % (name, i)) for name in missing_names for i in range(COUNTER_SHARDS)])
+
+        for (n, name) in enumerate(missing_names):
+            counters[name] = sum(shard.count for shard in shards[n * COUNTER_SHARDS:(n + 1) * COUNTER_SHARDS] if shard)
+
+        client.cas_multi(dict((name, counters[name] + COUNTER_CACHE_OFFSET) for name in missing_names if marks.get(name) == 0), time=COUNTER_CACHE_TIME, key_prefix='rest_gae:counter:')
+
+    return counters
+
+
+def delete_counters(names):
+    """Deletes sharded counters (see increment_counters)"""
+    ndb.delete_multi([ndb.Key(RESTCounterShard, '%s|%d' % (name, i)) for name in names for i in range(COUNTER_SHARDS)])
+    memcache.delete_multi(names, key_prefix='rest_gae:counter:')
+
+
+def merge_counters(model, models):
+    """Sets the sharded counter properties of `models` (instances of the `model` class) to the totals of their counters (see
+    RESTMeta.sharded_counters)"""
+
+    counters = getattr(model.RESTMeta, 'sharded_counters', [])
+    models = [m for m in models if isinstance(m, model)]
+
+    if not counters or not models:
+        return
+
+    totals = get_counters([get_property_counter_name(m.key, name) for m in models for name in counters])
+
+    for m in models:
+        for name in counters:
+            # The property value itself is the initial value of the counter
+            setattr(m, name, (getattr(m, name) or 0) + totals[get_property_counter_name(m.key, name)])
+
+
+def aggregate_query(query, operation, field=None, group_by=None, max_results=None, **options):
+    """Returns the result of an aggregation `operation` (see AGGREGATE_OPERATIONS) of the `field` property over the results of `query` - or a
+    dict of `group_by` property value -> result. Only the needed properties are fetched (using a projection query, or keys-only for counting).
+    Results whose `field` value is None are skipped. Raises a RESTException if the query has more than `max_results` results (None for no
+    limit). `options` are passed to the query (e.g. deadline, read_policy)."""
+
+    projection = sorted(set(name for name in [field, group_by] if name))
+    groups = {}
+
+    if max_results is not None:
+        options['limit'] = max_results + 1
+
+    if projection:
+        results = query.iter(projection=projection, batch_size=AGGREGATE_BATCH_SIZE, **options)
+    else:
+        results = query.iter(keys_only=True, batch_size=AGGREGATE_BATCH_SIZE, **options)
+
+    for (i, result) in enumerate(results):
+        if max_results is not None and i >= max_results:
+            raise RESTException('Too many models to aggregate (more than %d) - try a narrower query' % max_results)
+
+        value = getattr(result, field) if field else None
+
+        if field and value is None:
+            continue
+
+        group = getattr(result, group_by) if group_by else None
+        stats = groups.get(group)
+
+        if stats is None:
+            groups[group] = stats = { 'count': 0, 'sum': 0, 'min': value, 'max': value }
+
+        stats['count'] += 1
+
+        if operation in ['sum', 'avg']:
+            stats['sum'] += value
+        elif operation == 'min':
+            stats['min'] = min(stats['min'], value)
+        elif operation == 'max':
+            stats['max'] = max(stats['max'], value)
+
+    def get_result(stats):
+        if operation == 'avg':
+            return float(stats['sum']) / stats['count'] if stats else None
+        return stats[operation] if stats else (0 if operation in ['sum', 'count'] else None)
+
+    if group_by:
+        return dict((group, get_result(stats)) for (group, stats) in groups.iteritems())
+
+    return get_result(groups.get(None))
+
+
+def get_export_status(export_id):
+    """Returns the status of a background export (see export_to_file) - a dict of filename/format/user/finished (or None if unknown)"""
+    return memcache.get('rest_gae:export:%s' % export_id)
+
 
-# The REST permissions
-PERMISSION_ANYONE = 'anyone'
-PERMISSION_LOGGED_IN_USER = 'logged_in_user'
-PERMISSION_OWNER_USER = 'owner_user'
-PERMISSION_ADMIN = 'admin'
+def get_shard_split_points(kind, n, ancestor=None):
+    """Returns the n-1 keys that split the key space of `kind` (or only the entities under `ancestor`) into `n` ranges of (roughly) the same
+    size, or an empty list if there are no such entities. The keys are sampled using the __scatter__ property (or a keys-only scan for small
+    kinds and for ancestors), and are cached in memcache so all of the shards of a parallel read use the same split points. A big kind with
+    fewer than `n` samples is split by its samples (so some of the ranges are empty)."""
 
+    cache_key = 'rest_gae:shards:%s:%d:%s' % (kind, n, ancestor.urlsafe() if ancestor else '')
+    split_points = memcache.get(cache_key)
 
+    if split_points is None:
+        if ancestor:
+            # The entities of an ancestor are a contiguous part of the key space - so they're split by scanning their keys
+            keys = ndb.Query(kind=kind, ancestor=ancestor).fetch(SHARD_FALLBACK_SCAN_SIZE, keys_only=True)
 
-class NDBEncoder(json.JSONEncoder):
-    """JSON encoding for NDB models and properties"""
-    def _decode_key(self, key):
-            model_class = ndb.Model._kind_map.get(key.kind())
-            if getattr(model_class, 'RESTMeta', None) and getattr(model_class.RESTMeta, 'use_input_id', False):
-                return key.string_id()
-            else:
-                return key.urlsafe()
+            if len(keys) == SHARD_FALLBACK_SCAN_SIZE:
+                logging.warning('Splitting the %s entities of %s by their first %d keys only - the last shard may be bigger' % (kind, ancestor, SHARD_FALLBACK_SCAN_SIZE))
+        else:
+            # __scatter__ is set on a random ~0.2% of the entities, so sorting by it returns a random sample of keys
+            query = datastore.Query(kind, keys_only=True)
+            query.Order('__scatter__')
+            keys = [ndb.Key.from_old_key(key) for key in query.Get(n * SHARD_OVERSAMPLING)]
 
-    def default(self, obj):
-        if isinstance(obj, ndb.Model):
-            obj_dict = obj.to_dict()
+            if len(keys) < n:
+                # Too few samples - a small kind is split by scanning its keys (a scan of a big kind would only cover the beginning of its
+                # key space, so it's split by the samples it has)
+                scanned_keys = ndb.Query(kind=kind).fetch(SHARD_FALLBACK_SCAN_SIZE, keys_only=True)
 
-            # Each BlobKeyProperty is represented as a dict of upload_url/download_url
-            for (name, prop) in obj._properties.iteritems():
-                if isinstance(prop, ndb.BlobKeyProperty):
-                    server_host = app_identity.get_default_version_hostname()
-                    blob_property_url = 'http://%s%s/%s/%s' % (server_host, obj.RESTMeta.base_url, self._decode_key(obj.key), name) # e.g. /api/my_model/<SOME_KEY>/blob_prop
-                    obj_dict[name] = {
-                            'upload_url': blob_property_url,
-                            'download_url': blob_property_url if getattr(obj, name) else None # Display as null if the blob property is not set
-                            }
+                if len(scanned_keys) < SHARD_FALLBACK_SCAN_SIZE or not keys:
+                    keys = scanned_keys
 
+        keys.sort()
+        split_points = [keys[len(keys) * i // n].urlsafe() for i in range(1, n)] if keys else []
+        memcache.set(cache_key, split_points, time=SHARD_SPLIT_POINTS_CACHE_TIME)
 
+    return [ndb.Key(urlsafe=key) for key in split_points]
 
-            # Filter the properties that will be returned to user
-            included_properties = get_included_properties(obj, 'output')
-            obj_dict = dict((k,v) for k,v in obj_dict.iteritems() if k in included_properties)
-            # Translate the property names
-            obj_dict = translate_property_names(obj_dict, obj, 'output')
-            obj_dict['id'] = self._decode_key(obj.key)
 
-            return obj_dict
+def get_inequality_property(filters):
+    """Returns the name of the property a query's `filters` (a filter node) compare with an inequality filter (a != filter is normalized into
+    a < and a > filter), or None if there's no inequality filter. The datastore allows inequality filters on a single property."""
 
-        elif isinstance(obj, datetime) or isinstance(obj, date) or isinstance(obj, time):
-            return obj.isoformat()
+    if isinstance(filters, (ndb.query.ConjunctionNode, ndb.query.DisjunctionNode)):
+        for node in filters:
+            name = get_inequality_property(node)
+            if name:
+                return name
+    elif isinstance(filters, ndb.query.FilterNode):
+        (name, opsymbol, value) = filters.__getnewargs__()
+        if opsymbol in ['<', '<=', '>', '>=']:
+            return name
 
-        elif isinstance(obj, ndb.Key):
-            return self._decode_key(obj)
+    return None
 
-        elif isinstance(obj, ndb.GeoPt):
-            return str(obj)
 
+def prefetch_page(model, ancestor, filters, orders, limit, cursor, cache_key, cache_time, **options):
+    """Fetches the page of `limit` results of a `model` query (`ancestor`, `filters` and `orders` - see encode_query_orders) that starts at
+    `cursor`, and stores it in memcache under `cache_key` for `cache_time` seconds (see RESTHandler's `prefetch_next_page`). Pages bigger
+    than PREFETCH_MAX_BYTES aren't stored. Should be run as a deferred task - `options` are passed to the query (e.g. deadline, read_policy)."""
+
+    model = import_class(model)
+    query = ndb.Query(kind=model._get_kind(), ancestor=ancestor, filters=filters, orders=decode_query_orders(orders))
+
+    try:
+        (results, cursor, more_available) = query.fetch_page(limit, start_cursor=Cursor(urlsafe=cursor), **options)
+    except (BadRequestError, datastore_errors.Timeout, apiproxy_errors.DeadlineExceededError), exc:
+        # Prefetching is only an optimization - the next request will simply query the datastore
+        logging.warning('Could not prefetch the next page - %s' % exc)
+        return
+
+    page = pickle.dumps((results, cursor.urlsafe() if cursor else None, more_available), pickle.HIGHEST_PROTOCOL)
+
+    if len(page) > PREFETCH_MAX_BYTES:
+        logging.info('Not prefetching a page of %s - it is too big (%d bytes)' % (model._get_kind(), len(page)))
+        return
+
+    memcache.set(cache_key, page, time=cache_time)
+
+
+def encode_query_orders(orders):
+    """Returns the orders of a query as a list of (property name, direction) tuples - the datastore orders can't be pickled"""
+
+    if orders is None:
+        return []
+    elif isinstance(orders, datastore_query.CompositeOrder):
+        return [(order.prop, order.direction) for order in orders.orders]
+
+    return [(orders.prop, orders.direction)]
+
+
+def decode_query_orders(orders):
+    """Returns the datastore orders of a list of (property name, direction) tuples (see encode_query_orders)"""
+
+    if not orders:
+        return None
+
+    return datastore_query.CompositeOrder([datastore_query.PropertyOrder(name, direction) for (name, direction) in orders])
+
+
+def get_prefetch_stats():
+    """Returns the hit rate of the prefetched pages (see RESTHandler's `prefetch_next_page`) - a dict of hits/misses/hit_rate"""
+
+    stats = memcache.get_multi(['hits', 'misses'], key_prefix='rest_gae:prefetch:')
+    (hits, misses) = (stats.get('hits', 0), stats.get('misses', 0))
+
+    return { 'hits': hits, 'misses': misses, 'hit_rate': float(hits) / (hits + misses) if hits + misses else None }
+
+
+def get_purge_stats(names):
+    """Returns the progress of the latest purge tasks (see purge_entities) - a dict of name -> dict of scanned/deleted/finished/updated"""
+    return memcache.get_multi(names, key_prefix='rest_gae:purge:')
+
+
+
+def get_owned_models():
+    """Returns the models registered with a RESTHandler which have a RESTMeta.user_owner_property - a list of (import path, output settings)
+    tuples, which can be passed to delete_owned_entities (which may run in an instance where the RESTHandlers weren't created)"""
+    return [(get_class_path(model), _rest_output_settings[kind]) for (kind, model) in sorted(_rest_models.iteritems()) if getattr(model.RESTMeta, 'user_owner_property', None)]
+
+
+def delete_owned_entities(owner_key, models=None, cursor=None, deleted_count=0):
+    """Deletes all of the entities owned by `owner_key` (i.e. their RESTMeta.user_owner_property equals `owner_key`) of all of the `models`
+    (see get_owned_models - should be computed in the request that schedules the deletion) - including their blobs (BlobKeyProperty),
+    and the same bookkeeping as the DELETE endpoint: delete tombstones, maintained counts, sharded counters, watch changes and views.
+    Should be run as a deferred task: scans each model in keys-only batches (full entities only for models with blobs), deletes them
+    asynchronously and checkpoints by deferring itself every PURGE_BATCHES_PER_TASK batches (and for each model)."""
+
+    if models is None:
+        models = get_owned_models()
+
+    if not models:
+        logging.info('Deleted %d entities owned by %s' % (deleted_count, owner_key))
+        return
+
+    (model_path, output_settings) = models[0]
+    model = import_class(model_path)
+    _ensure_rest_model(model, output_settings)
+    meta_class = model.RESTMeta
+    kind = model._get_kind()
+
+    if is_owner_ancestor_model(model):
+        query = model.query(ancestor=owner_key)
+    else:
+        query = model.query(getattr(model, meta_class.user_owner_property) == owner_key)
+    blob_properties = get_blob_properties(model)
+
+    cursor = Cursor(urlsafe=cursor) if cursor else None
+    more_available = True
+    futures = []
+    task_deleted_count = 0
+
+    for i in range(PURGE_BATCHES_PER_TASK):
+        if blob_properties:
+            # We need the entities themselves in order to delete their blobs
+            (entities, cursor, more_available) = query.fetch_page(PURGE_BATCH_SIZE, start_cursor=cursor)
+            keys = [entity.key for entity in entities]
+            blob_keys = [blob_key for entity in entities for blob_key in get_model_blob_keys(entity)]
+
+            if blob_keys:
+                futures.append(blobstore.delete_async(blob_keys))
+                futures.append(_delete_blob_renditions_async(blob_keys))
         else:
-            return json.JSONEncoder.default(self, obj)
+            (keys, cursor, more_available) = query.fetch_page(PURGE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
 
-class RESTException(Exception):
-    """REST methods exception"""
-    pass
+        futures.extend(ndb.delete_multi_async(keys))
 
+        if keys and getattr(meta_class, 'updated_property', None):
+            # Leave tombstones, so syncing clients will know about the deletions
+            futures.extend(ndb.put_multi_async([RESTTombstone(model_kind=kind, model_id=encode_model_id(key), owner=owner_key) for key in keys]))
 
-class NoResponseResult(object):
-    """A class representing a non-response - used by rest_method_wrapper to detect when we shouldn't print any data with response.write.
-    Used when serving blobs (for BlobKeyProperty)"""
-    pass
+        if keys and getattr(meta_class, 'sharded_counters', None):
+            delete_counters([get_property_counter_name(key, name) for key in keys for name in meta_class.sharded_counters])
 
+        if keys:
+            record_changes(kind, [(encode_model_id(key), 'deleted', owner_key) for key in keys])
 
-#
-# Utility functions
-#
+        task_deleted_count += len(keys)
 
+        if not more_available or not cursor:
+            more_available = False
+            break
 
-def get_translation_table(model, input_type):
-    """Returns the translation table for a given `model` with a given `input_type`"""
-    meta_class = getattr(model, 'RESTMeta', None)
-    if not meta_class:
-        return {}
+    for future in futures:
+        future.get_result()
 
-    translation_table = getattr(model.RESTMeta, 'translate_property_names', {})
-    translation_table.update(getattr(model.RESTMeta, 'translate_%s_property_names' % input_type, {}))
+    deleted_count += task_deleted_count
 
-    return translation_table
+    if task_deleted_count and getattr(meta_class, 'maintain_count', False):
+        increment_counters({ get_count_counter_name(kind): -task_deleted_count, get_count_counter_name(kind, owner_key): -task_deleted_count })
 
+    if task_deleted_count and getattr(meta_class, 'views', None):
+        schedule_views_refresh(model)
 
+    if more_available:
+        # Checkpoint - continue deleting the current model in a new task
+        deferred.defer(delete_owned_entities, owner_key, models, cursor.urlsafe(), deleted_count)
+    else:
+        # Continue to the next model
+        deferred.defer(delete_owned_entities, owner_key, models[1:], None, deleted_count)
 
-def translate_property_names(data, model, input_type):
-    """Translates property names in `data` dict from one name to another, according to what is stated in `input_type` and the model's
-    RESTMeta.translate_property_names/translate_input_property_names/translate_output_property_name - note that the change of `data` is in-place."""
 
-    translation_table = get_translation_table(model, input_type)
+def migrate_to_owner_ancestor(model, cursor=None, migrated_count=0):
+    """Moves all of the existing entities of a `model` class (or its import path, e.g. 'models.MyModel') under their owner's key (i.e. their
+    RESTMeta.user_owner_property) - for models that switch to RESTMeta.user_owner_ancestor. Each entity is copied to a key with the same ID
+    under its owner, and then the original entity is deleted (note that the model IDs change). Should be run as a deferred task: checkpoints
+    by deferring itself every PURGE_BATCHES_PER_TASK batches. Entities without an owner, or already stored under an ancestor, are left as-is.
+    Can be safely re-run."""
 
-    if not translation_table:
-        return data
+    model = import_class(model)
+    kind = model._get_kind()
+    owner_property = model.RESTMeta.user_owner_property
+    query = model.query()
 
+    cursor = Cursor(urlsafe=cursor) if cursor else None
+    more_available = True
 
-    # Translate from one property name to another - for output, we turn the original property names
-    # into the new property names. For input, we convert back from the new property names to the original
-    # property names.
-    for old_name, new_name in translation_table.iteritems():
-        if input_type == 'output' and old_name not in data: continue
-        if input_type == 'input' and new_name not in data: continue
+    for i in range(PURGE_BATCHES_PER_TASK):
+        (entities, cursor, more_available) = query.fetch_page(PURGE_BATCH_SIZE, start_cursor=cursor)
+        entities = [entity for entity in entities if not entity.key.parent() and getattr(entity, owner_property)]
+        old_keys = [entity.key for entity in entities]
 
-        if input_type == 'output':
-            original_value = data[old_name]
-            del data[old_name]
-            data[new_name] = original_value
+        for entity in entities:
+            entity.key = ndb.Key(kind, entity.key.id(), parent=getattr(entity, owner_property))
 
-        elif input_type == 'input':
-            original_value = data[new_name]
-            del data[new_name]
-            data[old_name] = original_value
+        # Only delete the original entities once their copies were written
+        ndb.put_multi(entities)
+        ndb.delete_multi(old_keys)
+        migrated_count += len(entities)
 
-    return data
+        if not more_available or not cursor:
+            more_available = False
+            break
 
-def get_included_properties(model, input_type):
-    """Gets the properties of a `model` class to use for input/output (`input_type`). Uses the
-    model's Meta class to determine the included/excluded properties."""
+    if more_available:
+        # Checkpoint - continue in a new task
+        deferred.defer(migrate_to_owner_ancestor, get_class_path(model), cursor.urlsafe(), migrated_count)
+    else:
+        logging.info('Moved %d %s entities under their owners' % (migrated_count, kind))
 
-    meta_class = getattr(model, 'RESTMeta', None)
 
-    included_properties = set()
 
-    if meta_class:
-        included_properties = set(getattr(meta_class, 'included_%s_properties' % input_type, []))
-        included_properties.update(set(getattr(meta_class, 'included_properties', [])))
+def get_input_decoder(model):
+    """Returns the compiled input decoder of a `model` class - a dict of input property name -> (property, converter), which includes
+    only the properties accepted as input. `converter` is a function receiving (handler, raw input value) and returning the property value,
+    or None if the raw value can be used as-is. The decoder is compiled once per model class."""
 
-    if not included_properties:
-        # No Meta class (or no included properties defined), assume all properties are included
-        included_properties = set(model._properties.keys())
+    return get_model_metadata(model, 'input_decoder', _build_input_decoder)
 
-    if meta_class:
-        excluded_properties = set(getattr(meta_class, 'excluded_%s_properties' % input_type, []))
-        excluded_properties.update(set(getattr(meta_class, 'excluded_properties', [])))
+
+def _build_input_decoder(model):
+    included_properties = get_included_properties(model, 'input')
+    return FrozenDict((name, (prop, _get_property_converter(prop))) for (name, prop) in model._properties.iteritems() if name in included_properties)
+
+
+def _get_property_converter(prop):
+    """Returns a converter function (handler, raw input value) -> property value for the given `prop` (or None if no conversion is needed)"""
+
+    if isinstance(prop, ndb.KeyProperty):
+        def convert_key(handler, value):
+            if value is None:
+                return None
+
+            model_class = ndb.Model._kind_map.get(prop._kind) if prop._kind is not None else None
+            if model_class is not None and getattr(model_class, 'RESTMeta', None) and getattr(model_class.RESTMeta, 'use_compact_id', False) and _COMPACT_ID_RE.match(value):
+                try:
+                    return decode_model_id(model_class, value, handler._decoded_ids)
+                except ValueError as e:
+                    raise RESTException('invalid key: {}'.format(value) )
+
+            try:
+                return ndb.Key(urlsafe=value)
+            except ProtocolBufferDecodeError as e:
+                if getattr(model_class, 'RESTMeta', None) and getattr(model_class.RESTMeta, 'use_input_id', False):
+                    return ndb.Key(model_class, value)
+            raise RESTException('invalid key: {}'.format(value) )
+
+        return convert_key
+
+    elif isinstance(prop, ndb.TimeProperty):
+        return lambda handler, value: parse_time(value) if value is not None else None
+    elif isinstance(prop, ndb.DateProperty):
+        return lambda handler, value: parse_date(value) if value is not None else None
+    elif isinstance(prop, ndb.DateTimeProperty):
+        return lambda handler, value: parse_datetime(value) if value is not None else None
+    elif isinstance(prop, ndb.GeoPtProperty):
+        # Convert from string (formatted as '52.37, 4.88') to GeoPt
+        return lambda handler, value: ndb.GeoPt(value) if value is not None else None
+    elif isinstance(prop, ndb.StructuredProperty):
+        # It's a structured property - the input data is a dict - recursively parse it as well
+        return lambda handler, value: handler._build_model_from_data(value, prop._modelclass) if value is not None else None
     else:
-        # No Meta class, assume no properties are excluded
-        excluded_properties = set()
+        # Use as-is (no need for further manipulation)
+        return None
 
-    # Add some default excluded properties
-    if input_type == 'input':
-        excluded_properties.update(set(BaseRESTHandler.DEFAULT_EXCLUDED_INPUT_PROPERTIES))
-        if meta_class and getattr(meta_class, 'use_input_id', False):
-            included_properties.update(['id'])
-    if input_type == 'output':
-        excluded_properties.update(set(BaseRESTHandler.DEFAULT_EXCLUDED_OUTPUT_PROPERTIES))
 
-    # Calculate the properties to include
-    properties = included_properties - excluded_properties
+def _parse_iso_datetime(value):
+    """Parses an ISO 8601 datetime (or date) string into a naive UTC datetime. Returns None if `value` isn't formatted as such."""
+
+    match = _ISO_DATETIME_RE.match(value) if isinstance(value, basestring) else None
+    if not match:
+        return None
+
+    (year, month, day, hour, minute, second, fraction, tz) = match.groups()
+
+    try:
+        value = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0), int((fraction or '0').ljust(6, '0')))
+    except ValueError as e:
+        return None
+
+    if tz and tz != 'Z':
+        # Convert to UTC (NDB only supports naive UTC datetimes)
+        tz = tz.replace(':', '')
+        offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5] or 0))
+        value = value - offset if tz[0] == '+' else value + offset
+
+    return value
+
+
+def parse_datetime(value):
+    """Parses an ISO 8601 datetime string (falls back to dateutil for other formats, if available)"""
+
+    result = _parse_iso_datetime(value)
+    if result is not None:
+        return result
+
+    if dateutil is None:
+        try:
+            return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+        except (ValueError, TypeError) as e:
+            raise RESTException("Invalid datetime. Must be in ISO 8601 format.")
+    else:
+        return dateutil.parser.parse(value)
+
+
+def parse_date(value):
+    """Parses an ISO 8601 date string (falls back to dateutil for other formats, if available)"""
+
+    result = _parse_iso_datetime(value)
+    if result is not None:
+        return result.date()
+
+    if dateutil is None:
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").date()
+        except (ValueError, TypeError) as e:
+            raise RESTException("Invalid date. Must be in ISO 8601 format.")
+    else:
+        return dateutil.parser.parse(value).date()
+
+
+def parse_time(value):
+    """Parses an ISO 8601 time string (falls back to dateutil for other formats, if available)"""
+
+    match = _ISO_TIME_RE.match(value) if isinstance(value, basestring) else None
+    if match:
+        (hour, minute, second, fraction) = match.groups()
+        try:
+            return time(int(hour), int(minute), int(second or 0), int((fraction or '0').ljust(6, '0')))
+        except ValueError as e:
+            pass
+
+    if dateutil is None:
+        try:
+            return datetime.strptime(value, "%H:%M:%S").time()
+        except (ValueError, TypeError) as e:
+            raise RESTException("Invalid time. Must be in ISO 8601 format.")
+    else:
+        return dateutil.parser.parse(value).time()
+
 
-    return properties
+
+def get_class_path(cls):
+    """Returns the import path of a class (e.g. 'models.MyModel') - for passing model classes to deferred tasks, which may run in an
+    instance that hasn't imported them (see import_class)"""
+    return '%s.%s' % (cls.__module__, cls.__name__)
 
 
 def import_class(input_cls):
@@ -200,10 +1698,37 @@ class BaseRESTHandler(webapp2.RequestHandler):
     # The default number of results to return for a query in case `limit` parameter wasn't provided by the user
     DEFAULT_MAX_QUERY_RESULTS = 1000
 
+    # Query cost limits (None disables a limit): the maximal `limit`, the maximal number of values of a single IN filter, the maximal number
+    # of subqueries a query is split into (IN/!= filters), the maximal total size (in bytes) of a results page and the datastore deadline (in seconds)
+    max_query_limit = None
+    max_in_values = None
+    max_query_fanout = None
+    max_result_bytes = None
+    query_deadline = None
+
+    # Datastore settings: the read policy of the GET queries ('eventual' for eventually-consistent reads), the deadlines (in seconds) of gets
+    # and writes, and the number of retries on transient errors (with a jittered exponential backoff, starting at `retry_backoff` seconds)
+    read_policy = None
+    get_deadline = None
+    write_deadline = None
+    retry_attempts = 0
+    retry_backoff = 0.1
+    # The number of datastore retries of the current request
+    _datastore_retries = 0
+
+    # The settings of the handler's output (see register_rest_model) - None uses the settings registered for each model
+    output_settings = None
+
     # The names of properties that should be excluded from input/output
     DEFAULT_EXCLUDED_INPUT_PROPERTIES = [ 'class_' ] # 'class_' is a PolyModel attribute
     DEFAULT_EXCLUDED_OUTPUT_PROPERTIES = [ ]
 
+    # If set, the next page of a paged query is fetched while the current one is served, and cached for `prefetch_cache_time` seconds
+    prefetch_next_page = False
+    prefetch_cache_time = 30
+    # Whether the current page was prefetched ('hit'/'miss')
+    _prefetch_status = None
+
 
     #
     # Session related methods/properties
@@ -240,6 +1765,12 @@ class BaseRESTHandler(webapp2.RequestHandler):
             # Dispatch the request.
             response = webapp2.RequestHandler.dispatch(self)
 
+            if self._prefetch_status and response is not None:
+                response.headers['X-Prefetch'] = self._prefetch_status
+
+            if self.retry_attempts and response is not None:
+                response.headers['X-Datastore-Retries'] = str(self._datastore_retries)
+
         except:
             raise
         else:
@@ -308,21 +1839,59 @@ class BaseRESTHandler(webapp2.RequestHandler):
 
 
     def get_response(self, status, content):
-        """Returns an HTTP status message with JSON-encoded content (and appropriate HTTP response headers)"""
+        """Returns an HTTP status message with JSON-encoded content (or MessagePack-encoded, according to the Accept header) and
+        appropriate HTTP response headers"""
+
+        content_type = self._get_response_content_type()
 
-        # Create the JSON-encoded response
-        response = webapp2.Response(json.dumps(content, cls=NDBEncoder))
+        if content_type == 'application/json':
+            # Create the JSON-encoded response
+            body = json.dumps(content, cls=NDBEncoder, output_settings=self.output_settings)
+        else:
+            # Create the MessagePack-encoded response (NDB models and properties are encoded exactly as in JSON - str and unicode values are both strings)
+            body = msgpack.packb(content, default=NDBEncoder(output_settings=self.output_settings).default, use_bin_type=False)
+
+        response = webapp2.Response(body)
 
         response.status = status
 
-        response.headers['Content-Type'] = 'application/json'
+        response.headers['Content-Type'] = content_type
         response.headers['Access-Control-Allow-Methods'] = ', '.join(self.permissions.keys())
+        response.headers['Vary'] = 'Accept'
 
         if getattr(self, 'allowed_origin', None):
             response.headers['Access-Control-Allow-Origin'] = self.allowed_origin
 
         return response
 
+    def _get_response_content_type(self):
+        """Returns the content type of the response, according to the Accept header (JSON, unless MessagePack is preferred)"""
+
+        if msgpack is not None and self.request.headers.get('Accept'):
+            content_type = self.request.accept.best_match(['application/json'] + MSGPACK_CONTENT_TYPES)
+            if content_type in MSGPACK_CONTENT_TYPES:
+                return content_type
+
+        return 'application/json'
+
+    def _get_request_data(self):
+        """Parses the request body according to its Content-Type (JSON, or MessagePack). Raises ValueError if the body is invalid."""
+
+        if self.request.content_type in MSGPACK_CONTENT_TYPES:
+            if msgpack is None:
+                raise ValueError('MessagePack input is not supported')
+
+            try:
+                return msgpack.unpackb(self.request.body, raw=False)
+            except Exception as exc:
+                raise ValueError('Invalid MessagePack data - %s' % exc)
+
+        return json.loads(self.request.body)
+
+    def _get_request_format(self):
+        """Returns the name of the request body format (for error messages) - 'MessagePack' or 'JSON'"""
+        return 'MessagePack' if self.request.content_type in MSGPACK_CONTENT_TYPES else 'JSON'
+
     def success(self, content):
         return self.get_response(200, content)
 
@@ -348,20 +1917,28 @@ class BaseRESTHandler(webapp2.RequestHandler):
     #
 
 
+    @webapp2.cached_property
+    def _decoded_ids(self):
+        """The model IDs decoded during the current request (each ID is decoded only once)"""
+        return {}
+
+    def _model_id_to_key(self, model_id):
+        """Returns the model key according to the model_id (without fetching the model); raises an exception if invalid ID"""
+
+        try:
+            return decode_model_id(self.model, model_id, self._decoded_ids)
+        except Exception, exc:
+            # Invalid key name
+            raise RESTException('Invalid model id - %s' % model_id)
+
     def _model_id_to_model(self, model_id):
         """Returns the model according to the model_id; raises an exception if invalid ID / model not found"""
 
         if not model_id:
             return None
 
-        try:
-            if getattr(self.model, 'RESTMeta', None) and getattr(self.model.RESTMeta, 'use_input_id', False):
-                model = ndb.Key(self.model, model_id).get()
-            else:
-                model = ndb.Key(urlsafe=model_id).get()
-            if not model: raise Exception()
-        except Exception, exc:
-            # Invalid key name
+        model = self._call_datastore(self._model_id_to_key(model_id).get, deadline=self.get_deadline)
+        if not model:
             raise RESTException('Invalid model id - %s' % model_id)
 
         return model
@@ -378,23 +1955,52 @@ class BaseRESTHandler(webapp2.RequestHandler):
         return self.request.path_url + '?' + urlencode(params)
 
     def _filter_query(self):
-        """Filters the query results for given property filters (if provided by user)."""
+        """Filters the query results for given property filters and search terms (if provided by user)."""
+        return self._search_query(self._gql_query())
 
-        if not self.request.GET.get('q'):
-            # No query given - return as-is
-            return self.model.query()
+    def _search_query(self, query):
+        """Filters the query results by the `search` terms (if provided by user) - each word must be a prefix of a word of the searchable
+        properties (RESTMeta.search_properties), or only of the `search_fields` properties (if provided)"""
 
-        try:
+        if not self.request.GET.get('search'):
+            return query
+
+        names = list(getattr(getattr(self.model, 'RESTMeta', None), 'search_properties', []))
+        if not names:
+            raise RESTException('The "search" parameter is not supported by this endpoint')
+
+        fields = []
+        if self.request.GET.get('search_fields'):
             # Translate any property names
-            translation_table = get_translation_table(self.model, 'input')
+            fields = translate_property_names(dict((name.strip(), True) for name in self.request.GET.get('search_fields').split(',')), self.model, 'input').keys()
+            if set(fields) - set(names):
+                raise RESTException('Invalid "search_fields" parameter - %s' % self.request.GET.get('search_fields'))
+
+        words = get_search_words(self.request.GET.get('search'))
+        if not words:
+            raise RESTException('Invalid "search" parameter - %s' % self.request.GET.get('search'))
 
-            query = self.request.GET.get('q')
+        index = getattr(self.model, SEARCH_INDEX_NAME)
 
-            for original_name, new_name in translation_table.iteritems():
-                # Replace any references to the new property name with the old (original) one
-                query = re.sub(r'\b%s\s*(<=|>=|=|<|>|!=|(\s+IN\s+))' % new_name, r'%s \1' % original_name, query, flags=re.IGNORECASE)
+        for word in words:
+            word = word[:SEARCH_MAX_PREFIX_LENGTH]
+
+            if len(fields) > 1:
+                query = query.filter(index.IN(['%s:%s' % (name, word) for name in fields]))
+            else:
+                query = query.filter(index == '%s:%s' % (fields[0] if fields else '', word))
+
+        return query
+
+    def _gql_query(self):
+        """Returns the query filtered by the `q` GQL argument (if provided by user)"""
+
+        if not self.request.GET.get('q'):
+            # No query given - return as-is
+            return self.model.query()
 
-            return self.model.gql('WHERE ' + query)
+        try:
+            return build_gql_query(self.model, self.request.GET.get('q'))
         except Exception, exc:
             # Invalid query
             raise RESTException('Invalid query param - "%s"' % self.request.GET.get('q'))
@@ -404,16 +2010,8 @@ class BaseRESTHandler(webapp2.RequestHandler):
         """Fetches the query results for a given limit (if provided by user) and for a specific results page (if given by user).
         Returns a tuple of (results, cursor_for_next_fetch). cursor_for_next_fetch will be None is no more results are available."""
 
-        if not self.request.GET.get('limit'):
-            # No limit given - use default limit
-            limit = BaseRESTHandler.DEFAULT_MAX_QUERY_RESULTS
-        else:
-            try:
-                limit = int(self.request.GET.get('limit'))
-                if limit <= 0: raise ValueError('Limit cannot be zero or less')
-            except ValueError, exc:
-                # Invalid limit value
-                raise RESTException('Invalid "limit" parameter - %s' % self.request.GET.get('limit'))
+        limit = self._get_query_limit()
+        self._check_query_cost(query)
 
         if not self.request.GET.get('cursor'):
             # Fetch results from scratch
@@ -425,16 +2023,163 @@ class BaseRESTHandler(webapp2.RequestHandler):
             except BadValueError, exc:
                 raise RESTException('Invalid "cursor" argument - %s' % self.request.GET.get('cursor'))
 
-        try:
-            (results, cursor, more_available) = query.fetch_page(limit, start_cursor=cursor)
-        except BadRequestError, exc:
-            # This happens when we're using an existing cursor and the other query arguments were messed with
-            raise RESTException('Invalid "cursor" argument - %s' % self.request.GET.get('cursor'))
+        page = None
+
+        if self.prefetch_next_page and cursor:
+            # See if this page was already prefetched by the previous request
+            page = memcache.get(self._get_page_cache_key(query, limit, cursor))
+            self._prefetch_status = 'hit' if page is not None else 'miss'
+            memcache.incr('rest_gae:prefetch:hits' if page is not None else 'rest_gae:prefetch:misses', initial_value=0)
+
+        if page is not None:
+            (results, cursor, more_available) = pickle.loads(page)
+            cursor = Cursor(urlsafe=cursor) if cursor else None
+            self._check_result_bytes(results)
+        else:
+            try:
+                (results, cursor, more_available) = self._call_datastore(self._fetch_page, query, limit, cursor)
+            except BadRequestError, exc:
+                if cursor:
+                    # This happens when we're using an existing cursor and the other query arguments were messed with
+                    raise RESTException('Invalid "cursor" argument - %s' % self.request.GET.get('cursor'))
+                # e.g. a missing index
+                raise RESTException('Invalid query - %s' % exc)
+            except (datastore_errors.Timeout, apiproxy_errors.DeadlineExceededError), exc:
+                raise RESTException('The query took too long - try a smaller "limit" or a simpler query')
+
+        if not more_available:
+            cursor = None
+
+        if self.prefetch_next_page and cursor:
+            # Fetch the next page in a task - so this request doesn't wait for it
+            deferred.defer(prefetch_page, get_class_path(self.model), query.ancestor, query.filters, encode_query_orders(query.orders), limit, cursor.urlsafe(),
+                           self._get_page_cache_key(query, limit, cursor), self.prefetch_cache_time, deadline=self.query_deadline, read_policy=self._get_read_policy())
+
+        return (results, cursor)
+
+
+    def _get_query_limit(self):
+        """Returns the `limit` GET parameter (or the default limit) - it cannot be more than `max_query_limit`"""
+
+        if not self.request.GET.get('limit'):
+            # No limit given - use default limit
+            return min(BaseRESTHandler.DEFAULT_MAX_QUERY_RESULTS, self.max_query_limit or BaseRESTHandler.DEFAULT_MAX_QUERY_RESULTS)
+
+        try:
+            limit = int(self.request.GET.get('limit'))
+            if limit <= 0: raise ValueError('Limit cannot be zero or less')
+        except ValueError, exc:
+            # Invalid limit value
+            raise RESTException('Invalid "limit" parameter - %s' % self.request.GET.get('limit'))
+
+        if self.max_query_limit and limit > self.max_query_limit:
+            raise RESTException('Invalid "limit" parameter - %s (cannot be more than %d)' % (limit, self.max_query_limit))
+
+        return limit
+
+    def _fetch_page(self, query, limit, cursor):
+        """Fetches a page of `query` results - like query.fetch_page (with the `query_deadline` and `read_policy`), but when `max_result_bytes`
+        is set the results are fetched in batches of RESULT_BYTES_BATCH_SIZE, and a page that's too big is rejected as soon as it's exceeded"""
+
+        options = { 'deadline': self.query_deadline, 'read_policy': self._get_read_policy() }
+
+        if not self.max_result_bytes:
+            return query.fetch_page(limit, start_cursor=cursor, **options)
+
+        # The same as fetch_page - the extra result tells whether more results are available
+        iterator = query.iter(limit=limit + 1, start_cursor=cursor, produce_cursors=True, batch_size=min(limit, RESULT_BYTES_BATCH_SIZE), **options)
+        results = []
+        size = 0
+
+        while len(results) < limit and iterator.has_next():
+            result = iterator.next()
+            size += result._to_pb().ByteSize()
+            self._check_result_bytes(size=size)
+            results.append(result)
+
+        try:
+            cursor = iterator.cursor_after()
+        except datastore_errors.BadArgumentError, exc:
+            cursor = None
+
+        return (results, cursor, iterator.probably_has_next())
+
+    def _check_result_bytes(self, results=(), size=0, hint='a smaller "limit"'):
+        """Raises an exception if the total size of `results` (plus `size` bytes) is more than `max_result_bytes`"""
+
+        if self.max_result_bytes and size + sum(result._to_pb().ByteSize() for result in results) > self.max_result_bytes:
+            raise RESTException('The results are too big (more than %d bytes) - try %s' % (self.max_result_bytes, hint))
+
+
+    def _get_read_policy(self):
+        """Returns the datastore read policy of the GET queries (see `read_policy`)"""
+        return ndb.EVENTUAL_CONSISTENCY if self.read_policy == 'eventual' else None
+
+    def _call_datastore(self, func, *args, **kwd):
+        """Calls a datastore function and returns its result - retries up to `retry_attempts` times on transient errors, with a jittered
+        exponential backoff (the number of retries is returned in the X-Datastore-Retries response header)"""
+
+        attempt = 0
+
+        while True:
+            try:
+                return func(*args, **kwd)
+            except TRANSIENT_DATASTORE_ERRORS, exc:
+                if attempt >= self.retry_attempts:
+                    raise
+
+                time_module.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+                attempt += 1
+                self._datastore_retries += 1
+                logging.warning('Retrying a datastore call (retry %d out of %d) - %s' % (attempt, self.retry_attempts, exc))
+
+    def _put_models(self, models):
+        """Saves `models` (see _call_datastore) and returns their keys. When retries are enabled, new models are assigned IDs in advance -
+        so a retried put can't create duplicates."""
+
+        if self.retry_attempts:
+            groups = {}
+            for m in models:
+                if m.key is None or m.key.id() is None:
+                    groups.setdefault(m.key.parent() if m.key else None, []).append(m)
+
+            for (parent, group) in groups.iteritems():
+                (first, last) = group[0].allocate_ids(size=len(group), parent=parent)
+                for (m, id) in zip(group, range(first, last + 1)):
+                    m.key = ndb.Key(m._get_kind(), id, parent=parent)
+
+        return self._call_datastore(ndb.put_multi, models, deadline=self.write_deadline)
+
+    def _check_query_cost(self, query):
+        """Raises an exception if `query` is split into too many subqueries (see max_query_fanout), or has an IN filter with too many
+        values (see max_in_values). ndb normalizes IN/!= filters into a disjunction of the subqueries."""
+
+        if not isinstance(query.filters, ndb.query.DisjunctionNode):
+            return
+
+        subqueries = list(query.filters)
 
-        if not more_available:
-            cursor = None
+        if self.max_query_fanout and len(subqueries) > self.max_query_fanout:
+            raise RESTException('The query is too complex - it has %d subqueries (IN/!= filters), up to %d are allowed' % (len(subqueries), self.max_query_fanout))
 
-        return (results, cursor)
+        if self.max_in_values:
+            # The values of an IN filter are the different values its property is compared to across the subqueries
+            values = {}
+
+            for subquery in subqueries:
+                for node in (subquery if isinstance(subquery, ndb.query.ConjunctionNode) else [subquery]):
+                    if isinstance(node, ndb.query.FilterNode):
+                        (name, opsymbol, value) = node.__getnewargs__()
+                        if opsymbol == '=':
+                            values.setdefault(name, set()).add(repr(value))
+
+            for (name, name_values) in values.iteritems():
+                if len(name_values) > self.max_in_values:
+                    raise RESTException('Too many values for "%s" - %d (up to %d are allowed)' % (name, len(name_values), self.max_in_values))
+
+    def _get_page_cache_key(self, query, limit, cursor):
+        """Returns the memcache key of a query results page - a fingerprint of the query (kind, filters incl. the owner, orders), limit and cursor"""
+        return 'rest_gae:page:' + hashlib.sha1('%r|%d|%s' % (query, limit, cursor.urlsafe())).hexdigest()
 
 
     def _order_query(self, query):
@@ -447,19 +2192,16 @@ class BaseRESTHandler(webapp2.RequestHandler):
         else:
             try:
                 # The order parameter is formatted as 'col1, -col2, col3'
-                orders = [o.strip() for o in self.request.GET.get('order').split(',')]
-                orders = ['+'+o if not o.startswith('-') and not o.startswith('+') else o for o in orders]
-
-                # Translate property names (if it's defined for the current model) - e.g. input 'col1' is actually 'my_col1' in MyModel
-                translated_orders = dict([order.lstrip('-+'), order[0]] for order in orders)
-                translated_orders = translate_property_names(translated_orders, self.model, 'input')
-
-                orders = [-getattr(self.model, order) if direction == '-' else getattr(self.model, order) for order,direction in translated_orders.iteritems()]
-
+                orders = get_query_orders(self.model, self.request.GET.get('order'))
             except AttributeError, exc:
                 # Invalid column name
                 raise RESTException('Invalid "order" parameter - %s' % self.request.GET.get('order'))
 
+        inequality_property = get_inequality_property(query.filters)
+        if inequality_property and not orders:
+            # The first sort order of a query with an inequality filter (including !=) must be on the same property
+            orders.append(datastore_query.PropertyOrder(inequality_property))
+
         # Always use a sort-by-key order at the end - this solves the case where the query uses IN or != operators - since we're using a cursor
         # to fetch results - there is a requirement for this solution in order for the fetch_page to work. See "Query cursors" at
         # https://developers.google.com/appengine/docs/python/ndb/queries
@@ -469,6 +2211,50 @@ class BaseRESTHandler(webapp2.RequestHandler):
         return query.order(*orders)
 
 
+    def _shard_query(self, query):
+        """Limits the query to a single key range according to the `shard=i/n` argument (so `n` clients can read all of the results in parallel,
+        with no overlap), and orders it by key. The range is passed on to the next pages (`shard_range`). Returns None for an empty shard."""
+
+        if self.request.GET.get('order'):
+            raise RESTException('The "order" parameter cannot be used together with "shard"')
+        if get_inequality_property(query.filters):
+            # The datastore allows inequality filters on a single property - the key range is already one
+            raise RESTException('The "shard" parameter cannot be used together with inequality filters (<, <=, >, >=, !=) in "q"')
+
+        if self.request.GET.get('shard_range') is not None:
+            # Continue reading the same key range
+            try:
+                (start, end) = [ndb.Key(urlsafe=str(key)) if key else None for key in self.request.GET.get('shard_range').split(',')]
+            except Exception, exc:
+                raise RESTException('Invalid "shard_range" parameter - %s' % self.request.GET.get('shard_range'))
+
+        else:
+            try:
+                (i, n) = [int(value) for value in self.request.GET.get('shard').split('/')]
+                if not (0 <= i < n <= MAX_QUERY_SHARDS): raise ValueError()
+            except ValueError, exc:
+                raise RESTException('Invalid "shard" parameter - %s (must be formatted as i/n, where 0 <= i < n <= %d)' % (self.request.GET.get('shard'), MAX_QUERY_SHARDS))
+
+            split_points = get_shard_split_points(self.model._get_kind(), n, query.ancestor)
+
+            if not split_points and i > 0:
+                # There are no entities to split - the first shard reads all of them
+                return None
+
+            bounds = [None] + split_points + [None]
+            (start, end) = (bounds[i], bounds[i + 1])
+
+            # Make sure the next pages read the same range (even if the split points change in the meantime)
+            self.request.GET['shard_range'] = '%s,%s' % (start.urlsafe() if start else '', end.urlsafe() if end else '')
+
+        if start:
+            query = query.filter(self.model.key >= start)
+        if end:
+            query = query.filter(self.model.key < end)
+
+        return query.order(self.model.key)
+
+
     def _build_model_from_data(self, data, cls, model=None):
         """Builds a model instance (according to `cls`) from user input and returns it. Updates an existing model instance if given.
         Raises exceptions if input data is invalid."""
@@ -477,26 +2263,29 @@ class BaseRESTHandler(webapp2.RequestHandler):
         data = translate_property_names(data, cls, 'input')
 
         # Transform any raw input data into appropriate NDB properties - write all transformed properties
-        # into another dict (so any other unauthorized properties will be ignored).
+        # into another dict (so any other unauthorized properties will be ignored). The decoder includes only the properties accepted as input.
+        decoder = get_input_decoder(cls)
         input_properties = { }
-        for (name, prop) in cls._properties.iteritems():
-            if name not in data: continue # Input not given by user
+        for (name, value) in data.iteritems():
+            if name not in decoder: continue # Not an input property
+
+            (prop, converter) = decoder[name]
 
-            if prop._repeated:
+            if converter is None:
+                input_properties[name] = value
+            elif prop._repeated:
                 # This property is repeated (i.e. an array of values)
-                input_properties[name] = [self._value_to_property(value, prop) for value in data[name]]
+                input_properties[name] = [converter(self, v) for v in value]
             else:
-                input_properties[name] = self._value_to_property(data[name], prop)
+                input_properties[name] = converter(self, value)
 
         if not model and getattr(cls, 'RESTMeta', None) and getattr(cls.RESTMeta, 'use_input_id', False):
             if 'id' not in data:
                 raise RESTException('id field is required')
+            if isinstance(data['id'], basestring) and data['id'].split('/')[0] in RESERVED_MODEL_IDS:
+                raise RESTException('Invalid id - "%s" is reserved' % data['id'])
             input_properties['id'] = data['id']
 
-        # Filter the input properties
-        included_properties = get_included_properties(cls, 'input')
-        input_properties = dict((k,v) for k,v in input_properties.iteritems() if k in included_properties)
-
         # Set the user owner property to the currently logged-in user (if it's defined for the model class) - note that we're doing this check on the input `cls` parameter
         # and not the self.model class, since we need to support when a model has an inner StructuredProperty, and that model has its own RESTMeta definition.
         if hasattr(cls, 'RESTMeta') and hasattr(cls.RESTMeta, 'user_owner_property'):
@@ -505,6 +2294,10 @@ class BaseRESTHandler(webapp2.RequestHandler):
                 # admin updates another user's model instance - it'll change model ownership from that user to the admin)
                 input_properties[cls.RESTMeta.user_owner_property] = self.user.key
 
+                if cls is self.model and is_owner_ancestor_model(cls):
+                    # Store the new model under its owner's key
+                    input_properties['parent'] = self.user.key
+
         if not model:
             # Create a new model instance
             model = cls(**input_properties)
@@ -516,51 +2309,68 @@ class BaseRESTHandler(webapp2.RequestHandler):
 
     def _value_to_property(self, value, prop):
         """Converts raw data value into an appropriate NDB property"""
-        if isinstance(prop, ndb.KeyProperty):
-            if value is None:
-                return None
+        converter = _get_property_converter(prop)
+        return converter(self, value) if converter else value
+
+
+
+
+def get_blob_download_class(secret):
+    """Returns a BlobDownloadHandlerClass which serves blobs using pre-authorized URLs (see get_signed_blob_url) signed with `secret`"""
+
+    class BlobDownloadHandlerClass(blobstore_handlers.BlobstoreDownloadHandler):
+        """Serves blobs without any session, user or permission handling - the URL itself is the authorization"""
+
+        def get(self, blob_key):
             try:
-                return ndb.Key(urlsafe=value)
-            except ProtocolBufferDecodeError as e:
-                if prop._kind is not None:
-                    model_class = ndb.Model._kind_map.get(prop._kind)
-                    if getattr(model_class, 'RESTMeta', None) and getattr(model_class.RESTMeta, 'use_input_id', False):
-                        return ndb.Key(model_class, value)
-            raise RESTException('invalid key: {}'.format(value) )
-        elif isinstance(prop, ndb.TimeProperty):
-            if dateutil is None:
-                try:
-                    return datetime.strptime(value, "%H:%M:%S").time()
-                except ValueError as e:
-                    raise RESTException("Invalid time. Must be in ISO 8601 format.")
-            else:
-                return dateutil.parser.parse(value).time()
-        elif  isinstance(prop, ndb.DateProperty):
-            if dateutil is None:
-                try:
-                    return datetime.strptime(value, "%Y-%m-%d").date()
-                except ValueError as e:
-                    raise RESTException("Invalid date. Must be in ISO 8601 format.")
-            else:
-                return dateutil.parser.parse(value).date()
-        elif isinstance(prop, ndb.DateTimeProperty):
-            if dateutil is None:
+                expires = int(self.request.GET.get('expires'))
+            except (TypeError, ValueError) as exc:
+                return self.abort(403)
+
+            seconds_left = expires - int(time_module.time())
+            signature = str(self.request.GET.get('signature', ''))
+
+            try:
+                # The rendition (size/crop) is a part of the signed URL
+                rendition = get_rendition_name(self.request.GET.get('size'), _is_rendition_cropped(self.request)) if self.request.GET.get('size') else None
+            except RESTException, exc:
+                return self.abort(403)
+
+            if seconds_left <= 0 or not _compare_strings(signature, _sign_blob_url(secret, blob_key, expires, rendition)):
+                return self.abort(403)
+
+            # The blob's contents never change (a new upload creates a new blob), so it can be cached for as long as the URL is valid
+            self.response.headers['ETag'] = '"%s"' % blob_key
+            self.response.headers['Cache-Control'] = 'public, max-age=%d' % seconds_left
+
+            if self.request.GET.get('size'):
+                # Send a resized version of the image
                 try:
-                    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
-                except ValueError as e:
-                    raise RESTException("Invalid datetime. Must be in ISO 8601 format.")
-            else:
-                return dateutil.parser.parse(value)
-        elif isinstance(prop, ndb.GeoPtProperty):
-            # Convert from string (formatted as '52.37, 4.88') to GeoPt
-            return ndb.GeoPt(value)
-        elif isinstance(prop, ndb.StructuredProperty):
-            # It's a structured property - the input data is a dict - recursively parse it as well
-            return self._build_model_from_data(value, prop._modelclass)
-        else:
-            # Return as-is (no need for further manipulation)
-            return value
+                    return get_blob_rendition_response(self.request, blobstore.BlobKey(blob_key), public=True)
+                except RESTException, exc:
+                    return self.abort(400, str(exc))
+
+            if self.request.headers.get('If-None-Match') == self.response.headers['ETag']:
+                self.response.status = 304
+                return
+
+            self.send_blob(blobstore.BlobKey(blob_key))
+
+
+    return BlobDownloadHandlerClass
+
+
+def _compare_strings(a, b):
+    """Compares two strings in constant time (so the comparison time won't reveal how much of a signature is correct)"""
+
+    if len(a) != len(b):
+        return False
 
+    result = 0
+    for (x, y) in zip(a, b):
+        result |= ord(x) ^ ord(y)
+
+    return result == 0
 
 
 
@@ -570,16 +2380,28 @@ def get_rest_class(ndb_model, base_url, **kwd):
     class RESTHandlerClass(BaseRESTHandler, blobstore_handlers.BlobstoreUploadHandler, blobstore_handlers.BlobstoreDownloadHandler):
 
         model = import_class(ndb_model)
-        # Save the base API URL for the model (used for BlobKeyProperty)
-        if not hasattr(model, 'RESTMeta'):
-            class NewRESTMeta: pass
-            model.RESTMeta = NewRESTMeta
-        model.RESTMeta.base_url = base_url
+        # The settings of this handler's output (also passed to the background exports and views refreshes)
+        output_settings = register_rest_model(model, base_url, **kwd)
+        export_bucket = kwd.get('export_bucket', None)
 
         permissions = { 'OPTIONS': PERMISSION_ANYONE }
         permissions.update(kwd.get('permissions', {}))
         allow_http_method_override = kwd.get('allow_http_method_override', True)
         allowed_origin = kwd.get('allowed_origin', None)
+        prefetch_next_page = kwd.get('prefetch_next_page', False)
+        prefetch_cache_time = kwd.get('prefetch_cache_time', BaseRESTHandler.prefetch_cache_time)
+        max_count = kwd.get('max_count', 10000)
+        max_export_results = kwd.get('max_export_results', 10000)
+        max_query_limit = kwd.get('max_query_limit', BaseRESTHandler.max_query_limit)
+        max_in_values = kwd.get('max_in_values', BaseRESTHandler.max_in_values)
+        max_query_fanout = kwd.get('max_query_fanout', BaseRESTHandler.max_query_fanout)
+        max_result_bytes = kwd.get('max_result_bytes', BaseRESTHandler.max_result_bytes)
+        query_deadline = kwd.get('query_deadline', BaseRESTHandler.query_deadline)
+        read_policy = kwd.get('read_policy', BaseRESTHandler.read_policy)
+        get_deadline = kwd.get('get_deadline', BaseRESTHandler.get_deadline)
+        write_deadline = kwd.get('write_deadline', BaseRESTHandler.write_deadline)
+        retry_attempts = kwd.get('retry_attempts', BaseRESTHandler.retry_attempts)
+        retry_backoff = kwd.get('retry_backoff', BaseRESTHandler.retry_backoff)
 
         # Wrapping in a list so the functions won't be turned into bound methods
         after_get_callback = [kwd.get('after_get_callback', None)]
@@ -596,6 +2418,39 @@ def get_rest_class(ndb_model, base_url, **kwd):
                 raise ValueError('Must define a RESTMeta.user_owner_property for the model class %s if user-owner permission is used' % (model))
             if not hasattr(model, model.RESTMeta.user_owner_property):
                 raise ValueError('The user_owner_property "%s" (defined in RESTMeta.user_owner_property) does not exist in the given model %s' % (model.RESTMeta.user_owner_property, model))
+        if is_owner_ancestor_model(model) and getattr(model.RESTMeta, 'use_input_id', False):
+            raise ValueError('RESTMeta.user_owner_ancestor cannot be used together with RESTMeta.use_input_id (the model %s)' % (model))
+        if read_policy not in [None, 'strong', 'eventual']:
+            raise ValueError('Invalid "read_policy" - %s (must be "strong" or "eventual")' % read_policy)
+        if not isinstance(retry_attempts, (int, long)) or retry_attempts < 0:
+            raise ValueError('"retry_attempts" must be a non-negative integer')
+        if getattr(model.RESTMeta, 'views', None):
+            if permissions.get('GET') == PERMISSION_OWNER_USER:
+                raise ValueError('RESTMeta.views cannot be used with a PERMISSION_OWNER_USER GET permission (the views are shared by all users) in the given model %s' % (model))
+            for (name, view) in model.RESTMeta.views.iteritems():
+                try:
+                    build_view_query(model, view)
+                except Exception, exc:
+                    raise ValueError('Invalid view "%s" (defined in RESTMeta.views) in the given model %s - %s' % (name, model, exc))
+        if len(getattr(model.RESTMeta, 'sharded_counters', [])) > MAX_SHARDED_COUNTERS:
+            raise ValueError('Up to %d sharded counters (RESTMeta.sharded_counters) can be defined in the given model %s' % (MAX_SHARDED_COUNTERS, model))
+        for name in getattr(model.RESTMeta, 'sharded_counters', []):
+            if not isinstance(model._properties.get(name), ndb.IntegerProperty) or model._properties[name]._repeated:
+                raise ValueError('The sharded counter "%s" (defined in RESTMeta.sharded_counters) must be an IntegerProperty in the given model %s' % (name, model))
+        if getattr(model.RESTMeta, 'updated_property', None):
+            updated_property = model._properties.get(model.RESTMeta.updated_property)
+            if not isinstance(updated_property, ndb.DateTimeProperty) or not updated_property._auto_now:
+                raise ValueError('The updated_property "%s" (defined in RESTMeta.updated_property) must be a DateTimeProperty with auto_now=True in the given model %s' % (model.RESTMeta.updated_property, model))
+
+        # Background exports pickle the after_get_callback into their task (see export_to_file) - a callback which can't be pickled (e.g. a
+        # lambda) disables them, instead of failing each background export
+        background_export_error = None
+        if after_get_callback[0] and cloudstorage is not None:
+            try:
+                pickle.dumps(after_get_callback[0], pickle.HIGHEST_PROTOCOL)
+            except Exception, exc:
+                background_export_error = 'Background exports are not supported by this endpoint (its after_get_callback must be a module-level function)'
+                logging.warning('Background exports of %s are disabled - the after_get_callback %r cannot be pickled (%s)' % (model, after_get_callback[0], exc))
 
         def __init__(self, request, response):
             self.initialize(request, response)
@@ -611,12 +2466,18 @@ def get_rest_class(ndb_model, base_url, **kwd):
             self.after_delete_callback = self.after_delete_callback[0]
 
 
-        def rest_method_wrapper(func):
-            """Wraps GET/POST/PUT/DELETE methods and adds standard functionality"""
+        def rest_method_wrapper(func, method_name=None):
+            """Wraps GET/POST/PUT/DELETE methods and adds standard functionality. `method_name` is the HTTP method whose permission
+            applies (the name of the function by default)"""
+
+            method_name = (method_name or func.func_name).upper()
+
+            def inner_f(self, model_id=None, property_name=None, **route_kwargs):
+                if self.request.method == 'OPTIONS' and method_name != 'OPTIONS':
+                    # An endpoint with its own route (e.g. /_export) - answer like the main route
+                    return self.options()
 
-            def inner_f(self, model_id, property_name=None):
                 # See if method type is supported
-                method_name = func.func_name.upper()
                 if method_name not in self.permissions:
                     return self.method_not_allowed()
 
@@ -634,7 +2495,13 @@ def get_rest_class(ndb_model, base_url, **kwd):
                 try:
                     # Call original method
                     if model_id:
-                        model = self._model_id_to_model(model_id.lstrip('/')) # Get rid of '/' at the beginning
+                        model_id = model_id.lstrip('/') # Get rid of '/' at the beginning
+
+                        if (permission == PERMISSION_OWNER_USER) and is_owner_ancestor_model(self.model) and (self._model_id_to_key(model_id).parent() != self.user.key):
+                            # The owner is part of the key - no need to fetch the model in order to verify it
+                            return self.permission_denied()
+
+                        model = self._model_id_to_model(model_id)
 
                         if (permission == PERMISSION_OWNER_USER) and (self.get_model_owner(model) != self.user.key):
                             # The currently logged-in user is not the owner of the model
@@ -684,10 +2551,32 @@ def get_rest_class(ndb_model, base_url, **kwd):
 
                 if self.permissions['GET'] == PERMISSION_OWNER_USER:
                     # Return only models owned by currently logged-in user
-                    query = query.filter(getattr(self.model, self.user_owner_property) == self.user.key)
+                    query = self._filter_query_by_owner(query)
 
-                query = self._order_query(query) # Order the results
-                (results, cursor) = self._fetch_query(query) # Fetch them (with a limit / specific page, if provided)
+                if self.request.GET.get('since') is not None:
+                    # Return only the changes since the previous sync
+                    return self._get_changes(query)
+
+                if self.request.GET.get('count', '').lower() in ['1', 'true']:
+                    # Return only the number of results
+                    return self._count_query(query)
+
+                if self.request.GET.get('near') or self.request.GET.get('bbox'):
+                    # Return only the results in a given area
+                    return self._geo_query(query)
+
+                if self.request.GET.get('shard'):
+                    query = self._shard_query(query) # Read only a single key range (ordered by key)
+                else:
+                    query = self._order_query(query) # Order the results
+
+                if query is not None:
+                    (results, cursor) = self._fetch_query(query) # Fetch them (with a limit / specific page, if provided)
+                else:
+                    # An empty shard
+                    (results, cursor) = ([], None)
+
+                self._merge_counters(results)
 
                 if self.after_get_callback:
                     # Additional processing required
@@ -712,6 +2601,10 @@ def get_rest_class(ndb_model, base_url, **kwd):
                     if not isinstance(blob_key, blobstore.BlobKey):
                         raise RESTException('"%s" is not a BlobKeyProperty' % property_name)
 
+                    if self.request.GET.get('size'):
+                        # Send a resized version of the image (only the allowed renditions, if any are configured)
+                        return get_blob_rendition_response(self.request, blob_key, allowed_renditions=self.output_settings['blob_rendition_sizes'])
+
                     # Send the blob contents
                     self.send_blob(blob_key)
 
@@ -721,6 +2614,8 @@ def get_rest_class(ndb_model, base_url, **kwd):
 
                 # Return a single item (query by ID)
 
+                self._merge_counters([model])
+
                 if self.after_get_callback:
                     # Additional processing required
                     model = self.after_get_callback(model)
@@ -728,6 +2623,480 @@ def get_rest_class(ndb_model, base_url, **kwd):
                 return model
 
 
+        def _get_changes(self, query):
+            """Returns the models changed since the `since` sync token (ordered by RESTMeta.updated_property), and the IDs of the models
+            deleted since then (with the first page). The last page includes the token for the next sync."""
+
+            updated_property = getattr(self.model.RESTMeta, 'updated_property', None)
+
+            if not updated_property:
+                raise RESTException('The "since" parameter is not supported by this endpoint')
+            if self.request.GET.get('order') or self.request.GET.get('shard'):
+                raise RESTException('The "since" parameter cannot be used together with "order" or "shard"')
+
+            try:
+                # An empty token (or "0") is used for the initial sync
+                since = _sync_token_to_datetime(self.request.GET.get('since')) if self.request.GET.get('since') not in ['', '0'] else None
+                # The time the sync has started at (carried through the next pages), which is used for the next sync token
+                sync_start = _sync_token_to_datetime(self.request.GET.get('sync_start')) if self.request.GET.get('sync_start') else datetime.now()
+            except (ValueError, OverflowError), exc:
+                raise RESTException('Invalid "since" parameter - %s' % self.request.GET.get('since'))
+
+            if since and since < datetime.now() - timedelta(seconds=get_tombstone_horizon(self.model)):
+                # The tombstones of that period may have already been deleted - the client must sync from scratch
+                return { 'reset': True }
+
+            deleted = []
+
+            if since and not self.request.GET.get('cursor'):
+                # Return the deletions with the first page
+                tombstones = RESTTombstone.query(RESTTombstone.model_kind == self.model._get_kind(), RESTTombstone.deleted > since)
+
+                if self.permissions['GET'] == PERMISSION_OWNER_USER:
+                    tombstones = tombstones.filter(RESTTombstone.owner == self.user.key)
+
+                deleted = [tombstone.model_id for tombstone in tombstones.fetch(MAX_SYNC_TOMBSTONES + 1)]
+
+                if len(deleted) > MAX_SYNC_TOMBSTONES:
+                    # Too many deletions - it's cheaper to sync from scratch
+                    return { 'reset': True }
+
+            prop = getattr(self.model, updated_property)
+            if since:
+                query = query.filter(prop > since)
+
+            self.request.GET['sync_start'] = _datetime_to_sync_token(sync_start)
+            (results, cursor) = self._fetch_query(query.order(prop, self.model.key))
+            self._merge_counters(results)
+
+            if self.after_get_callback:
+                # Additional processing required
+                results = self.after_get_callback(results)
+
+            return {
+                'results': results,
+                'deleted': deleted,
+                'next_results_url': self._build_next_query_url(cursor),
+                # The token for the next sync (only when there are no more pages)
+                'sync_token': _datetime_to_sync_token(sync_start - timedelta(seconds=SYNC_TOKEN_OVERLAP)) if not cursor else None
+                }
+
+
+        def watch(self, model, property_name=None):
+            """GET /_watch endpoint - waits (up to `timeout` seconds) until the models change after the `since` generation, and returns the changes"""
+
+            if self.request.method != 'GET':
+                return self.method_not_allowed()
+
+            kind = self.model._get_kind()
+
+            if not self.request.GET.get('since'):
+                # Return the current generation (to be used with the next request)
+                return { 'generation': get_change_generation(kind), 'changes': [] }
+
+            try:
+                since = int(self.request.GET.get('since'))
+                timeout = min(float(self.request.GET.get('timeout', WATCH_DEFAULT_TIMEOUT)), WATCH_MAX_TIMEOUT)
+            except ValueError, exc:
+                raise RESTException('Invalid "since"/"timeout" parameter')
+
+            deadline = time_module.time() + timeout
+            generation = get_change_generation(kind)
+
+            while generation == since and time_module.time() < deadline:
+                # Nothing changed yet - idle watchers only cost a memcache check every WATCH_POLL_INTERVAL
+                time_module.sleep(WATCH_POLL_INTERVAL)
+                generation = get_change_generation(kind)
+
+            if generation == since:
+                return { 'generation': generation, 'changes': [] }
+
+            records = memcache.get_multi(['%s:%d' % (kind, g) for g in range(since + 1, generation + 1)], key_prefix='rest_gae:changes:') if since < generation <= since + WATCH_MAX_CHANGES else {}
+
+            if len(records) != generation - since:
+                # The generation was reset (memcache eviction), or some of the changes aren't available anymore - the client should reload
+                return { 'generation': generation, 'changes': [], 'reset': True }
+
+            owner = self.user.key if self.permissions['GET'] == PERMISSION_OWNER_USER else None
+            operations = {}
+
+            for g in range(since + 1, generation + 1):
+                for (model_id, operation, model_owner) in records['%s:%d' % (kind, g)]:
+                    if owner is None or model_owner == owner:
+                        # Keep only the last operation of each model
+                        operations.pop(model_id, None)
+                        operations[model_id] = operation
+
+            result = {
+                'generation': generation,
+                'changes': [{ 'id': model_id, 'operation': operation } for (model_id, operation) in operations.iteritems()]
+                }
+
+            if self.request.GET.get('include_models', '').lower() in ['1', 'true']:
+                # Return the changed models themselves as well
+                model_ids = [model_id for (model_id, operation) in operations.iteritems() if operation != 'deleted']
+                result['results'] = [m for m in ndb.get_multi([self._model_id_to_key(model_id) for model_id in model_ids]) if m]
+
+                if self.after_get_callback:
+                    # Additional processing required
+                    result['results'] = self.after_get_callback(result['results'])
+
+            return result
+
+        watch = rest_method_wrapper(watch, 'GET')
+
+
+        def _record_changes(self, models, operation):
+            """Records the changes of `models` for the watch requests (see record_changes), and schedules a refresh of the materialized views"""
+
+            has_owner = hasattr(self.model.RESTMeta, 'user_owner_property')
+            record_changes(self.model._get_kind(), [(encode_model_id(m.key), operation, self.get_model_owner(m) if has_owner else None) for m in models])
+
+            if getattr(self.model.RESTMeta, 'views', None):
+                schedule_views_refresh(self.model)
+
+
+        def view(self, model, property_name=None):
+            """GET /_views/<name> endpoint - returns a materialized view (see RESTMeta.views), as stored when the models were last changed (the
+            counter totals and `after_get_callback` are applied on each request, as in the GET endpoint)"""
+
+            if self.request.method != 'GET':
+                return self.method_not_allowed()
+
+            name = self.request.route_kwargs.get('view_name')
+            if name not in getattr(self.model.RESTMeta, 'views', {}):
+                raise RESTException('Invalid view name - %s' % name)
+
+            view_id = '%s:%s' % (self.model._get_kind(), name)
+            results = memcache.get('rest_gae:view:%s' % view_id)
+
+            if results is None:
+                stored_view = RESTMaterializedView.get_by_id(view_id)
+
+                if stored_view:
+                    results = stored_view.results
+                    memcache.set('rest_gae:view:%s' % view_id, results, time=VIEW_CACHE_TIME)
+                else:
+                    # The view wasn't computed yet
+                    results = refresh_views(self.model, [name])[name]
+
+            self._merge_counters(results)
+
+            if self.after_get_callback:
+                results = self.after_get_callback(results)
+
+            return {
+                'results': results,
+                'next_results_url': None
+                }
+
+        view = rest_method_wrapper(view, 'GET')
+
+
+        def _geo_query(self, query):
+            """Returns the results of `query` within `radius` meters of `near` (sorted by distance), or within `bbox` - using the geohash index
+            (see RESTMeta.geo_index_property): the covering geohash cells are queried in parallel, and the results are filtered exactly"""
+
+            index_name = get_geo_index_name(self.model)
+
+            if not index_name:
+                raise RESTException('The "near"/"bbox" parameters are not supported by this endpoint')
+            if self.request.GET.get('order') or self.request.GET.get('shard') or self.request.GET.get('cursor'):
+                raise RESTException('The "near"/"bbox" parameters cannot be used together with "order", "shard" or "cursor"')
+
+            try:
+                if self.request.GET.get('near'):
+                    (lat, lng) = [float(value) for value in self.request.GET.get('near').split(',')]
+                    radius = float(self.request.GET.get('radius', 1000))
+                    if not (-90 <= lat <= 90 and -180 <= lng <= 180 and radius > 0): raise ValueError()
+
+                    # The bounding box of the circle
+                    delta_lat = math.degrees(radius / EARTH_RADIUS)
+                    delta_lng = math.degrees(radius / (EARTH_RADIUS * max(math.cos(math.radians(lat)), 0.01)))
+                    (south, north) = (max(lat - delta_lat, -90.0), min(lat + delta_lat, 90.0))
+                    (west, east) = ((lng - delta_lng + 180) % 360 - 180, (lng + delta_lng + 180) % 360 - 180) if delta_lng < 180 else (-180.0, 180.0)
+                else:
+                    (south, west, north, east) = [float(value) for value in self.request.GET.get('bbox').split(',')]
+                    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180): raise ValueError()
+            except ValueError, exc:
+                raise RESTException('Invalid "near"/"radius"/"bbox" parameters (must be formatted as near=LAT,LNG&radius=METERS or bbox=SOUTH,WEST,NORTH,EAST)')
+
+            limit = self._get_query_limit()
+            self._check_query_cost(query)
+
+            geo_property = self.model.RESTMeta.geo_index_property
+
+            # Query all of the covering cells in parallel
+            futures = [query.filter(getattr(self.model, index_name) == prefix).fetch_async(MAX_GEO_CELL_RESULTS + 1, deadline=self.query_deadline, read_policy=self._get_read_policy())
+                       for prefix in get_geohash_prefixes(south, west, north, east)]
+
+            results = {}
+            size = 0
+
+            try:
+                for future in futures:
+                    cell_results = future.get_result()
+
+                    if len(cell_results) > MAX_GEO_CELL_RESULTS:
+                        raise RESTException('Too many models in the area (more than %d in a single geohash cell) - try a smaller "radius"/"bbox" or a narrower "q"' % MAX_GEO_CELL_RESULTS)
+
+                    # All of the fetched models count towards max_result_bytes (not only the returned ones)
+                    size += sum(result._to_pb().ByteSize() for result in cell_results) if self.max_result_bytes else 0
+                    self._check_result_bytes(size=size, hint='a smaller "radius"/"bbox"')
+
+                    for result in cell_results:
+                        results[result.key] = result
+            except (datastore_errors.Timeout, apiproxy_errors.DeadlineExceededError), exc:
+                raise RESTException('The query took too long - try a smaller "radius"/"bbox" or a simpler query')
+
+            def in_bbox(location):
+                in_lng = (west <= location.lon <= east) if west <= east else (location.lon >= west or location.lon <= east)
+                return south <= location.lat <= north and in_lng
+
+            if self.request.GET.get('near'):
+                # Filter (and sort) the results by their exact distance
+                distances = {}
+                for (key, result) in results.iteritems():
+                    location = getattr(result, geo_property)
+                    if location:
+                        distances[key] = get_distance(lat, lng, location.lat, location.lon)
+
+                results = sorted([results[key] for key in distances if distances[key] <= radius], key=lambda result: distances[result.key])
+            else:
+                results = [result for result in results.itervalues() if getattr(result, geo_property) and in_bbox(getattr(result, geo_property))]
+
+            results = results[:limit]
+            self._merge_counters(results)
+
+            if self.after_get_callback:
+                # Additional processing required
+                results = self.after_get_callback(results)
+
+            return {
+                'results': results,
+                'next_results_url': None
+                }
+
+
+        def _count_query(self, query):
+            """Returns the number of results of `query` - from the maintained counters (RESTMeta.maintain_count) for unfiltered queries,
+            or using a keys-only count (up to `max_count` results) otherwise"""
+
+            owner = self.user.key if self.permissions['GET'] == PERMISSION_OWNER_USER else None
+            # The counters only count all of the models (or all of the models of an owner) - any other filter (q, search etc.) needs a real count
+            unfiltered = query.filters is None or (owner is not None and not is_owner_ancestor_model(self.model) and query.filters == (getattr(self.model, self.user_owner_property) == owner))
+
+            if getattr(self.model.RESTMeta, 'maintain_count', False) and unfiltered:
+                counter_name = self._get_count_counter_name(owner)
+                return { 'count': get_counters([counter_name])[counter_name], 'capped': False }
+
+            self._check_query_cost(query)
+
+            try:
+                count = query.count(limit=self.max_count, deadline=self.query_deadline, read_policy=self._get_read_policy())
+            except (datastore_errors.Timeout, apiproxy_errors.DeadlineExceededError), exc:
+                raise RESTException('The query took too long - try a simpler query')
+
+            return { 'count': count, 'capped': count >= self.max_count }
+
+
+        def _get_count_counter_name(self, owner=None):
+            """Returns the name of the counter of all of the models (or only the models of `owner`) - see RESTMeta.maintain_count"""
+            return get_count_counter_name(self.model._get_kind(), owner)
+
+
+        def _update_counts(self, models, delta):
+            """Updates the maintained counters (RESTMeta.maintain_count) after creating/deleting `models` (`delta` is 1 or -1)"""
+
+            if not getattr(self.model.RESTMeta, 'maintain_count', False) or not models:
+                return
+
+            deltas = { self._get_count_counter_name(): delta * len(models) }
+
+            if hasattr(self.model.RESTMeta, 'user_owner_property'):
+                # Count the models of each owner as well
+                for m in models:
+                    owner = self.get_model_owner(m)
+                    if owner:
+                        name = self._get_count_counter_name(owner)
+                        deltas[name] = deltas.get(name, 0) + delta
+
+            increment_counters(deltas)
+
+
+        def aggregate(self, model, property_name=None):
+            """GET /_aggregate endpoint - returns the sum/avg/min/max/count of a property over the model instances the user is allowed to see
+            (optionally grouped by another property). The results are cached until the models are changed."""
+
+            if self.request.method != 'GET':
+                return self.method_not_allowed()
+
+            operation = self.request.GET.get('op')
+            if operation not in AGGREGATE_OPERATIONS:
+                raise RESTException('Invalid "op" parameter - %s (must be one of: %s)' % (operation, ', '.join(AGGREGATE_OPERATIONS)))
+
+            # Translate the property names (e.g. input 'price' is actually 'my_price' in MyModel)
+            (field, group_by) = [self._get_aggregate_property(name, self.request.GET.get(name)) for name in ['field', 'group_by']]
+
+            if not field and operation != 'count':
+                raise RESTException('The "field" parameter is required for the "%s" operation' % operation)
+            if field and operation in ['sum', 'avg'] and not isinstance(self.model._properties[field], (ndb.IntegerProperty, ndb.FloatProperty)):
+                raise RESTException('"%s" is not a numeric property' % self.request.GET.get('field'))
+
+            query = self._filter_query()
+
+            if self.permissions['GET'] == PERMISSION_OWNER_USER:
+                # Aggregate only models owned by currently logged-in user
+                query = self._filter_query_by_owner(query)
+
+            self._check_query_cost(query)
+
+            # The cached results are keyed by the model's change generation (see record_changes), so they're recomputed after each change
+            cache_key = 'rest_gae:aggregate:' + hashlib.sha1('%d|%s|%s|%s|%r' % (get_change_generation(self.model._get_kind()), operation, field, group_by, query)).hexdigest()
+            result = memcache.get(cache_key)
+
+            if result is None:
+                try:
+                    value = aggregate_query(query, operation, field, group_by, max_results=self.max_count, deadline=self.query_deadline, read_policy=self._get_read_policy())
+                except BadRequestError, exc:
+                    # e.g. an equality filter on a projected property, or a missing index
+                    raise RESTException('Invalid aggregation query - %s' % exc)
+                except (datastore_errors.Timeout, apiproxy_errors.DeadlineExceededError), exc:
+                    raise RESTException('The query took too long - try a simpler query')
+
+                result = { 'op': operation, 'field': self.request.GET.get('field'), 'group_by': self.request.GET.get('group_by') }
+
+                if group_by:
+                    result['results'] = [{ 'group': group, 'value': group_value } for (group, group_value) in value.iteritems()]
+                else:
+                    result['value'] = value
+
+                memcache.set(cache_key, result, time=AGGREGATE_CACHE_TIME)
+
+            return result
+
+        aggregate = rest_method_wrapper(aggregate, 'GET')
+
+
+        def _get_aggregate_property(self, argument, name):
+            """Returns the original name of an aggregated property (the `argument` GET parameter) - it must be an indexed output property"""
+
+            if not name:
+                return None
+
+            original_name = translate_property_names({ name: True }, self.model, 'input').keys()[0]
+            prop = self.model._properties.get(original_name)
+
+            if not prop or original_name not in get_included_properties(self.model, 'output') or not prop._indexed:
+                raise RESTException('Invalid "%s" parameter - %s (must be an indexed property)' % (argument, name))
+            if original_name in getattr(self.model.RESTMeta, 'sharded_counters', []):
+                # The stored value is only the counter's initial value - its increments are kept in the counter shards
+                raise RESTException('Invalid "%s" parameter - %s (sharded counters cannot be aggregated)' % (argument, name))
+
+            return original_name
+
+
+        def export(self, model, property_name=None):
+            """GET /_export endpoint - returns all of the model instances the user is allowed to see (as NDJSON or CSV), or exports them to a file
+            in the background (if asked to, or if there are more than `max_export_results` of them)"""
+
+            if self.request.method != 'GET':
+                return self.method_not_allowed()
+
+            if self.request.GET.get('export_id'):
+                return self._get_background_export(self.request.GET.get('export_id'))
+
+            format = self.request.GET.get('format', 'ndjson')
+            if format not in EXPORT_CONTENT_TYPES:
+                raise RESTException('Invalid "format" parameter - %s (must be one of: %s)' % (format, ', '.join(sorted(EXPORT_CONTENT_TYPES))))
+
+            query = self._filter_query()
+
+            if self.permissions['GET'] == PERMISSION_OWNER_USER:
+                # Export only models owned by currently logged-in user
+                query = self._filter_query_by_owner(query)
+
+            self._check_query_cost(query)
+
+            # The export is fetched in batches using cursors - which requires a sort-by-key order when `q` uses IN or != (see _order_query)
+            query = self._order_query(query)
+
+            if self.request.GET.get('background', '').lower() in ['1', 'true']:
+                return self._start_background_export(query, format)
+
+            if self.max_export_results is not None:
+                # The response isn't streamed (App Engine buffers all of it, up to 32MB) - so bigger exports are written to a file instead
+                try:
+                    count = query.count(limit=self.max_export_results + 1, deadline=self.query_deadline, read_policy=self._get_read_policy())
+                except (datastore_errors.Timeout, apiproxy_errors.DeadlineExceededError), exc:
+                    raise RESTException('The query took too long - try a simpler query')
+
+                if count > self.max_export_results:
+                    if cloudstorage is None:
+                        raise RESTException('Too many models to export in a single request (more than %d) - try a narrower "q"' % self.max_export_results)
+                    return self._start_background_export(query, format)
+
+            response = webapp2.Response(app_iter=iter_export(self.model, query, format, self.after_get_callback, self.output_settings,
+                                                                  deadline=self.query_deadline, read_policy=self._get_read_policy()))
+            response.headers['Content-Type'] = EXPORT_CONTENT_TYPES[format]
+            response.headers['Content-Disposition'] = 'attachment; filename="%s.%s"' % (self.model._get_kind(), format)
+
+            if getattr(self, 'allowed_origin', None):
+                response.headers['Access-Control-Allow-Origin'] = self.allowed_origin
+
+            return response
+
+        export = rest_method_wrapper(export, 'GET')
+
+
+        def _start_background_export(self, query, format):
+            """Starts exporting the results of `query` to a GCS file (see export_to_file) and returns the export ID"""
+
+            if cloudstorage is None:
+                raise RESTException('Background exports are not supported (the GCS client library is missing)')
+            if self.background_export_error:
+                raise RESTException(self.background_export_error)
+
+            export_id = os.urandom(16).encode('hex')
+            filename = '/%s/rest_gae_exports/%s-%s.%s' % (self.export_bucket or app_identity.get_default_gcs_bucket_name(), self.model._get_kind(), export_id, format)
+
+            memcache.set('rest_gae:export:%s' % export_id, {
+                'filename': filename,
+                'format': format,
+                'user': self.user.key.urlsafe() if self.user else None,
+                'finished': False
+                }, time=EXPORT_STATUS_CACHE_TIME)
+
+            deferred.defer(export_to_file, self.model, self.output_settings, query.filters, query.ancestor, format, filename, export_id, self.after_get_callback,
+                           encode_query_orders(query.orders))
+
+            return self.get_response(202, {
+                'export_id': export_id,
+                'status_url': self.request.path_url + '?' + urlencode({ 'export_id': export_id })
+                })
+
+
+        def _get_background_export(self, export_id):
+            """Returns the status of a background export, or the exported file once it's finished"""
+
+            status = get_export_status(export_id)
+
+            if not status:
+                raise RESTException('Invalid export_id - %s' % export_id)
+            if status['user'] != (self.user.key.urlsafe() if self.user else None):
+                # Only the user who started the export can download it
+                return self.permission_denied()
+
+            if not status['finished']:
+                return { 'finished': False }
+
+            self.response.headers['Content-Type'] = EXPORT_CONTENT_TYPES[status['format']]
+            self.send_blob(blobstore.create_gs_key('/gs' + status['filename']), save_as='%s.%s' % (self.model._get_kind(), status['format']))
+
+            # Make sure we don't return a value (i.e. not write to self.response) - so self.send_blob will work properly
+            return NoResponseResult()
+
+
         @rest_method_wrapper
         def post(self, model, property_name=None):
             """POST endpoint - adds a new model instance"""
@@ -758,11 +3127,12 @@ def get_rest_class(ndb_model, base_url, **kwd):
 
                 if getattr(model, property_name):
                     # The property already has a previous value - delete the older blob
-                    blobstore.delete(getattr(model, property_name))
+                    delete_blobs([getattr(model, property_name)])
 
                 # Set the blob reference
                 setattr(model, property_name, blob_info.key())
-                model.put()
+                self._put_models([model])
+                self._record_changes([model], 'updated')
 
                 # Everything was OK
                 return { 'status': True }
@@ -770,10 +3140,10 @@ def get_rest_class(ndb_model, base_url, **kwd):
 
 
             try:
-                # Parse POST data as JSON
-                json_data = json.loads(self.request.body)
+                # Parse POST data (JSON or MessagePack)
+                json_data = self._get_request_data()
             except ValueError as exc:
-                raise RESTException('Invalid JSON POST data')
+                raise RESTException('Invalid %s POST data' % self._get_request_format())
 
             if not isinstance(json_data, list):
                 json_data = [json_data]
@@ -787,13 +3157,15 @@ def get_rest_class(ndb_model, base_url, **kwd):
                     models.append(model)
 
                 except Exception as exc:
-                    raise RESTException('Invalid JSON POST data - %s' % exc)
+                    raise RESTException('Invalid %s POST data - %s' % (self._get_request_format(), exc))
 
             if self.before_post_callback:
                 models = self.before_post_callback(models, json_data)
 
             # Commit all models in a transaction
-            created_keys = ndb.put_multi(models)
+            created_keys = self._put_models(models)
+            self._record_changes(models, 'created')
+            self._update_counts(models, 1)
 
             if self.after_post_callback:
                 models = self.after_post_callback(created_keys, models)
@@ -806,14 +3178,28 @@ def get_rest_class(ndb_model, base_url, **kwd):
         def put(self, model, property_name=None):
             """PUT endpoint - updates an existing model instance"""
             models = []
+            # The counter increments of each model (see RESTMeta.sharded_counters) - applied together with the model's write
+            increments = {}
 
             try:
-                # Parse PUT data as JSON
-                json_data = json.loads(self.request.body)
+                # Parse PUT data (JSON or MessagePack)
+                json_data = self._get_request_data()
             except ValueError as exc:
-                raise RESTException('Invalid JSON PUT data')
+                raise RESTException('Invalid %s PUT data' % self._get_request_format())
 
             if model:
+                if isinstance(json_data, dict) and '$inc' in json_data:
+                    # Increment the counters (see RESTMeta.sharded_counters)
+                    increments[model.key] = self._get_counter_deltas(model, json_data.pop('$inc'))
+
+                    if (not json_data and not getattr(self.model.RESTMeta, 'updated_property', None) and
+                        not self.before_put_callback and not self.after_put_callback):
+                        # Only counters were incremented - no need to rewrite the model (unless the PUT callbacks should see it)
+                        increment_counters(increments[model.key])
+                        self._record_changes([model], 'updated')
+                        self._merge_counters([model])
+                        return [model]
+
                 # Update just one model
                 model = self._build_model_from_data(json_data, self.model, model)
                 json_data = [json_data]
@@ -822,7 +3208,7 @@ def get_rest_class(ndb_model, base_url, **kwd):
                 # Update several models at once
 
                 if not isinstance(json_data, list):
-                    raise RESTException('Invalid JSON PUT data')
+                    raise RESTException('Invalid %s PUT data' % self._get_request_format())
 
                 for model_to_update in json_data:
 
@@ -832,14 +3218,19 @@ def get_rest_class(ndb_model, base_url, **kwd):
                         raise RESTException('Missing "id" argument for model')
 
                     model = self._model_id_to_model(model_id)
+                    if '$inc' in model_to_update:
+                        increments[model.key] = self._get_counter_deltas(model, model_to_update.pop('$inc'))
                     model = self._build_model_from_data(model_to_update, self.model, model)
                     models.append(model)
 
             if self.before_put_callback:
                 models = self.before_put_callback(models, json_data)
 
-            # Commit all models in a transaction
-            updated_keys = ndb.put_multi(models)
+            # Commit all models (and their counter increments)
+            updated_keys = self._put_models_with_increments(models, increments) if increments else self._put_models(models)
+            self._record_changes(models, 'updated')
+
+            self._merge_counters(models)
 
             if self.after_put_callback:
                 models = self.after_put_callback(updated_keys, models)
@@ -847,13 +3238,76 @@ def get_rest_class(ndb_model, base_url, **kwd):
             return models
 
 
+        def _get_counter_name(self, model, name):
+            """Returns the name of the sharded counter of the `name` property of `model` (see RESTMeta.sharded_counters)"""
+            return get_property_counter_name(model.key, name)
+
+
+        def _get_counter_deltas(self, model, increments):
+            """Returns the counter increments of `model` according to the `increments` input (a dict of property name -> delta) - a dict of
+            counter name -> delta (see RESTMeta.sharded_counters). Raises RESTException if the input is invalid."""
+
+            if not isinstance(increments, dict):
+                raise RESTException('Invalid "$inc" data')
+
+            counters = getattr(self.model.RESTMeta, 'sharded_counters', [])
+            deltas = {}
+
+            # Translate the property names (a copy - so the input data won't be modified)
+            for (name, delta) in translate_property_names(dict(increments), self.model, 'input').iteritems():
+                if name not in counters:
+                    raise RESTException('"%s" is not a counter property' % name)
+                if not isinstance(delta, (int, long)) or isinstance(delta, bool):
+                    raise RESTException('Invalid "$inc" value for "%s" - %s' % (name, delta))
+
+                deltas[self._get_counter_name(model, name)] = delta
+
+            return deltas
+
+
+        def _put_models_with_increments(self, models, increments):
+            """Saves `models` and returns their keys - each model with counter `increments` (a dict of model key -> counter deltas) is saved
+            together with its increments in a single (cross-group) transaction, so they're either both applied or not at all"""
+
+            @ndb.tasklet
+            def put_model(model, deltas):
+                (key, _) = yield model.put_async(), increment_counters_async(deltas)
+                raise ndb.Return(key)
+
+            increments = dict((m.key, increments[m.key]) for m in models if increments.get(m.key))
+            uncached_names = dict((key, begin_cached_counters_update(deltas)) for (key, deltas) in increments.iteritems())
+            futures = dict((m.key, ndb.transaction_async(lambda m=m: put_model(m, increments[m.key]), xg=True, deadline=self.write_deadline))
+                           for m in models if m.key in increments)
+
+            plain_models = [m for m in models if m.key not in futures]
+            keys = dict(zip([m.key for m in plain_models], self._put_models(plain_models) if plain_models else []))
+            errors = []
+
+            for (key, future) in futures.iteritems():
+                try:
+                    keys[key] = future.get_result()
+                    end_cached_counters_update(increments[key], uncached_names[key])
+                except Exception, exc:
+                    end_cached_counters_update(increments[key], uncached_names[key], committed=False)
+                    errors.append(exc)
+
+            if errors:
+                raise errors[0]
+
+            return [keys[m.key] for m in models]
+
+
+        def _merge_counters(self, models):
+            """Sets the sharded counter properties of `models` to the totals of their counters (see RESTMeta.sharded_counters)"""
+            merge_counters(self.model, models)
+
+
         def _delete_model_blobs(self, model):
             """Deletes all blobs associated with the model (finds all BlobKeyProperty)"""
 
-            for (name, prop) in model._properties.iteritems():
-                if isinstance(prop, ndb.BlobKeyProperty):
-                    if getattr(model, name):
-                        blobstore.delete(getattr(model, name))
+            blob_keys = get_model_blob_keys(model)
+            if blob_keys:
+                delete_blobs(blob_keys)
 
 
 
@@ -869,7 +3323,7 @@ def get_rest_class(ndb_model, base_url, **kwd):
 
                 if self.permissions['DELETE'] == PERMISSION_OWNER_USER:
                     # Delete all models owned by the currently logged-in user
-                    query = self.model.query().filter(getattr(self.model, self.user_owner_property) == self.user.key)
+                    query = self._filter_query_by_owner(self.model.query())
                 else:
                     # Delete all models
                     query = self.model.query()
@@ -879,7 +3333,7 @@ def get_rest_class(ndb_model, base_url, **kwd):
                 more_available = True
 
                 while more_available:
-                    results, cursor, more_available = query.fetch_page(BaseRESTHandler.DEFAULT_MAX_QUERY_RESULTS, start_cursor=cursor)
+                    results, cursor, more_available = self._call_datastore(query.fetch_page, BaseRESTHandler.DEFAULT_MAX_QUERY_RESULTS, start_cursor=cursor, deadline=self.query_deadline)
                     if results:
                         models.extend(results)
 
@@ -889,7 +3343,20 @@ def get_rest_class(ndb_model, base_url, **kwd):
             for m in models:
                 self._delete_model_blobs(m) # No easy way to delete blobstore entries in a transaction
 
-            deleted_keys = ndb.delete_multi(m.key for m in models)
+            deleted_keys = self._call_datastore(ndb.delete_multi, [m.key for m in models], deadline=self.write_deadline)
+            self._record_changes(models, 'deleted')
+            self._update_counts(models, -1)
+
+            if getattr(self.model.RESTMeta, 'sharded_counters', None):
+                delete_counters([self._get_counter_name(m, name) for m in models for name in self.model.RESTMeta.sharded_counters])
+
+            if getattr(self.model.RESTMeta, 'updated_property', None):
+                # Leave tombstones, so syncing clients will know about the deletions
+                self._call_datastore(ndb.put_multi, [RESTTombstone(
+                    model_kind=self.model._get_kind(),
+                    model_id=encode_model_id(m.key),
+                    owner=self.get_model_owner(m) if hasattr(self.model.RESTMeta, 'user_owner_property') else None
+                    ) for m in models], deadline=self.write_deadline)
 
             if self.after_delete_callback:
                 self.after_delete_callback(deleted_keys, models)
@@ -924,9 +3391,20 @@ def get_rest_class(ndb_model, base_url, **kwd):
             return self.model.RESTMeta.user_owner_property
 
         def get_model_owner(self, model):
-            """Returns the user owner of the given `model` (relies on RESTMeta.user_owner_property)"""
+            """Returns the user owner of the given `model` (relies on RESTMeta.user_owner_property, or on the model's key if RESTMeta.user_owner_ancestor is set)"""
+            if is_owner_ancestor_model(self.model):
+                return model.key.parent()
+
             return getattr(model, self.user_owner_property)
 
+        def _filter_query_by_owner(self, query):
+            """Returns `query` limited to the models owned by the currently logged-in user - an ancestor query if RESTMeta.user_owner_ancestor is set"""
+            if is_owner_ancestor_model(self.model):
+                return ndb.Query(kind=query.kind, ancestor=self.user.key, filters=query.filters, orders=query.orders, app=query.app,
+                                 namespace=query.namespace, default_options=query.default_options)
+
+            return query.filter(getattr(self.model, self.user_owner_property) == self.user.key)
+
 
 
 
@@ -957,6 +3435,14 @@ class RESTHandler(NamePrefixRoute): # We inherit from NamePrefixRoute so the sam
             raise ValueError('RESHandler url should start with "/": %s' % url)
 
         routes = [
+                # Export all of the model instances (e.g. /api/my_model/_export?format=csv)
+                webapp2.Route(url + '/_export', get_rest_class(model, url, **kwd), 'export', handler_method='export'),
+                # Wait for changes of the model instances (e.g. /api/my_model/_watch?since=123)
+                webapp2.Route(url + '/_watch', get_rest_class(model, url, **kwd), 'watch', handler_method='watch'),
+                # Aggregate the model instances (e.g. /api/my_model/_aggregate?op=sum&field=price&group_by=category)
+                webapp2.Route(url + '/_aggregate', get_rest_class(model, url, **kwd), 'aggregate', handler_method='aggregate'),
+                # Materialized views of the model instances (e.g. /api/my_model/_views/latest)
+                webapp2.Route(url + '/_views/<view_name:[^/]+>', get_rest_class(model, url, **kwd), 'view', handler_method='view'),
                 # Make sure we catch both URLs: to '/mymodel' and to '/mymodel/123'
                 webapp2.Route(url + '<model_id:(/.+)?|/>', get_rest_class(model, url, **kwd), 'main')
             ]
@@ -976,6 +3462,10 @@ class RESTHandler(NamePrefixRoute): # We inherit from NamePrefixRoute so the sam
                 # Upload/Download blob route and handler
                 routes.insert(0, webapp2.Route(blob_property_url, get_rest_class(model, url, **kwd), 'upload-download-blob'))
 
+        if get_blob_properties(model) and kwd.get('blob_download_secret'):
+            # Pre-authorized blob downloads route and handler (e.g. /api/my_model/_blobs/<BLOB_KEY>?expires=...&signature=...)
+            routes.insert(0, webapp2.Route(url + '/_blobs/<blob_key:[^/]+>', get_blob_download_class(kwd['blob_download_secret']), 'download-signed-blob'))
+
 
 
         super(RESTHandler, self).__init__('rest-handler-', routes)
@@ -5,18 +5,51 @@ A lot of the webapp2 user authentication and registration implementation is base
 
 import json
 import time
+from datetime import datetime, timedelta
+import logging
+import pickle
+import hashlib
+import binascii
 from urllib import urlencode
 import webapp2_extras.appengine.auth.models
 import webapp2
 from jinja2 import Template
 from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.api import users as gae_users
 from webapp2_extras import auth
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import model
 from webapp2_extras import security
 from webapp2_extras.auth import InvalidAuthIdError, InvalidPasswordError
 from webapp2_extras import sessions
-from rest_gae import PERMISSION_ADMIN, PERMISSION_ANYONE, PERMISSION_LOGGED_IN_USER, PERMISSION_OWNER_USER, BaseRESTHandler, RESTException, import_class
+from rest_gae import PERMISSION_ADMIN, PERMISSION_ANYONE, PERMISSION_LOGGED_IN_USER, PERMISSION_OWNER_USER, BaseRESTHandler, RESTException, import_class, get_class_path, freeze_model_metadata, install_search_index, start_purge, get_purge_stats, delete_owned_entities, get_owned_models, get_tombstone_purge_jobs
+
+
+# The maximal number of queued emails sent by a single flush task
+EMAIL_BATCH_SIZE = 100
+# How long (in seconds) queued emails are leased while being sent - a failed email becomes available for a retry after this period
+EMAIL_LEASE_SECONDS = 60
+# How long (in seconds) to wait before flushing the email queue - emails queued during this period are sent together
+EMAIL_FLUSH_DELAY = 2
+# Emails that failed to be sent this many times are dropped
+EMAIL_MAX_RETRIES = 5
+# How long (in seconds) to wait before retrying the emails that failed to be sent by a deferred task (doubled for each retry)
+EMAIL_RETRY_DELAY = 60
+
+# How long (in seconds) an auth_id -> user id resolution is kept in memcache
+AUTH_ID_CACHE_TIME = 3600
+# The prefix of the PBKDF2 password hashes (see generate_password_hash) - webapp2 hashes start with a hex digest, so they never have it
+PBKDF2_HASH_PREFIX = 'pbkdf2:'
+
+# The number of users created together (unique properties reserved + users saved) in bulk registration
+BULK_REGISTRATION_CHUNK_SIZE = 200
+
+# How long (in seconds) a unique property must be seen without its user before it's deleted by the cleanup task (protects the uniques
+# of users which are being registered at the same time, and the eventual consistency of the user lookups)
+UNIQUE_ORPHAN_GRACE_PERIOD = 3600
 
 
 def get_user_rest_class(**kwd):
@@ -37,6 +70,16 @@ def get_user_rest_class(**kwd):
         user_policy_callback = [kwd.get('user_policy_callback', None)]
         send_email_callback = [kwd.get('send_email_callback', None)] # Wrapping in a list so the function won't be turned into a bound method
         allow_login_for_non_verified_email = kwd.get('allow_login_for_non_verified_email', True)
+        email_queue_name = kwd.get('email_queue_name', None)
+        cascade_delete = kwd.get('cascade_delete', False)
+        max_query_limit = kwd.get('max_query_limit', BaseRESTHandler.max_query_limit)
+        max_result_bytes = kwd.get('max_result_bytes', BaseRESTHandler.max_result_bytes)
+        query_deadline = kwd.get('query_deadline', BaseRESTHandler.query_deadline)
+        read_policy = kwd.get('read_policy', BaseRESTHandler.read_policy)
+        retry_attempts = kwd.get('retry_attempts', BaseRESTHandler.retry_attempts)
+        retry_backoff = kwd.get('retry_backoff', BaseRESTHandler.retry_backoff)
+        password_hash_method = kwd.get('password_hash_method', getattr(model, 'password_hash_method', 'sha1'))
+        password_hash_iterations = kwd.get('password_hash_iterations', getattr(model, 'password_hash_iterations', 1))
 
         # Validate arguments (we do this at this stage in order to raise exceptions immediately rather than while the app is running)
         if (model != User) and (User not in model.__bases__):
@@ -55,7 +98,27 @@ def get_user_rest_class(**kwd):
             raise ValueError('Must set "reset_password_email" when "verify_email_address" is True')
         if reset_password_email and set(reset_password_email.keys()) != set(['sender', 'subject', 'body_text', 'body_html']):
             raise ValueError('"reset_password_email" must include all of the following keys: sender, subject, body_text, body_html')
+        if send_email_callback[0]:
+            try:
+                pickle.dumps(send_email_callback[0])
+            except Exception, exc:
+                raise ValueError('"send_email_callback" must be a module-level function (it is pickled into the email task)')
+        if password_hash_method not in hashlib.algorithms:
+            raise ValueError('Unsupported "password_hash_method" - %s (must be one of: %s)' % (password_hash_method, ', '.join(hashlib.algorithms)))
+        if not isinstance(password_hash_iterations, (int, long)) or password_hash_iterations < 1:
+            raise ValueError('"password_hash_iterations" must be a positive integer')
+
+        # The user model hashes the passwords (on registration, password change and re-hashing on login) according to these parameters
+        model.password_hash_method = password_hash_method
+        model.password_hash_iterations = password_hash_iterations
 
+        # Add the search index of the user model (see RESTMeta.search_properties), and compute its metadata now, so the requests will only read it
+        install_search_index(model)
+        freeze_model_metadata(model)
+
+        # Compile the email templates once - they're only rendered per request
+        verification_email = _compile_email_templates(verification_email)
+        reset_password_email = _compile_email_templates(reset_password_email)
 
         permissions = { 'GET': PERMISSION_ANYONE, 'PUT': PERMISSION_OWNER_USER, 'DELETE': PERMISSION_OWNER_USER, 'POST': PERMISSION_ANYONE } # Used by get_response method when building the HTTP response header 'Access-Control-Allow-Methods'
 
@@ -86,7 +149,7 @@ def get_user_rest_class(**kwd):
 
                             model = self.user
 
-                        elif (method_name == 'POST' and model_id in ['login', 'reset']) or (method_name == 'GET' and model_id == 'verify'):
+                        elif (method_name == 'POST' and model_id in ['login', 'reset', 'bulk']) or (method_name == 'GET' and model_id == 'verify'):
                             model = model_id
 
                         else:
@@ -209,18 +272,68 @@ def get_user_rest_class(**kwd):
         def post(self, model):
             """POST endpoint - registers a new user"""
 
-            if model and model not in ['login', 'reset']:
+            if model and model not in ['login', 'reset', 'bulk']:
                 # Invalid usage of the endpoint
                 raise RESTException('Cannot POST to a specific user ID')
 
+            if model and model == 'bulk':
+                # Register several users at once (admins only)
+
+                if not self.user:
+                    # Must be logged-in
+                    return self.unauthorized()
+
+                if not self.user.is_admin:
+                    # Must be admin
+                    return self.permission_denied()
+
+                try:
+                    # Parse POST data (JSON or MessagePack)
+                    json_data = self._get_request_data()
+                except ValueError, exc:
+                    raise RESTException('Invalid %s POST data' % self._get_request_format())
+
+                if not isinstance(json_data, list):
+                    raise RESTException('Invalid %s POST data - must be a list of users' % self._get_request_format())
+
+                results = [None] * len(json_data)
+                users_to_create = []
+                indexes_to_create = []
+
+                for (index, user_data) in enumerate(json_data):
+                    try:
+                        users_to_create.append(self._get_user_values_from_data(user_data))
+                        indexes_to_create.append(index)
+                    except Exception, exc:
+                        # Invalid input for this user (the rest of the users are still registered)
+                        results[index] = { 'error': str(exc) }
+
+                created_users = []
+
+                for (index, result) in zip(indexes_to_create, self.model.create_users(users_to_create, ['email'])):
+                    results[index] = result
+
+                    if 'existing_fields' in result:
+                        result['existing_fields'] = ['user_name' if s == 'auth_id' else s for s in result['existing_fields']]
+                        result['error'] = 'Unable to register user - the following fields are already registered: %s' % (', '.join(result['existing_fields']))
+
+                    elif 'user' in result:
+                        created_users.append(result['user'])
+
+                if self.verify_email_address and created_users:
+                    # Send the email verifications (all together)
+                    self._send_verification_emails(created_users, self.verification_email)
+
+                return self.success({ 'results': results })
+
             if model and model == 'reset':
                 # Send a password reset email
 
                 try:
-                    # Parse POST data as JSON
-                    json_data = json.loads(self.request.body)
+                    # Parse POST data (JSON or MessagePack)
+                    json_data = self._get_request_data()
                 except ValueError, exc:
-                    raise RESTException('Invalid JSON POST data')
+                    raise RESTException('Invalid %s POST data' % self._get_request_format())
 
                 if 'user_name' not in json_data:
                     raise RESTException('Missing user_name argument')
@@ -239,10 +352,10 @@ def get_user_rest_class(**kwd):
                 # Login the user
 
                 try:
-                    # Parse POST data as JSON
-                    json_data = json.loads(self.request.body)
+                    # Parse POST data (JSON or MessagePack)
+                    json_data = self._get_request_data()
                 except ValueError, exc:
-                    raise RESTException('Invalid JSON POST data')
+                    raise RESTException('Invalid %s POST data' % self._get_request_format())
 
                 if 'user_name' not in json_data:
                     raise RESTException('Missing user_name argument')
@@ -279,59 +392,20 @@ def get_user_rest_class(**kwd):
 
 
             try:
-                # Parse POST data as JSON
-                json_data = json.loads(self.request.body)
+                # Parse POST data (JSON or MessagePack)
+                json_data = self._get_request_data()
             except ValueError, exc:
-                raise RESTException('Invalid JSON POST data')
+                raise RESTException('Invalid %s POST data' % self._get_request_format())
 
 
             try:
                 # Any exceptions raised due to invalid/missing input will be caught
 
-                if self.user_policy_callback is not None and self.user_policy_callback[0] is not None:
-                    json_data = self.user_policy_callback[0](self.user, json_data)
-
-                if not 'email' in json_data:
-                    raise ValueError('Missing email')
-                if not self.email_as_username and not 'user_name' in json_data:
-                    raise ValueError('Missing user_name')
-                if not 'password' in json_data:
-                    raise ValueError('Missing password')
-
-                user_name = json_data['email'] if self.email_as_username else json_data['user_name']
-                password = json_data['password']
-
-                # Sanitize the input
-                json_data.pop('user_name', None)
-                json_data.pop('password', None)
-                json_data.pop('is_email_verified', None)
-
-                if self.user and self.user.is_admin:
-                    # Allow admins to create a new user and set his access level
-                    is_admin = json_data.get('is_admin', False)
-                else:
-                    is_admin = False
-
-                json_data.pop('is_admin', None)
-
-
-                user_properties = { }
-
-                # Make sure only properties defined in the user model will be written (since the parent webapp2 User model is an ExpandoModel)
-                for prop_name in self.model._properties.keys():
-                    if prop_name in json_data:
-                        user_properties[prop_name] = json_data[prop_name]
+                (user_name, user_values) = self._get_user_values_from_data(json_data)
 
                 unique_properties = ['email']
 
-                user_data = self.model.create_user(
-                        user_name,
-                        unique_properties,
-                        password_raw=password,
-                        is_email_verified=(False if self.verify_email_address else True),
-                        is_admin=is_admin,
-                        **user_properties
-                        )
+                user_data = self.model.create_user(user_name, unique_properties, **user_values)
 
                 if not user_data[0]:
                     # Caused due to multiple keys (i.e. the user is already registered or the username/email is taken by someone else)
@@ -348,39 +422,96 @@ def get_user_rest_class(**kwd):
                 return self.success(user_data[1])
 
             except Exception, exc:
-                raise RESTException('Invalid JSON POST data - %s' % exc)
+                raise RESTException('Invalid %s POST data - %s' % (self._get_request_format(), exc))
+
+
+        def _get_user_values_from_data(self, json_data):
+            """Validates and sanitizes the input `json_data` of a user registration. Returns a tuple of (user_name, user_values) to be
+            used with the user model's create_user method. Raises an exception if the input is invalid."""
+
+            if self.user_policy_callback is not None and self.user_policy_callback[0] is not None:
+                json_data = self.user_policy_callback[0](self.user, json_data)
+
+            if not 'email' in json_data:
+                raise ValueError('Missing email')
+            if not self.email_as_username and not 'user_name' in json_data:
+                raise ValueError('Missing user_name')
+            if not 'password' in json_data:
+                raise ValueError('Missing password')
+
+            user_name = json_data['email'] if self.email_as_username else json_data['user_name']
+            password = json_data['password']
+
+            # Sanitize the input
+            json_data.pop('user_name', None)
+            json_data.pop('password', None)
+            json_data.pop('is_email_verified', None)
+
+            if self.user and self.user.is_admin:
+                # Allow admins to create a new user and set his access level
+                is_admin = json_data.get('is_admin', False)
+            else:
+                is_admin = False
+
+            json_data.pop('is_admin', None)
+
+
+            user_values = {
+                    'password_raw': password,
+                    'is_email_verified': (False if self.verify_email_address else True),
+                    'is_admin': is_admin
+                    }
+
+            # Make sure only properties defined in the user model will be written (since the parent webapp2 User model is an ExpandoModel)
+            for prop_name in self.model._properties.keys():
+                if prop_name in json_data:
+                    user_values[prop_name] = json_data[prop_name]
+
+            return (user_name, user_values)
 
 
         def _send_verification_email(self, user, email, reset_password=False):
             """Sends a verification email to a specific `user` with specific email details (in `email`). Creates a reset password link if `reset_password` is True."""
+            self._send_verification_emails([user], email, reset_password)
+
+
+        def _send_verification_emails(self, users, email, reset_password=False):
+            """Sends a verification email to each of the `users` (see _send_verification_email) - their signup tokens are saved using a single
+            put_multi, and the emails are sent together in the background"""
+
+            # Create the signup tokens (the same way create_signup_token does)
+            token_model = self.user_model.token_model
+            tokens = []
+
+            for user in users:
+                token = security.generate_random_string(entropy=128)
+                tokens.append(token_model(key=token_model.get_key(user.get_id(), 'signup', token), user=str(user.get_id()), subject='signup', token=token))
 
-            # Prepare the verification URL
-            user_id = user.get_id()
-            token = self.user_model.create_signup_token(user_id)
+            ndb.put_multi(tokens)
 
             path_url = self.request.path_url
             path_url = path_url[:-len('verify')] if path_url.endswith('reset') else path_url
+            path_url = path_url[:-len('bulk')] if path_url.endswith('bulk') else path_url
             path_url = path_url.rstrip('/')
-            verification_params = { 'type': ('v' if not reset_password else 'p'), 'user_id': user_id, 'signup_token': token }
-            verification_url = path_url + '/verify?' + urlencode(verification_params)
 
-            # Prepare email body
-            email['body_text'] = Template(email['body_text']).render(user=user, verification_url=verification_url)
-            email['body_html'] = Template(email['body_html']).render(user=user, verification_url=verification_url)
+            emails = []
 
-            # Send the email
-            if self.send_email_callback:
-                # Use the provided function for sending the email
-                self.send_email_callback(email)
-            else:
-                # Use GAE's email services
-                message = mail.EmailMessage()
-                message.sender = email['sender']
-                message.to = user.email
-                message.subject = email['subject']
-                message.body = email['body_text']
-                message.html = email['body_html']
-                message.send()
+            for (user, token) in zip(users, tokens):
+                # Prepare the verification URL
+                verification_params = { 'type': ('v' if not reset_password else 'p'), 'user_id': user.get_id(), 'signup_token': token.token }
+                verification_url = path_url + '/verify?' + urlencode(verification_params)
+
+                # Prepare email body (render into a new dict - `email` holds the compiled templates shared by all requests)
+                emails.append({
+                        'sender': email['sender'],
+                        'to': user.email,
+                        'subject': email['subject'],
+                        'body_text': email['body_text'].render(user=user, verification_url=verification_url),
+                        'body_html': email['body_html'].render(user=user, verification_url=verification_url)
+                        })
+
+            # Send the emails in the background (so the request won't wait for the email service)
+            _dispatch_emails(emails, self.email_queue_name, self.send_email_callback)
 
 
         @rest_method_wrapper
@@ -402,10 +533,10 @@ def get_user_rest_class(**kwd):
 
 
             try:
-                # Parse PUT data as JSON
-                json_data = json.loads(self.request.body)
+                # Parse PUT data (JSON or MessagePack)
+                json_data = self._get_request_data()
             except ValueError, exc:
-                raise RESTException('Invalid JSON PUT data')
+                raise RESTException('Invalid %s PUT data' % self._get_request_format())
 
 
 
@@ -434,7 +565,7 @@ def get_user_rest_class(**kwd):
                 model.put()
 
             except Exception, exc:
-                raise RESTException('Invalid JSON PUT data - %s' % exc)
+                raise RESTException('Invalid %s PUT data - %s' % (self._get_request_format(), exc))
 
 
             # Return the updated user details
@@ -461,9 +592,15 @@ def get_user_rest_class(**kwd):
             try:
                 self.user_model.remove_unique(model.email, ['email'], email=model.email)
                 model.key.delete()
+                self.user_model.uncache_auth_ids(model.auth_ids)
             except Exception, exc:
                 raise RESTException('Could not delete user - %s' % exc)
 
+            if self.cascade_delete:
+                # Delete the user's data in the background (so the request returns immediately) - the owned models are resolved here, since the
+                # RESTHandlers may not be created in the instance that runs the task
+                deferred.defer(delete_owned_entities, model.key, get_owned_models())
+
 
             # Return the deleted user instance
             return self.success(model)
@@ -474,6 +611,247 @@ def get_user_rest_class(**kwd):
     return UserRESTHandlerClass
 
 
+def get_cleanup_class(**kwd):
+    """Returns a CleanupHandlerClass with the expiration settings set according to input"""
+
+    class CleanupHandlerClass(BaseRESTHandler):
+
+        user_model = import_class(kwd.get('user_model', User))
+        auth_token_max_age = kwd.get('auth_token_max_age', None)
+        signup_token_max_age = kwd.get('signup_token_max_age', 86400 * 7)
+        session_max_age = kwd.get('session_max_age', 86400 * 7 * 3)
+        cleanup_orphaned_uniques = kwd.get('cleanup_orphaned_uniques', True)
+
+        permissions = { 'GET': PERMISSION_ADMIN } # Used by get_response method when building the HTTP response header 'Access-Control-Allow-Methods'
+
+        def get(self):
+            """Schedules the cleanup tasks and returns the progress of the previous ones"""
+
+            if not self.request.headers.get('X-AppEngine-Cron') and not gae_users.is_current_user_admin():
+                # Only cron jobs and app admins can trigger the cleanup
+                return self.permission_denied()
+
+            now = datetime.now()
+            token_kind = self.user_model.token_model._get_kind()
+
+            auth_token_max_age = self.auth_token_max_age
+            if auth_token_max_age is None:
+                # Use the same expiration as webapp2_extras.auth
+                auth_token_max_age = self.auth.store.config['token_max_age']
+
+            jobs = [
+                    ('auth_tokens', token_kind, [('created', '<', now - timedelta(seconds=auth_token_max_age))], _select_tokens_by_subject, ('auth',)),
+                    ('signup_tokens', token_kind, [('created', '<', now - timedelta(seconds=self.signup_token_max_age))], _select_tokens_by_subject, ('signup',)),
+                    ('sessions', 'Session', [('updated', '<', now - timedelta(seconds=self.session_max_age))], None, ())
+                    ]
+
+            if self.cleanup_orphaned_uniques:
+                # The user model is passed by its import path (the task may run in an instance which hasn't imported it)
+                jobs.append(('uniques', self.user_model.unique_model._get_kind(), [], _select_orphaned_uniques, (get_class_path(self.user_model),)))
+
+            # Expired delete tombstones (of models with a RESTMeta.updated_property)
+            jobs.extend(get_tombstone_purge_jobs(now))
+
+            # Purges which are still running (from a previous run) aren't started again
+            scheduled = [name for (name, kind, filters, select_keys, select_keys_args) in jobs if start_purge(name, kind, filters, select_keys, select_keys_args)]
+
+            return self.success({
+                'scheduled': scheduled,
+                'running': [job[0] for job in jobs if job[0] not in scheduled],
+                'previous_runs': get_purge_stats([job[0] for job in jobs])
+                })
+
+
+    return CleanupHandlerClass
+
+
+class CleanupHandler(webapp2.Route):
+    """Returns our RequestHandler for deleting expired auth tokens, signup tokens, sessions (of the datastore session backend),
+    orphaned unique properties and expired delete tombstones (see RESTMeta.tombstone_horizon). Should be called by a cron job:
+            app = webapp2.WSGIApplication([CleanupHandler('/tasks/cleanup', user_model='models.my_user_model')])
+
+            cron.yaml:
+                - description: rest_gae cleanup
+                  url: /tasks/cleanup
+                  schedule: every 24 hours
+
+        Each kind is scanned by a background (deferred) task using keys-only batches, and the expired entities are deleted in batches.
+        A purge which is still running (from the previous run) isn't started again. The response contains the names of the scheduled and
+        still running purges and the deletion counts of the previous run.
+
+        Parameters:
+            `user_model` - (optional) The user model to be used - if omitted, uses the default rest_gae.users.User model.
+            `auth_token_max_age` - (optional) Auth tokens older than this (in seconds) are deleted. Defaults to webapp2_extras.auth `token_max_age`.
+            `signup_token_max_age` - (optional; default=1 week) Signup tokens (verification / reset password links) older than this (in seconds) are deleted.
+            `session_max_age` - (optional; default=3 weeks) Sessions that weren't updated for this long (in seconds) are deleted.
+            `cleanup_orphaned_uniques` - (optional; default=True) Delete unique properties (user names / emails) whose user no longer exists.
+    """
+
+    def __init__(self, url, **kwd):
+        super(CleanupHandler, self).__init__(url.rstrip(' /'), get_cleanup_class(**kwd))
+
+
+def _select_tokens_by_subject(keys, subject):
+    """Returns the token keys of the given `subject` (the token key name is formatted as 'user_id.subject.token')"""
+    return [key for key in keys if key.id().rsplit('.', 2)[-2] == subject]
+
+
+def _select_orphaned_uniques(keys, user_model_path):
+    """Returns the unique keys of the user model (`user_model_path` is its import path) whose user doesn't exist (and wasn't found in the
+    previous cleanup run either - see UNIQUE_ORPHAN_GRACE_PERIOD). The unique key name is formatted as 'UserClassName.property_name:value'."""
+
+    user_model = import_class(user_model_path)
+    futures = []
+
+    for key in keys:
+        (prefix, value) = key.id().split(':', 1)
+        (class_name, name) = prefix.split('.', 1)
+        if class_name != user_model.__name__:
+            continue
+
+        prop = user_model.auth_ids if name == 'auth_id' else getattr(user_model, name)
+        futures.append((key, user_model.query(prop == value).get_async(keys_only=True)))
+
+    orphaned_keys = [key for (key, future) in futures if not future.get_result()]
+    if not orphaned_keys:
+        return []
+
+    # Only delete uniques which were orphaned for at least UNIQUE_ORPHAN_GRACE_PERIOD
+    now = int(time.time())
+    first_seen = memcache.get_multi([key.id() for key in orphaned_keys], key_prefix='rest_gae:orphan:')
+    memcache.add_multi(dict((key.id(), now) for key in orphaned_keys), key_prefix='rest_gae:orphan:', time=UNIQUE_ORPHAN_GRACE_PERIOD * 48)
+
+    return [key for key in orphaned_keys if now - first_seen.get(key.id(), now) >= UNIQUE_ORPHAN_GRACE_PERIOD]
+
+
+
+#
+# Email sending functions (module-level, so they can be used by deferred tasks)
+#
+
+
+def _compile_email_templates(email):
+    """Returns a copy of the `email` dict with its body_text/body_html compiled as Jinja2 templates"""
+    if not email:
+        return email
+
+    email = dict(email)
+    email['body_text'] = Template(email['body_text'])
+    email['body_html'] = Template(email['body_html'])
+
+    return email
+
+
+def _send_email(email, send_email_callback=None):
+    """Sends a rendered `email` dict (sender, to, subject, body_text, body_html)"""
+
+    if send_email_callback:
+        # Use the provided function for sending the email
+        send_email_callback(email)
+    else:
+        # Use GAE's email services
+        message = mail.EmailMessage()
+        message.sender = email['sender']
+        message.to = email['to']
+        message.subject = email['subject']
+        message.body = email['body_text']
+        message.html = email['body_html']
+        message.send()
+
+
+def _dispatch_emails(emails, queue_name=None, send_email_callback=None):
+    """Sends a list of rendered `emails` in the background - by deferred tasks (up to EMAIL_BATCH_SIZE emails per task), or using the
+    `queue_name` pull queue (see _enqueue_emails)"""
+
+    if queue_name:
+        _enqueue_emails(emails, queue_name, send_email_callback)
+    else:
+        for start in range(0, len(emails), EMAIL_BATCH_SIZE):
+            deferred.defer(_send_emails, emails[start:start + EMAIL_BATCH_SIZE], send_email_callback)
+
+
+def _send_emails(emails, send_email_callback=None, retry_count=0):
+    """Sends a list of rendered `emails` (should be run as a deferred task). The emails that failed to be sent are retried by a new
+    task (after EMAIL_RETRY_DELAY seconds, doubled for each retry) - so the emails that were already sent aren't sent again."""
+
+    failed_emails = []
+
+    for email in emails:
+        try:
+            _send_email(email, send_email_callback)
+        except Exception, exc:
+            if retry_count < EMAIL_MAX_RETRIES:
+                logging.warning('Failed sending email to %s (will retry): %s' % (email['to'], exc))
+                failed_emails.append(email)
+            else:
+                logging.error('Failed sending email to %s (giving up after %d attempts): %s' % (email['to'], retry_count + 1, exc))
+
+    if failed_emails:
+        deferred.defer(_send_emails, failed_emails, send_email_callback, retry_count + 1, _countdown=EMAIL_RETRY_DELAY * 2 ** retry_count)
+
+
+def _enqueue_emails(emails, queue_name, send_email_callback=None):
+    """Adds a list of rendered `emails` to the `queue_name` pull queue and schedules a task that flushes it"""
+
+    queue = taskqueue.Queue(queue_name)
+    tasks = [taskqueue.Task(payload=json.dumps(email), method='PULL') for email in emails]
+
+    for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+
+    _schedule_email_flush(queue_name, send_email_callback, EMAIL_FLUSH_DELAY)
+
+
+def _schedule_email_flush(queue_name, send_email_callback, countdown, batched=True):
+    """Schedules a flush of the email queue in `countdown` seconds. If `batched` is True, all of the emails queued within the same time
+    period share a single flush task (we use a named task for that)."""
+
+    task_name = 'flush-%s-%d' % (queue_name, (int(time.time()) + countdown) // EMAIL_FLUSH_DELAY) if batched else None
+
+    try:
+        deferred.defer(_flush_email_queue, queue_name, send_email_callback, _countdown=countdown, _name=task_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # A flush is already scheduled for this time period
+        pass
+
+
+def _flush_email_queue(queue_name, send_email_callback=None):
+    """Leases a batch of emails from the `queue_name` pull queue and sends them. Emails that failed to be sent are retried once
+    their lease expires."""
+
+    queue = taskqueue.Queue(queue_name)
+    tasks = queue.lease_tasks(EMAIL_LEASE_SECONDS, EMAIL_BATCH_SIZE)
+
+    done_tasks = []
+    failed_count = 0
+
+    for task in tasks:
+        email = json.loads(task.payload)
+
+        try:
+            _send_email(email, send_email_callback)
+        except Exception, exc:
+            if task.retry_count < EMAIL_MAX_RETRIES:
+                logging.warning('Failed sending email to %s (will retry): %s' % (email['to'], exc))
+                failed_count += 1
+                continue
+
+            logging.error('Failed sending email to %s (giving up after %d attempts): %s' % (email['to'], task.retry_count + 1, exc))
+
+        done_tasks.append(task)
+
+    if done_tasks:
+        queue.delete_tasks(done_tasks)
+
+    if len(tasks) == EMAIL_BATCH_SIZE:
+        # There might be more emails waiting in the queue
+        _schedule_email_flush(queue_name, send_email_callback, 0, batched=False)
+    elif failed_count:
+        # Retry the failed emails once their lease expires
+        _schedule_email_flush(queue_name, send_email_callback, EMAIL_LEASE_SECONDS, batched=False)
+
+
+
 class UserRESTHandler(webapp2.Route):
     """Returns our RequestHandler for user management. Should be used as part of the WSGIApplication routing:
             app = webapp2.WSGIApplication([('/users', UserRESTHandler(
@@ -497,7 +875,8 @@ class UserRESTHandler(webapp2.Route):
                                                     'body_text': 'Hello {{ user.name }}, click here: {{ verification_url }}',
                                                     'body_html': 'Hello {{ user.name }}, click <a href="{{ verification_url }}">here</a>'
                                                 },
-                                                send_email_callback=lambda email: my_send_func(email),
+                                                send_email_callback=my_send_func,
+                                                email_queue_name='emails',
                                                 allow_login_for_non_verified_email=False
                                            )])
 
@@ -506,6 +885,7 @@ class UserRESTHandler(webapp2.Route):
                 GET /users/<user_id> - get the user details (permitted according to `user_details_permission`)
                 POST /users - registers a new user (if `admin_only_user_registration` == True - only admins can register)
                 POST /users/login - logins using an email/username+password combination
+                POST /users/bulk - registers several users at once (for admins only)
                 POST /users/reset - resets a user's password by sending him an email (the user name is passed in the POST data) - this endpoint is active only if `verify_email_address` is True
                 GET /users/verify - a link sent to a user's email address - for email verification (if `verify_email_address` is True) or for password reset
                 DELETE /users/<user_id> - Deletes a user account (permitted for admins or if the user deletes his own account)
@@ -534,9 +914,20 @@ class UserRESTHandler(webapp2.Route):
             `reset_password_email` - (optional) Must be set if `verify_email_address` is True. A dict containing the details of the reset password email being sent: Contains the same
                                         details as the `verification_email` dict.
             `send_email_callback` - (optional) If set, we'll use this function for sending out the emails for email verification / password reset (instead of using GAE's email services).
-                                        The function receives a single dict argument - containing sender, subject, body_text, body_html.
+                                        The function receives a single dict argument - containing sender, to, subject, body_text, body_html.
                                         Note that the body_text+body_html values are already rendered as templates (meaning, the verification URLs are already embedded inside them).
+                                        Must be a module-level function (it's pickled into the email tasks).
+            `email_queue_name` - (optional; default=None) Emails are always sent in the background (by deferred tasks, which retry failed emails - requires the deferred builtin
+                                        to be enabled). If set, the emails are added to this pull queue (must be defined in queue.yaml with `mode: pull`) and sent in batches
+                                        by a single flush task, instead of by a task per request.
             `allow_login_for_non_verified_email` - (optional; default=True) If set to False, any user with a non-verified email address will not be able to login (will get an access denied error).
+            `cascade_delete` - (optional; default=False) If set, deleting a user also deletes (in a background task) all of the entities the user owns - of every
+                                        model wrapped by a RESTHandler that has a RESTMeta.user_owner_property (including their blobs, delete tombstones and counters).
+            `max_query_limit`, `max_result_bytes`, `query_deadline` - (optional) Cost limits of the users list query (same as in RESTHandler).
+            `read_policy`, `retry_attempts`, `retry_backoff` - (optional) The read policy and the transient-error retries of the users list query (same as in RESTHandler).
+            `password_hash_method` - (optional; default='sha1') The hashlib algorithm used for hashing passwords.
+            `password_hash_iterations` - (optional; default=1) The number of PBKDF2 iterations used for hashing passwords (1 means a single salted HMAC, as webapp2 does).
+                                        Passwords hashed with different parameters are re-hashed transparently when their user logs in.
 
     """
 
@@ -559,6 +950,7 @@ class User(webapp2_extras.appengine.auth.models.User):
         excluded_output_properties = ['password']
         excluded_input_properties = ['password', 'is_admin', 'is_email_verified' ]
         admin_property = 'is_admin'
+        search_properties = ['email']
 
 
     #
@@ -567,13 +959,80 @@ class User(webapp2_extras.appengine.auth.models.User):
 
 
 
+    # The password hashing parameters (set according to the UserRESTHandler `password_hash_method` / `password_hash_iterations` arguments)
+    password_hash_method = 'sha1'
+    password_hash_iterations = 1
+
+
     def set_password(self, raw_password):
       """Sets the password for the current user
 
       :param raw_password:
           The raw password which will be hashed and stored
       """
-      self.password = security.generate_password_hash(raw_password, length=12)
+      self.password = generate_password_hash(raw_password, self.password_hash_method, self.password_hash_iterations)
+
+    @classmethod
+    def _auth_id_cache_key(cls, auth_id):
+      """Returns the memcache key used for caching the user id of `auth_id`"""
+      return 'rest_gae:auth_id:%s:%s' % (cls.__name__, auth_id)
+
+    @classmethod
+    def uncache_auth_ids(cls, auth_ids):
+      """Removes the cached user ids of the given `auth_ids` (should be called when a user is deleted or its auth_ids are changed)"""
+      memcache.delete_multi([cls._auth_id_cache_key(auth_id) for auth_id in auth_ids])
+
+    @classmethod
+    def get_by_auth_id(cls, auth_id):
+      """Returns a user object based on a auth_id. The auth_id -> user id resolution is cached in memcache, so
+      (in most cases) this costs a single get by key instead of a datastore query.
+
+      :param auth_id:
+          String representing a unique id for the user.
+      :returns:
+          A user object.
+      """
+      cache_key = cls._auth_id_cache_key(auth_id)
+      user_id = memcache.get(cache_key)
+
+      if user_id is not None:
+          user = cls.get_by_id(user_id)
+          # Make sure the cached value isn't stale (e.g. the user was deleted or its auth_id was changed)
+          if user and auth_id in user.auth_ids:
+              return user
+
+      user = cls.query(cls.auth_ids == auth_id).get()
+      if user:
+          memcache.set(cache_key, user.key.id(), time=AUTH_ID_CACHE_TIME)
+
+      return user
+
+    @classmethod
+    def get_by_auth_password(cls, auth_id, password):
+      """Returns a user object, validating password. Re-hashes the password in case it was hashed using old hashing parameters.
+
+      :param auth_id:
+          Authentication id.
+      :param password:
+          Password to be checked.
+      :returns:
+          A user object, if found and password matches.
+      :raises:
+          ``auth.InvalidAuthIdError`` or ``auth.InvalidPasswordError``.
+      """
+      user = cls.get_by_auth_id(auth_id)
+      if not user:
+          raise InvalidAuthIdError()
+
+      if not check_password_hash(password, user.password):
+          raise InvalidPasswordError()
+
+      if password_needs_rehash(user.password, cls.password_hash_method, cls.password_hash_iterations):
+          # The password was hashed using old parameters - the raw password is only available now, so this is the time to re-hash it
+          user.set_password(password)
+          user.put()
+
+      return user
 
     @classmethod
     def get_by_auth_token(cls, user_id, token, subject='auth'):
@@ -597,38 +1056,249 @@ class User(webapp2_extras.appengine.auth.models.User):
 
       return None, None
 
-    # Since the original create_user method calls user.put() (where the exception occurs), only *after*
-    # calling cls.unique_model.create_multi(k for k, v in uniques), this means we'll have to delete
-    # those created uniques (other they'll just stay as garbage data in the DB, while not allowing
-    # the user to re-register with the same username/email/etc.
-    @classmethod 
-    def remove_unique(cls, auth_id, unique_properties, **user_values):
+    @classmethod
+    def _get_uniques(cls, auth_id, unique_properties, user_values):
+        """Returns a list of (unique key name, property name) tuples for a user - the same way the original create_user method does"""
         uniques = [('%s.auth_id:%s' % (cls.__name__, auth_id), 'auth_id')]
-        print uniques
         if unique_properties:
             for name in unique_properties:
                 key = '%s.%s:%s' % (cls.__name__, name, user_values[name])
                 uniques.append((key, name))
 
+        return uniques
+
+    # Since create_user calls user.put() (where the exception occurs), only *after* calling
+    # cls.unique_model.create_multi(k for k, v in uniques), this means we'll have to delete
+    # those created uniques (other they'll just stay as garbage data in the DB, while not allowing
+    # the user to re-register with the same username/email/etc.
+    @classmethod 
+    def remove_unique(cls, auth_id, unique_properties, **user_values):
+        uniques = cls._get_uniques(auth_id, unique_properties, user_values)
+
         # Delete the uniques
         ndb.delete_multi(model.Key(cls.unique_model, k) for k,v in uniques)
 
 
     @classmethod
     def create_user(cls, auth_id, unique_properties=None, **user_values):
-        """Creates a new user (calls the original webapp2.auth.User.create_user. However, when the user
-            creation fails due to an exception (e.g. when a required property isn't provided), we'll clean up
-            and delete any unique properties created alongside the user model."""
-        try:
-            # Call original create_user method
-            return super(User, cls).create_user(auth_id, unique_properties, **user_values)
+        """Creates a new user (the same way the original webapp2.auth.User.create_user does, but hashes the password according to our
+            hashing parameters). When the user creation fails due to an exception (e.g. when a required property isn't provided), we'll
+            clean up and delete any unique properties created alongside the user model."""
+        assert user_values.get('password') is None, 'Use password_raw instead of password to create new users.'
 
+        if 'password_raw' in user_values:
+            user_values['password'] = generate_password_hash(user_values.pop('password_raw'), cls.password_hash_method, cls.password_hash_iterations)
+
+        user_values['auth_ids'] = [auth_id]
+        user = cls(**user_values)
+
+        uniques = cls._get_uniques(auth_id, unique_properties, user_values)
+        ok, existing = cls.unique_model.create_multi(k for k, v in uniques)
+
+        if not ok:
+            return False, [v for k, v in uniques if k in existing]
+
+        try:
+            user.put()
         except Exception, exc:
-            cls.remove_unique(auth_id, unique_properties, user_values)
+            cls.remove_unique(auth_id, unique_properties, **user_values)
 
             # Continue throwing the original exception
             raise exc
 
+        return True, user
+
+
+    @classmethod
+    def create_users(cls, users, unique_properties=None):
+        """Creates several users at once. `users` is a list of (auth_id, user_values) tuples (the same arguments create_user receives).
+            The users are created in chunks - the unique properties of each chunk are reserved together (in parallel transactions) and
+            its users are saved using a single put_multi.
+
+            Returns a list with a result dict for each of the input users: {'user': <the created user>} if it was created;
+            {'existing_fields': [...]} if some of its unique properties are already registered; {'error': '...'} if it couldn't be created.
+        """
+        results = []
+
+        for start in range(0, len(users), BULK_REGISTRATION_CHUNK_SIZE):
+            results.extend(cls._create_users_chunk(users[start:start + BULK_REGISTRATION_CHUNK_SIZE], unique_properties))
+
+        return results
+
+
+    @classmethod
+    def _create_users_chunk(cls, users, unique_properties):
+        """Creates a chunk of users (see create_users)"""
+
+        results = [None] * len(users)
+        rows = [] # (index, user, uniques) of the users which should be created
+        chunk_uniques = set()
+
+        for (index, (auth_id, user_values)) in enumerate(users):
+            try:
+                user_values = dict(user_values)
+
+                if 'password_raw' in user_values:
+                    user_values['password'] = generate_password_hash(user_values.pop('password_raw'), cls.password_hash_method, cls.password_hash_iterations)
+
+                user_values['auth_ids'] = [auth_id]
+                user = cls(**user_values)
+                uniques = cls._get_uniques(auth_id, unique_properties, user_values)
+            except Exception, exc:
+                results[index] = { 'error': str(exc) }
+                continue
+
+            # Conflicts within the input itself (e.g. two users with the same email)
+            existing_fields = [name for (key, name) in uniques if key in chunk_uniques]
+            if existing_fields:
+                results[index] = { 'existing_fields': existing_fields }
+                continue
+
+            chunk_uniques.update(key for (key, name) in uniques)
+            rows.append((index, user, uniques))
+
+        # Skip the uniques which are already registered (a single get_multi for the entire chunk)
+        unique_keys = [model.Key(cls.unique_model, key) for (index, user, uniques) in rows for (key, name) in uniques]
+        registered_keys = set(entity.key for entity in ndb.get_multi(unique_keys) if entity)
+
+        # Reserve the rest of the uniques (each in its own transaction, since they belong to different entity groups - but all in parallel)
+        keys_to_reserve = [key for key in unique_keys if key not in registered_keys]
+        futures = [ndb.transaction_async(lambda key=key: _reserve_unique_async(cls.unique_model, key)) for key in keys_to_reserve]
+        reserved_keys = set()
+        failed_keys = {}
+
+        for (key, future) in zip(keys_to_reserve, futures):
+            try:
+                if future.get_result():
+                    reserved_keys.add(key)
+            except Exception, exc:
+                # e.g. contention - only the users of this value fail (if the value was reserved after all, it's released by the CleanupHandler)
+                failed_keys[key] = exc
+
+        # Only create the users which all of their uniques were reserved, and release the uniques of the rest (in a single batch)
+        users_to_create = []
+        keys_to_release = []
+
+        for (index, user, uniques) in rows:
+            keys = [model.Key(cls.unique_model, key) for (key, name) in uniques]
+            existing_fields = [name for (key, (key_name, name)) in zip(keys, uniques) if key not in reserved_keys and key not in failed_keys]
+            errors = [str(failed_keys[key]) for key in keys if key in failed_keys]
+
+            if existing_fields or errors:
+                results[index] = { 'existing_fields': existing_fields } if existing_fields else { 'error': 'Could not reserve the unique properties - %s' % errors[0] }
+                keys_to_release.extend(key for key in keys if key in reserved_keys)
+            else:
+                users_to_create.append((index, user, keys))
+
+        if users_to_create:
+            # Allocate the user IDs in advance - so if put_multi fails, we can tell which of the users were saved anyway
+            (first_id, last_id) = cls.allocate_ids(size=len(users_to_create))
+            for ((index, user, keys), user_id) in zip(users_to_create, range(first_id, last_id + 1)):
+                user.key = model.Key(cls, user_id)
+
+            try:
+                ndb.put_multi([user for (index, user, keys) in users_to_create])
+                saved_keys = None
+            except Exception, exc:
+                logging.warning('Could not save %d users - %s' % (len(users_to_create), exc))
+
+                try:
+                    # put_multi isn't atomic - some of the users may have been saved
+                    saved_keys = set(user.key for user in ndb.get_multi([user.key for (index, user, keys) in users_to_create]) if user)
+                except Exception, lookup_exc:
+                    # We can't tell which users were saved - keep their uniques (orphaned ones are released by the CleanupHandler)
+                    saved_keys = set()
+                    users_to_create = [(index, user, []) for (index, user, keys) in users_to_create]
+
+            for (index, user, keys) in users_to_create:
+                if saved_keys is None or user.key in saved_keys:
+                    results[index] = { 'user': user }
+                else:
+                    results[index] = { 'error': 'Could not save the user - %s' % exc }
+                    keys_to_release.extend(keys)
+
+        if keys_to_release:
+            ndb.delete_multi(keys_to_release)
+
+        return results
+
+
+@ndb.tasklet
+def _reserve_unique_async(unique_model, key):
+    """Reserves a unique value (should run inside a transaction). Returns True if reserved, False if the value is already taken."""
+    entity = yield key.get_async()
+    if entity:
+        raise ndb.Return(False)
+
+    yield unique_model(key=key).put_async()
+    raise ndb.Return(True)
+
+
+
+#
+# Password hashing functions
+#
+
+
+def generate_password_hash(raw_password, method='sha1', iterations=1):
+    """Returns a salted hash of `raw_password`. If `iterations` is 1, the hash is generated exactly as webapp2 does ('hash$method$salt'),
+    otherwise PBKDF2 is used with the given number of `iterations` ('pbkdf2:method:iterations$salt$hash')."""
+
+    if iterations <= 1:
+        return security.generate_password_hash(raw_password, method=method, length=12)
+
+    salt = security.generate_random_string(length=12)
+    return '%s%s:%d$%s$%s' % (PBKDF2_HASH_PREFIX, method, iterations, salt, _pbkdf2_hash(raw_password, method, salt, iterations))
+
+
+def check_password_hash(raw_password, pwhash):
+    """Checks if `raw_password` matches the `pwhash` (generated by generate_password_hash or by webapp2)"""
+
+    if not pwhash.startswith(PBKDF2_HASH_PREFIX):
+        # Generated by webapp2
+        return security.check_password_hash(raw_password, pwhash)
+
+    (method, iterations, salt, hashval) = _parse_pbkdf2_hash(pwhash)
+    if method is None:
+        return False
+
+    return security.compare_hashes(_pbkdf2_hash(raw_password, method, salt, iterations), hashval)
+
+
+def password_needs_rehash(pwhash, method, iterations):
+    """Returns True if `pwhash` wasn't generated using the given hashing `method` and `iterations`"""
+
+    if pwhash.startswith(PBKDF2_HASH_PREFIX):
+        (hash_method, hash_iterations, salt, hashval) = _parse_pbkdf2_hash(pwhash)
+    elif pwhash.count('$') >= 2:
+        # Generated by webapp2 ('hash$method$salt')
+        (hash_method, hash_iterations) = (pwhash.split('$', 2)[1], 1)
+    else:
+        # An unsalted legacy hash (or plain text password)
+        return True
+
+    return (hash_method, hash_iterations) != (method, iterations)
+
+
+def _parse_pbkdf2_hash(pwhash):
+    """Returns the (method, iterations, salt, hash) of a PBKDF2 `pwhash` (see generate_password_hash), or a tuple of Nones if it's invalid"""
+
+    try:
+        (params, salt, hashval) = pwhash[len(PBKDF2_HASH_PREFIX):].split('$', 2)
+        (method, iterations) = params.split(':', 1)
+        return (method, int(iterations), salt, hashval)
+    except ValueError, exc:
+        return (None, None, None, None)
+
+
+def _pbkdf2_hash(raw_password, method, salt, iterations):
+    if isinstance(raw_password, unicode):
+        raw_password = raw_password.encode('utf-8')
+
+    # The hash parameters are parsed from the stored (unicode) hash - pbkdf2_hmac only accepts byte strings
+    return binascii.hexlify(hashlib.pbkdf2_hmac(str(method), raw_password, str(salt), iterations))
+
+
 
 def register_new_user(user_name, email, password, **kwd):
     """Utility method for registering a new user. Useful for creating the first admin user. Returns the newly-created user.
@@ -651,4 +1321,26 @@ def register_new_user(user_name, email, password, **kwd):
     return user_data[1]
 
 
+def register_new_users(users, **kwd):
+    """Utility method for registering many users at once (e.g. when provisioning the users of a new organization).
+    `users` is a list of dicts, each containing `user_name`, `email`, `password` and any additional user properties.
+    Can pass a `user_model` parameter to use a different User model.
+
+    Returns a list with a result dict for each of the input users - see User.create_users.
+    """
+    user_model = import_class(kwd.pop('user_model', User))
+
+    unique_properties = ['email']
+    users_to_create = []
+
+    for user in users:
+        user_values = dict(user)
+        user_name = user_values.pop('user_name')
+        user_values['password_raw'] = user_values.pop('password')
+        user_values.update(kwd)
+        users_to_create.append((user_name, user_values))
+
+    return user_model.create_users(users_to_create, unique_properties)
+
+
 
@@ -0,0 +1,107 @@
+"""
+Bulk POST benchmark: the time of a POST of many rows (strings, numbers, dates/times, repeated and structured properties), and how much
+of it is spent validating and converting the input (`_build_model_from_data`), on the SDK testbed stubs.
+
+Usage (see gae_testbed.py):
+
+    GAE_SDK=/path/to/google_appengine python2.7 tests/benchmark_bulk_post.py [--rows N] [--runs N] [--root PATH]
+
+`--root` runs the benchmark against another rest_gae checkout (e.g. an older version, for comparison). The datetimes are naive (older
+versions reject timezone-aware values).
+"""
+
+import os
+import json
+import time
+import argparse
+
+import gae_testbed
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument('--rows', type=int, default=1000, help='the number of rows in each POST (default: 1000)')
+parser.add_argument('--runs', type=int, default=7, help='the number of timed POSTs (default: 7)')
+parser.add_argument('--root', default=None, help='the rest_gae checkout to benchmark (default: this repository)')
+args = parser.parse_args()
+
+gae_testbed.fix_sys_path(args.root)
+testbed = gae_testbed.setup()
+
+import webapp2
+from google.appengine.ext import ndb
+from rest_gae import rest_gae
+
+
+class Address(ndb.Model):
+    city = ndb.StringProperty()
+    zip = ndb.IntegerProperty()
+
+
+class Row(ndb.Model):
+    name = ndb.StringProperty()
+    count = ndb.IntegerProperty()
+    score = ndb.FloatProperty()
+    active = ndb.BooleanProperty()
+    created = ndb.DateTimeProperty()
+    day = ndb.DateProperty()
+    at = ndb.TimeProperty()
+    tags = ndb.StringProperty(repeated=True)
+    address = ndb.StructuredProperty(Address)
+    notes = ndb.TextProperty()
+
+
+app = webapp2.WSGIApplication([rest_gae.RESTHandler('/api/rows', Row, permissions={ 'POST': rest_gae.PERMISSION_ANYONE })],
+                              config={ 'webapp2_extras.sessions': { 'secret_key': 'benchmark' } })
+
+body = json.dumps([{
+    'name': 'row %d' % i,
+    'count': i,
+    'score': i * 0.5,
+    'active': i % 2 == 0,
+    'created': '2014-02-%02dT10:%02d:30.123' % (i % 28 + 1, i % 60),
+    'day': '2014-03-%02d' % (i % 28 + 1),
+    'at': '12:%02d:00' % (i % 60),
+    'tags': ['a', 'b', 'c'],
+    'address': { 'city': 'X', 'zip': i },
+    'notes': 'n' * 50
+    } for i in range(args.rows)])
+
+# Measure the time spent in _build_model_from_data (called for each row, and for each nested StructuredProperty)
+build_model_from_data = rest_gae.BaseRESTHandler._build_model_from_data
+build_time = [0.0]
+build_depth = [0]
+
+def timed_build_model_from_data(self, *args, **kwd):
+    start = time.time()
+    build_depth[0] += 1
+    try:
+        return build_model_from_data(self, *args, **kwd)
+    finally:
+        build_depth[0] -= 1
+        if not build_depth[0]:
+            # Only count the top-level calls (the nested StructuredProperty calls are included in them)
+            build_time[0] += time.time() - start
+
+rest_gae.BaseRESTHandler._build_model_from_data = timed_build_model_from_data
+
+
+def post():
+    request = webapp2.Request.blank('/api/rows', method='POST', body=body)
+    request.content_type = 'application/json'
+
+    build_time[0] = 0.0
+    start = time.time()
+    response = request.get_response(app)
+    elapsed = time.time() - start
+
+    assert response.status_int == 200, response.body[:300]
+    return (elapsed, build_time[0])
+
+
+post() # Warm up
+(totals, builds) = zip(*[post() for i in range(args.runs)])
+median = lambda values: sorted(values)[len(values) // 2] * 1000
+
+print '%s: POST %d rows - median %.0fms, of which _build_model_from_data %.1fms (%.1fus per row)' % (
+    os.path.dirname(os.path.dirname(os.path.abspath(rest_gae.__file__))), args.rows, median(totals), median(builds), median(builds) * 1000 / args.rows)
+
+testbed.deactivate()
@@ -0,0 +1,106 @@
+"""
+Response encodings benchmark: the size and the encode time of GET list pages as JSON and as MessagePack (content negotiation by the
+Accept header), and the size and compression time of gzipped JSON, on the SDK testbed stubs.
+
+Usage (see gae_testbed.py):
+
+    GAE_SDK=/path/to/google_appengine python2.7 tests/benchmark_encodings.py [--requests N]
+
+Needs the msgpack package.
+"""
+
+import json
+import time
+import zlib
+import argparse
+
+import gae_testbed
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument('--requests', type=int, default=50, help='the number of timed requests of each page size and encoding (default: 50)')
+args = parser.parse_args()
+
+gae_testbed.fix_sys_path()
+testbed = gae_testbed.setup()
+
+import msgpack
+import webapp2
+from google.appengine.ext import ndb
+from rest_gae import rest_gae
+
+
+class Item(ndb.Model):
+    name = ndb.StringProperty()
+    description = ndb.TextProperty()
+    price = ndb.FloatProperty()
+    tags = ndb.StringProperty(repeated=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    owner = ndb.KeyProperty()
+
+
+app = webapp2.WSGIApplication([rest_gae.RESTHandler('/api/items', Item, permissions={ 'GET': rest_gae.PERMISSION_ANYONE })],
+                              config={ 'webapp2_extras.sessions': { 'secret_key': 'benchmark' } })
+
+ndb.put_multi([Item(name='item %d' % i, description='A fairly ordinary description of item number %d, ' % i * 3, price=i * 1.25,
+                    tags=['tag%d' % (i % 7), 'tag%d' % (i % 11)], owner=ndb.Key('User', i % 13 + 1)) for i in range(100)])
+
+# The time of encoding the response (the rest of the request is the same for all encodings)
+get_response = rest_gae.BaseRESTHandler.get_response
+encode_time = [0.0]
+
+def timed_get_response(self, *args, **kwd):
+    start = time.time()
+    try:
+        return get_response(self, *args, **kwd)
+    finally:
+        encode_time[0] += time.time() - start
+
+rest_gae.BaseRESTHandler.get_response = timed_get_response
+
+
+def get_page(limit, accept):
+    """Returns the last response and the median request and encode times (in ms) of a page of `limit` results in the `accept` format"""
+
+    (request_times, encode_times) = ([], [])
+
+    for i in range(args.requests):
+        ndb.get_context().clear_cache()
+        request = webapp2.Request.blank('/api/items?limit=%d' % limit, headers={ 'Accept': accept })
+
+        encode_time[0] = 0.0
+        start = time.time()
+        response = request.get_response(app)
+        request_times.append(time.time() - start)
+        encode_times.append(encode_time[0])
+
+        assert response.status_int == 200, response.body
+
+    median = lambda values: sorted(values)[len(values) // 2] * 1000
+    return (response, median(request_times), median(encode_times))
+
+
+def gzip_json(body):
+    """Returns the gzipped size of `body` and its compression time (in ms)"""
+
+    start = time.time()
+    for i in range(args.requests):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+
+    return (len(compressed), (time.time() - start) * 1000 / args.requests)
+
+
+for limit in [1, 20, 100]:
+    (json_response, json_time, json_encode_time) = get_page(limit, 'application/json')
+    (msgpack_response, msgpack_time, msgpack_encode_time) = get_page(limit, 'application/x-msgpack')
+    (gzip_size, gzip_time) = gzip_json(json_response.body)
+
+    # Both encodings hold the same output
+    assert msgpack_response.content_type == 'application/x-msgpack'
+    assert msgpack.unpackb(msgpack_response.body, raw=False) == json.loads(json_response.body)
+
+    print 'limit=%3d  JSON: %6d bytes, encode %.2fms (request %.2fms) | MessagePack: %6d bytes, encode %.2fms (request %.2fms) | ' \
+          'gzipped JSON: %5d bytes, +%.2fms' % (limit, len(json_response.body), json_encode_time, json_time, len(msgpack_response.body),
+                                               msgpack_encode_time, msgpack_time, gzip_size, gzip_time)
+
+testbed.deactivate()
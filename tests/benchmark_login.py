@@ -0,0 +1,69 @@
+"""
+Login benchmark: the latency (p50/p99) of POST /users/login on the SDK testbed stubs, and the datastore calls made by each login
+(the auth_id -> user lookup is cached in memcache, so a login should only get the user by key).
+
+Usage (see gae_testbed.py):
+
+    GAE_SDK=/path/to/google_appengine python2.7 tests/benchmark_login.py [--iterations N] [--logins N] [--root PATH]
+
+`--iterations` is the UserRESTHandler `password_hash_iterations` (the user is registered with a single-iteration hash, so the first
+login rehashes the password). `--root` runs the benchmark against another rest_gae checkout (e.g. an older version, for comparison).
+"""
+
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+
+import gae_testbed
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument('--iterations', type=int, default=1, help='password_hash_iterations (default: 1)')
+parser.add_argument('--logins', type=int, default=300, help='the number of timed logins (default: 300)')
+parser.add_argument('--root', default=None, help='the rest_gae checkout to benchmark (default: this repository)')
+args = parser.parse_args()
+
+gae_testbed.fix_sys_path(args.root)
+testbed = gae_testbed.setup()
+
+import webapp2
+from google.appengine.api import apiproxy_stub_map
+from rest_gae.users import UserRESTHandler, register_new_user
+
+app = webapp2.WSGIApplication([UserRESTHandler('/users', password_hash_method='sha256', password_hash_iterations=args.iterations)], config={
+    'webapp2_extras.auth': { 'user_model': 'rest_gae.users.User', 'user_attributes': [] },
+    'webapp2_extras.sessions': { 'secret_key': 'benchmark' },
+    })
+
+register_new_user('alice', 'alice@example.com', 'secret')
+
+# Count the datastore calls of the timed logins
+datastore_calls = Counter()
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('count_datastore_calls',
+    lambda service, call, request, response: datastore_calls.update([call]) if service == 'datastore_v3' else None)
+
+
+def login():
+    request = webapp2.Request.blank('/users/login', method='POST', body=json.dumps({ 'user_name': 'alice', 'password': 'secret' }))
+    request.content_type = 'application/json'
+
+    start = time.time()
+    response = request.get_response(app)
+    elapsed = (time.time() - start) * 1000
+
+    assert response.status_int == 200, response.body
+    return elapsed
+
+
+# Warm up (and rehash the password if the iterations were changed)
+login()
+datastore_calls.clear()
+
+latencies = sorted(login() for i in range(args.logins))
+percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+print 'iterations=%d logins=%d: p50 %.2fms, p99 %.2fms' % (args.iterations, args.logins, percentile(0.5), percentile(0.99))
+print 'datastore calls per login: %s' % ', '.join('%s %.1f' % (call, count / float(args.logins)) for (call, count) in sorted(datastore_calls.items()))
+
+testbed.deactivate()
@@ -0,0 +1,81 @@
+"""
+Sets up the App Engine SDK testbed (datastore, memcache, task queue, blobstore and other service stubs) for the stress tests and the
+benchmarks. The SDK directory (the one containing dev_appserver.py) is read from the GAE_SDK environment variable, e.g.:
+
+    GAE_SDK=/path/to/google_appengine python2.7 tests/stress_test.py
+"""
+
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fix_sys_path(root=None):
+    """Adds the SDK (and its bundled libraries) and the rest_gae checkout at `root` (this repository by default) to sys.path"""
+
+    sdk = os.environ.get('GAE_SDK')
+    if not sdk or not os.path.exists(os.path.join(sdk, 'dev_appserver.py')):
+        raise SystemExit('Set GAE_SDK to the App Engine SDK directory (the one containing dev_appserver.py)')
+
+    # Makes google.appengine.ext.webapp use webapp2 (as in production) - it's read when the module is first imported
+    os.environ['APPENGINE_RUNTIME'] = 'python27'
+
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+    sys.path.insert(0, root or REPO_ROOT)
+
+
+def setup():
+    """Activates a testbed with all of the service stubs used by rest_gae and returns it (call testbed.deactivate() when done)"""
+
+    from google.appengine.ext import testbed
+    from google.appengine.ext import ndb
+    from google.appengine.datastore import datastore_stub_util
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.setup_env(app_id='testapp', default_version_hostname='localhost:8080', overwrite=True)
+
+    # Queries are strongly consistent, so the tests can check their results right after each write
+    tb.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=REPO_ROOT)
+    tb.init_blobstore_stub()
+    tb.init_app_identity_stub()
+    tb.init_mail_stub()
+    tb.init_search_stub()
+    tb.init_urlfetch_stub()
+
+    try:
+        tb.init_images_stub()
+    except testbed.StubNotSupportedError:
+        # The images stub needs PIL
+        pass
+
+    ndb.get_context().clear_cache()
+    return tb
+
+
+def run_tasks(tb, queue='default', max_rounds=50):
+    """Runs the deferred tasks of `queue` (including the tasks they add) and returns the number of tasks run"""
+
+    from google.appengine.ext import testbed
+    from google.appengine.ext import deferred
+
+    stub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    count = 0
+
+    for i in range(max_rounds):
+        tasks = stub.get_filtered_tasks(queue_names=[queue])
+        if not tasks:
+            break
+
+        stub.FlushQueue(queue)
+        for task in tasks:
+            deferred.run(task.payload)
+            count += 1
+
+    return count
@@ -0,0 +1,211 @@
+"""
+Concurrent-request stress tests: several RESTHandlers (with different settings) of the same model are called from a thread pool with
+mixed GET/POST/PUT traffic - checking that each response is correct (the models' data, the translated property names, and the
+per-handler blob URL settings), and that the shared model metadata isn't modified by the requests.
+
+Usage (see gae_testbed.py):
+
+    GAE_SDK=/path/to/google_appengine python2.7 tests/stress_test.py [-v]
+
+The thread count and the number of requests per thread can be set with STRESS_THREADS and STRESS_REQUESTS. The throughput of a single
+thread and of all of the threads is printed - note that the SDK stubs run in-process (under the GIL), so the throughput isn't expected
+to grow with the number of threads here; the multi-threaded run only has to serve all of the requests correctly.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import unittest
+from urllib import urlencode
+from multiprocessing.pool import ThreadPool
+
+import gae_testbed
+gae_testbed.fix_sys_path()
+
+import webapp2
+from google.appengine.ext import ndb
+from google.appengine.ext import blobstore
+from rest_gae import RESTHandler, PERMISSION_ANYONE
+from rest_gae.rest_gae import get_translation_table, get_included_properties
+
+THREADS = int(os.environ.get('STRESS_THREADS', 8))
+REQUESTS_PER_THREAD = int(os.environ.get('STRESS_REQUESTS', 60))
+
+HOST_URL = 'http://localhost:8080'
+
+
+class Document(ndb.Model):
+    title = ndb.StringProperty()
+    rank = ndb.IntegerProperty(default=0)
+    file = ndb.BlobKeyProperty()
+
+    class RESTMeta:
+        translate_property_names = { 'title': 'name' }
+        translate_output_property_names = { 'rank': 'position' }
+        views = { 'top': { 'order': '-rank', 'limit': 5 } }
+
+
+# The names of the shared models (created in setUp), ordered by their blob keys
+SHARED_NAMES_BY_FILE = ['shared %d' % i for i in sorted(range(20), key=lambda i: 'blob%d' % i)]
+
+PERMISSIONS = { 'GET': PERMISSION_ANYONE, 'POST': PERMISSION_ANYONE, 'PUT': PERMISSION_ANYONE }
+
+# The handlers of the same model - each with its own blob download settings
+HANDLER_SECRETS = { 'a': 'secret-a', 'b': None, 'c': 'secret-c' }
+
+
+def create_app():
+    routes = []
+    for (name, secret) in sorted(HANDLER_SECRETS.items()):
+        settings = { 'blob_download_secret': secret, 'blob_download_url_ttl': 600 } if secret else {}
+        routes.append(RESTHandler('/api/%s' % name, Document, permissions=PERMISSIONS, **settings))
+
+    return webapp2.WSGIApplication(routes, config={ 'webapp2_extras.sessions': { 'secret_key': 'stress' } })
+
+
+class StressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = gae_testbed.setup()
+        self.app = create_app()
+        self.shared_keys = ndb.put_multi([Document(title='shared %d' % i, rank=i, file=blobstore.BlobKey('blob%d' % i)) for i in range(20)])
+        self.metadata = self._get_metadata()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def _get_metadata(self):
+        return [dict(get_translation_table(Document, input_type)) for input_type in ['input', 'output']] + \
+               [set(get_included_properties(Document, input_type)) for input_type in ['input', 'output']]
+
+    def request(self, method, path, data=None):
+        """Calls the app (as a new request - without the ndb cache of previous requests) and returns (status, decoded JSON output)"""
+
+        ndb.get_context().clear_cache()
+        request = webapp2.Request.blank(path, method=method, body=json.dumps(data) if data is not None else None)
+        if data is not None:
+            request.content_type = 'application/json'
+
+        response = request.get_response(self.app)
+        return (response.status_int, json.loads(response.body) if response.content_type == 'application/json' else None)
+
+    def check_output(self, handler, output):
+        """Checks the output of a single model by `handler` - the output property names and the handler's blob URLs"""
+
+        self.assertEqual(set(output.keys()), set(['id', 'name', 'position', 'file']))
+
+        upload_url = output['file']['upload_url']
+        download_url = output['file']['download_url']
+        self.assertEqual(upload_url, '%s/api/%s/%s/file' % (HOST_URL, handler, output['id']))
+
+        if download_url is None:
+            # No blob yet
+            return
+        elif HANDLER_SECRETS[handler] is None:
+            self.assertEqual(download_url, upload_url)
+        else:
+            # A pre-authorized URL - accepted only by the handler that signed it
+            self.assertTrue(download_url.startswith('%s/api/%s/_blobs/' % (HOST_URL, handler)), download_url)
+
+    def run_client(self, seed):
+        """Sends a random mix of requests - creating, updating and reading its own models and listing the shared ones. Returns the
+        number of requests and the last (name, rank) of each of its models."""
+
+        rand = random.Random(seed)
+        expected = {}
+        count = 0
+
+        while count < REQUESTS_PER_THREAD:
+            handler = rand.choice(sorted(HANDLER_SECRETS))
+            action = rand.choice(['post', 'put', 'get', 'list']) if expected else 'post'
+
+            if action == 'post':
+                name = 'doc %s-%d' % (seed, count)
+                (status, output) = self.request('POST', '/api/%s' % handler, { 'name': name, 'rank': count })
+                self.assertEqual(status, 200, output)
+                self.assertEqual((output[0]['name'], output[0]['position']), (name, count))
+                self.check_output(handler, output[0])
+                expected[output[0]['id']] = (name, count)
+
+            elif action == 'put':
+                model_id = rand.choice(sorted(expected))
+                rank = rand.randint(0, 1000)
+                (status, output) = self.request('PUT', '/api/%s/%s' % (handler, model_id), { 'rank': rank })
+                self.assertEqual(status, 200, output)
+                self.assertEqual((output[0]['id'], output[0]['position']), (model_id, rank))
+                self.check_output(handler, output[0])
+                expected[model_id] = (expected[model_id][0], rank)
+
+            elif action == 'get':
+                model_id = rand.choice(sorted(expected))
+                (status, output) = self.request('GET', '/api/%s/%s' % (handler, model_id))
+                self.assertEqual(status, 200, output)
+                self.assertEqual((output['name'], output['position']), expected[model_id])
+                self.check_output(handler, output)
+
+            else:
+                # Only the shared models have files (ordered by the file, as the inequality property)
+                (status, output) = self.request('GET', '/api/%s?%s' % (handler, urlencode({ 'q': 'file != NULL', 'limit': 10 })))
+                self.assertEqual(status, 200, output)
+                self.assertEqual([m['name'] for m in output['results']], SHARED_NAMES_BY_FILE[:10])
+                for m in output['results']:
+                    self.check_output(handler, m)
+
+            count += 1
+
+        return (count, expected)
+
+    def run_clients(self, threads):
+        """Runs `threads` clients at once and returns their results and the number of requests per second"""
+
+        pool = ThreadPool(threads)
+        start = time.time()
+        try:
+            results = pool.map(self.run_client, range(threads))
+        finally:
+            pool.close()
+            pool.join()
+
+        return (results, sum(count for (count, _) in results) / (time.time() - start))
+
+    def test_concurrent_requests(self):
+        (_, single_rate) = self.run_clients(1)
+        (results, rate) = self.run_clients(THREADS)
+        sys.stderr.write('\n1 thread: %.0f requests/s, %d threads: %.0f requests/s\n' % (single_rate, THREADS, rate))
+
+        self.assertEqual(sum(count for (count, _) in results), THREADS * REQUESTS_PER_THREAD)
+
+        # The stored models match the last response of each client
+        for (_, expected) in results:
+            for (model_id, (name, rank)) in expected.iteritems():
+                model = ndb.Key(urlsafe=model_id).get()
+                self.assertEqual((model.title, model.rank), (name, rank))
+
+        # The input and output translation tables didn't leak into each other (and nothing else was modified)
+        self.assertEqual(self._get_metadata(), self.metadata)
+        self.assertEqual(Document.RESTMeta.translate_property_names, { 'title': 'name' })
+
+    def test_signed_urls_per_handler(self):
+        (status, output) = self.request('GET', '/api/a/%s' % self.shared_keys[0].urlsafe())
+        path = output['file']['download_url'][len(HOST_URL):]
+
+        self.assertEqual(self.request('GET', path)[0], 200)
+        # Signed with handler a's secret - rejected by handler c
+        self.assertEqual(self.request('GET', path.replace('/api/a/', '/api/c/'))[0], 403)
+
+    def test_views_use_the_handler_settings(self):
+        # The view is refreshed in a task - using the settings of the handler that changed the model
+        (status, output) = self.request('PUT', '/api/c/%s' % self.shared_keys[0].urlsafe(), { 'rank': 100 })
+        self.assertEqual(status, 200, output)
+        gae_testbed.run_tasks(self.testbed)
+
+        (status, output) = self.request('GET', '/api/c/_views/top')
+        self.assertEqual(status, 200, output)
+        self.assertEqual([m['position'] for m in output['results']], [100, 19, 18, 17, 16])
+        self.check_output('c', output['results'][0])
+
+
+if __name__ == '__main__':
+    unittest.main()